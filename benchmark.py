@@ -0,0 +1,395 @@
+'''
+Offline benchmarks on synthetic region sets.
+
+make_region_set() builds what setup.main returns (a ShapeSchema GeoDataFrame, a
+GraphSchema neighbor frame and a PopulationSchema frame, all indexed by id) for a grid or
+a Voronoi tessellation of any size, without pygris or the census API. run() times the
+setup, simulate and visualize entry points on it, plus fresh processes running it through
+main and headless (cold_start), and appends the results to a JSON-lines file, so two
+versions can be compared with compare().
+
+    python benchmark.py --sizes 50 1000 10000 --layouts grid voronoi
+    python benchmark.py --compare old_results.jsonl new_results.jsonl
+'''
+import argparse
+import copy
+from config import Filepaths, Settings
+from data.list_of_contiguous_states import CONTIGUOUS_STATES
+import data.schema as sch
+from datetime import datetime
+import geopandas as gpd
+import instrument
+import json
+import matplotlib
+import numpy as np
+import os
+import pandas as pd
+import platform
+import setup
+import shapely
+import simulate
+from sinks import KeyframeSink, SummarySink
+from state import SimulationState, static_frame
+import subprocess
+import sys
+import tempfile
+import visualize as viz
+
+LAYOUT_ERROR_MESSAGE = "layout must be 'grid' or 'voronoi'"
+BENCHMARKS = [
+    "generate_neighborfile",
+    "initialize",
+    "time_step",
+    "calculate_migration",
+    "generate_geo_plot_data",
+    "render_frame",
+    "cold_start"
+]
+BOUNDS = (-124.0, 25.0, -67.0, 49.0) #Contiguous US, EPSG:4269
+US_POPULATION = 330e6
+MAX_NEIGHBORFILE_REGIONS = 100000 #Larger sets skip setup.generate_neighborfile, which reprojects and buffers every polygon
+MAX_COLD_START_REGIONS = 20000 #Larger sets can have over 999 regions per state, which the 3-digit county codes of the data files can not number
+
+def make_geometries(n:int, layout:str, seed:int) -> np.ndarray:
+    xmin, ymin, xmax, ymax = BOUNDS
+    match layout:
+        case "grid":
+            columns = max(1, round(np.sqrt(n * (xmax - xmin) / (ymax - ymin))))
+            rows = int(np.ceil(n / columns))
+            width = (xmax - xmin) / columns
+            height = (ymax - ymin) / rows
+            i = np.arange(n) // rows
+            j = np.arange(n) % rows
+            return shapely.box(xmin + i*width, ymin + j*height, xmin + (i + 1)*width, ymin + (j + 1)*height)
+        case "voronoi":
+            rng = np.random.default_rng(seed)
+            points = shapely.points(rng.uniform(xmin, xmax, n), rng.uniform(ymin, ymax, n))
+            extent = shapely.box(*BOUNDS)
+            cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent, ordered=True))
+            return shapely.intersection(cells, extent)
+        case _:
+            raise ValueError(LAYOUT_ERROR_MESSAGE)
+
+def make_neighbor_frame(gdf:gpd.GeoDataFrame) -> pd.DataFrame:
+    '''
+    The neighbor frame setup.generate_neighborfile would produce for gdf (indexed by id),
+    found with one vectorized STRtree query so large sets stay tractable
+    '''
+    geometries = gdf.geometry.to_numpy()
+    left, right = shapely.STRtree(geometries).query(geometries, predicate="intersects")
+    pairs = left != right
+    left, right = left[pairs], right[pairs]
+    # Shapefile polygons are 1:100 km
+    shared_border_length = 100 * shapely.length(shapely.intersection(geometries[left], geometries[right]))
+    shared = shared_border_length > 0
+    left, right, shared_border_length = left[shared], right[shared], shared_border_length[shared]
+    ids = gdf.index.to_numpy()
+    state_fp = gdf["STATEFP"].to_numpy()
+    county_fp = gdf["COUNTYFP"].to_numpy()
+    names = gdf["NAME"].to_numpy()
+    neighbors = [[] for _ in range(len(gdf))]
+    for i, j, length in zip(left.tolist(), right.tolist(), shared_border_length.tolist()):
+        neighbors[i].append({
+            "neighbor_id":ids[j],
+            "neighbor_state_fp":state_fp[j],
+            "neighbor_name":names[j],
+            "shared_border_length":length,
+            "neighbor_county_fp":county_fp[j]
+        })
+    neighbor_df = pd.DataFrame({
+        "state_fp":state_fp,
+        "name":names,
+        "county_fp":county_fp,
+        "border_length":100 * shapely.length(geometries),
+        "neighbors":neighbors
+    }, index=pd.Index(ids, name="id"))
+    return neighbor_df[neighbor_df["neighbors"].map(len) > 0]
+
+def make_region_set(
+        n:int,
+        layout:str = "grid",
+        seed:int = 0,
+        validate:bool = False
+    ) -> tuple[gpd.GeoDataFrame, pd.DataFrame, pd.DataFrame]:
+    '''
+    A synthetic (shape_gdf, neighbors_df, population_df) triple with n regions spread over
+    the contiguous states in west-to-east bands. validate runs the same schema cleaning as
+    setup.main, which takes far longer than generating the data on large sets.
+    '''
+    rng = np.random.default_rng(seed)
+    geometries = make_geometries(n, layout, seed)
+    n = len(geometries)
+    # Every state gets a west-to-east band of regions, numbered within the state
+    order = np.argsort(shapely.get_x(shapely.centroid(geometries)), kind="stable")
+    states = np.empty(n, dtype=int)
+    states[order] = np.arange(n) * len(CONTIGUOUS_STATES) // n
+    state_fp = np.array([str(CONTIGUOUS_STATES[state]["state_fp"]).zfill(2) for state in states])
+    county_number = pd.Series(np.zeros(n, dtype=int)).groupby(states).cumcount().to_numpy() + 1
+    county_fp = pd.Series(county_number).astype(str).str.zfill(max(3, len(str(n)))).to_numpy()
+    ids = np.char.add(state_fp, county_fp.astype(str))
+    names = np.char.add("Region ", ids)
+    # Shapefile polygons are 1:100 km, so a square degree is 1e10 m^2
+    aland = shapely.area(geometries) * 1e10
+    shape_gdf = gpd.GeoDataFrame({
+        "STATEFP":state_fp,
+        "COUNTYFP":county_fp,
+        "NAME":names,
+        "ALAND":aland,
+        "AWATER":0.0,
+        "id":ids
+    }, geometry=geometries, crs="EPSG:4269")
+    weights = rng.lognormal(0, 1.5, n)
+    population_df = pd.DataFrame({
+        "NAME":names,
+        "POP":np.maximum(np.round(weights / weights.sum() * US_POPULATION), 1).astype(np.int64),
+        "HISP":0,
+        "state":state_fp,
+        "county":county_fp,
+        "id":ids
+    })
+    if validate:
+        shape_gdf = sch.clean_df(shape_gdf, sch.ShapeSchema)
+        population_df = sch.clean_df(population_df, sch.PopulationSchema)
+    shape_gdf = shape_gdf.set_index("id")
+    population_df = population_df.set_index("id")
+    neighbors_df = make_neighbor_frame(shape_gdf)
+    if validate:
+        neighbors_df = sch.clean_df(neighbors_df, sch.GraphSchema)
+    return shape_gdf, neighbors_df, population_df
+
+def get_settings(shape_gdf:gpd.GeoDataFrame) -> Settings:
+    settings = Settings()
+    settings.simulation_resolution = "county"
+    settings.simulation_length = 30
+    settings.outbreak_size = 100
+    # A handful of outbreaks spread through the domain
+    settings.outbreak_region = list(shape_gdf.index[np.linspace(0, len(shape_gdf) - 1, 5).astype(int)].unique())
+    settings.fps = 1
+    settings.animation_duration = 2
+    return settings
+
+def timed(recorder:instrument.Recorder, name:str, repeat:int, function, *args):
+    for _ in range(repeat):
+        with recorder.timer(name):
+            ret = function(*args)
+    return ret
+
+def run_region_set(n:int, layout:str, benchmarks:list[str], repeat:int = 3, seed:int = 0) -> dict:
+    '''
+    Times the selected benchmarks on one synthetic region set and returns a result record
+    '''
+    shape_gdf, neighbors_df, population_df = make_region_set(n, layout, seed)
+    settings = get_settings(shape_gdf)
+    recorder = instrument.Recorder()
+    with instrument.recording(recorder):
+        if "generate_neighborfile" in benchmarks and len(shape_gdf) <= MAX_NEIGHBORFILE_REGIONS:
+            timed(recorder, "benchmark.generate_neighborfile", repeat, setup.generate_neighborfile, shape_gdf.reset_index())
+        initial_df = timed(recorder, "benchmark.initialize", 1 if "initialize" not in benchmarks else repeat,
+                           simulate.initialize, shape_gdf, neighbors_df, population_df, settings)
+        if "time_step" in benchmarks:
+            rng = simulate.make_rng(settings)
+            timed(recorder, "benchmark.time_step", repeat, simulate.time_step, initial_df, settings, rng)
+        if "calculate_migration" in benchmarks:
+            timed(recorder, "benchmark.calculate_migration", repeat, simulate.calculate_migration, initial_df)
+        if "generate_geo_plot_data" in benchmarks or "render_frame" in benchmarks:
+            keyframe_sink = KeyframeSink(list(range(settings.simulation_length + 1)))
+            summary_sink = SummarySink()
+            simulate.run_state(
+                simulate.get_topology(initial_df),
+                SimulationState.from_frame(initial_df),
+                static_frame(initial_df),
+                settings,
+                [summary_sink, keyframe_sink],
+                verbose=False
+            )
+            plot_data = timed(recorder, "benchmark.generate_geo_plot_data", repeat,
+                              viz.generate_geo_plot_data, keyframe_sink, shape_gdf, settings)
+            if "render_frame" in benchmarks:
+                render_frame(recorder, plot_data, shape_gdf, simulate.summarize(summary_sink), settings, repeat)
+        if "cold_start" in benchmarks and len(shape_gdf) <= MAX_COLD_START_REGIONS:
+            time_cold_start(recorder, shape_gdf, population_df, settings, repeat)
+    return {
+        "layout":layout,
+        "regions":len(shape_gdf),
+        "edges":int(neighbors_df["neighbors"].map(len).sum()),
+        "timings":recorder.rows(),
+        "counts":recorder.counts
+    }
+
+def render_frame(
+        recorder:instrument.Recorder,
+        plot_data:viz.GeoPlotData,
+        shape_gdf:gpd.GeoDataFrame,
+        pop_data:pd.DataFrame,
+        settings:Settings,
+        repeat:int
+    ) -> None:
+    plot_borders = shape_gdf.dissolve(by="STATEFP").reset_index()
+    plot_types = settings.get_plot_types()
+    fig, axs, limits, colormap = viz.setup_plots_and_limits(plot_types, plot_data, pop_data, settings)
+    frame = settings.simulation_length // 2
+    for _ in range(repeat):
+        with recorder.timer("benchmark.render_frame"):
+            viz.generate_frame(frame, plot_data, plot_borders, pop_data, plot_types, axs, limits, colormap)
+            fig.canvas.draw()
+    # Every later frame of an animation only recolours the geo plot the first one drew
+    geo_artists = {}
+    viz.generate_frame(0, plot_data, plot_borders, pop_data, plot_types, axs, limits, colormap, None, geo_artists)
+    for _ in range(repeat):
+        with recorder.timer("benchmark.update_frame"):
+            viz.generate_frame(frame, plot_data, plot_borders, pop_data, plot_types, axs, limits, colormap, None, geo_artists)
+            fig.canvas.draw()
+    viz.plt.close(fig)
+
+def write_data_directory(directory:str, shape_gdf:gpd.GeoDataFrame, population_df:pd.DataFrame) -> tuple[Filepaths, dict[str, str]]:
+    '''
+    Writes a region set as the county shapefile and population file of a data directory,
+    renumbered with the 3-digit county codes those files use, and returns its Filepaths
+    and the new id of every region
+    '''
+    filepaths = Filepaths()
+    filepaths.data_directory = directory
+    filepaths.shape_directory = os.path.join(directory, "shapefiles")
+    filepaths.neighbor_directory = os.path.join(directory, "neighbors")
+    filepaths.population_directory = os.path.join(directory, "populations")
+    filepaths.county_populations_filename = os.path.join(filepaths.population_directory, "county_populations.csv")
+    filepaths.last_simulation_directory = os.path.join(directory, "last_simulation")
+    filepaths.checkpoint_directory = os.path.join(directory, "checkpoints")
+    filepaths.report_directory = os.path.join(directory, "reports")
+    filepaths.setup_cache_directory = os.path.join(directory, "setup_cache")
+    for path in [filepaths.shape_directory, filepaths.neighbor_directory, filepaths.population_directory]:
+        os.makedirs(path, exist_ok=True)
+    county_fp = shape_gdf["COUNTYFP"].astype(int).astype(str).str.zfill(3)
+    ids = dict(zip(shape_gdf.index, shape_gdf["STATEFP"] + county_fp))
+    shape_gdf.assign(COUNTYFP=county_fp).reset_index(drop=True).to_file(os.path.join(filepaths.shape_directory, filepaths.county_shapefile_filename))
+    pd.DataFrame({
+        "NAME":population_df["NAME"].to_numpy(),
+        "POP":population_df["POP"].to_numpy(),
+        "HISP":population_df["HISP"].to_numpy(),
+        "state":population_df["state"].astype(int).to_numpy(),
+        "county":population_df["county"].astype(int).to_numpy()
+    }).to_csv(filepaths.county_populations_filename, index=False)
+    return filepaths, ids
+
+def time_cold_start(
+        recorder:instrument.Recorder,
+        shape_gdf:gpd.GeoDataFrame,
+        population_df:pd.DataFrame,
+        settings:Settings,
+        repeat:int
+    ) -> None:
+    '''
+    Times fresh processes that set up and simulate the region set through the interactive
+    (main) and the headless entry points, both starting from warm setup caches
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        filepaths, ids = write_data_directory(directory, shape_gdf, population_df)
+        cold_settings = copy.copy(settings)
+        cold_settings.outbreak_region = [ids[region] for region in settings.outbreak_region]
+        arguments = [json.dumps(vars(cold_settings)), json.dumps(vars(filepaths))]
+        environment = os.environ | {"MPLBACKEND":"Agg"}
+        def start(module:str) -> None:
+            code = "; ".join([
+                f"import config, json, sys, {module}",
+                "settings = config.Settings()",
+                "vars(settings).update(json.loads(sys.argv[1]))",
+                "filepaths = config.Filepaths()",
+                "vars(filepaths).update(json.loads(sys.argv[2]))",
+                f"{module}.run_simulation(settings, filepaths)"
+            ])
+            subprocess.run([sys.executable, "-c", code] + arguments, cwd=os.path.dirname(os.path.abspath(__file__)),
+                           env=environment, capture_output=True, check=True)
+        # The first start generates the neighbor file and fills the caches
+        start("headless")
+        for module in ["main", "headless"]:
+            for _ in range(repeat):
+                with recorder.timer(f"benchmark.cold_start_{module}"):
+                    start(module)
+
+def get_version() -> str|None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(
+        sizes:list[int],
+        layouts:list[str],
+        benchmarks:list[str] = BENCHMARKS,
+        repeat:int = 3,
+        filename:str|None = None
+    ) -> list[dict]:
+    '''
+    Benchmarks every size and layout and appends one JSON line per region set to filename
+    '''
+    run_metadata = {
+        "time":datetime.now().isoformat(timespec="seconds"),
+        "version":get_version(),
+        "python":platform.python_version(),
+        "numpy":np.__version__,
+        "pandas":pd.__version__,
+        "machine":platform.machine(),
+        "repeat":repeat
+    }
+    results = []
+    for layout in layouts:
+        for n in sizes:
+            print(f"Benchmarking {n} {layout} regions")
+            result = run_metadata | run_region_set(n, layout, benchmarks, repeat)
+            results.append(result)
+            for row in result["timings"]:
+                if row["phase"].startswith("benchmark."):
+                    print(f"    {row['phase'][10:]:<26}{row['min_s']:>10.4f} s")
+            if filename is not None:
+                directory = os.path.dirname(filename)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(filename, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+    return results
+
+def load_results(filename:str) -> pd.DataFrame:
+    '''
+    One row per (version, layout, regions, phase) with the best time of each benchmark
+    '''
+    rows = []
+    with open(filename, "r") as f:
+        for line in f:
+            result = json.loads(line)
+            for timing in result["timings"]:
+                rows.append({
+                    "version":result["version"],
+                    "layout":result["layout"],
+                    "regions":result["regions"],
+                    "phase":timing["phase"],
+                    "min_s":timing["min_s"]
+                })
+    return pd.DataFrame.from_records(rows)
+
+def compare(baseline_filename:str, current_filename:str) -> pd.DataFrame:
+    '''
+    Best times of both result files side by side, with current / baseline ratios. The
+    latest entry wins when a file holds several runs of the same benchmark.
+    '''
+    keys = ["layout", "regions", "phase"]
+    baseline = load_results(baseline_filename).groupby(keys)["min_s"].last()
+    current = load_results(current_filename).groupby(keys)["min_s"].last()
+    ret_df = pd.concat({"baseline_s":baseline, "current_s":current}, axis=1).dropna()
+    ret_df["ratio"] = ret_df["current_s"] / ret_df["baseline_s"]
+    return ret_df
+
+if __name__ == "__main__":
+    matplotlib.use("Agg")
+    parser = argparse.ArgumentParser(description="Benchmark the simulation on synthetic region sets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 1000, 10000])
+    parser.add_argument("--layouts", nargs="+", default=["grid", "voronoi"])
+    parser.add_argument("--benchmarks", nargs="+", default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=Filepaths().benchmark_results_filename)
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"))
+    args = parser.parse_args()
+    if args.compare:
+        with pd.option_context("display.max_rows", None, "display.width", 120):
+            print(compare(*args.compare))
+    else:
+        run(args.sizes, args.layouts, args.benchmarks, args.repeat, args.output)
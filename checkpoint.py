@@ -0,0 +1,247 @@
+'''
+Checkpoints of a running simulation, and resuming from them.
+
+A checkpoint is a single compressed .npz file holding the day's SimulationState, the
+region graph and static columns, the Settings, the RNG state, the stop criteria and the
+contents of every sink, so a resumed run needs neither the setup data nor the original
+process. Resuming continues from the checkpointed day and gives the same days, stop
+reason and sink contents as a run that was never interrupted. Adaptive runs
+(settings.time_stepping == "adaptive") restart their step size from the checkpointed day,
+so they only agree with an uninterrupted run to within the step tolerance.
+'''
+import copy
+from config import Settings
+import json
+import numpy as np
+import os
+import pandas as pd
+import re
+import simulate
+from state import DYNAMIC_COLUMNS, SimulationState, Trajectory
+import time
+from topology import Topology
+
+CHECKPOINT_FORMAT_VERSION = 1
+CHECKPOINT_PATTERN = re.compile(r"^day_(\d+)\.npz$")
+FAILURE_PATTERN = re.compile(r"^failed_day_(\d+)\.npz$")
+TOPOLOGY_ARRAYS = ["area", "border_length", "border_area_z", "indptr", "dst", "shared_border_length"]
+
+def checkpoint_filename(day:int) -> str:
+    return f"day_{day:05d}.npz"
+
+def failure_filename(day:int) -> str:
+    return f"failed_day_{day:05d}.npz"
+
+def latest(directory:str) -> str|None:
+    '''
+    Path of the most recent checkpoint in directory, or None if there is none
+    '''
+    if not os.path.isdir(directory):
+        return None
+    days = [(int(match.group(1)), filename) for filename in os.listdir(directory) if (match := CHECKPOINT_PATTERN.match(filename))]
+    if not days:
+        return None
+    return os.path.join(directory, max(days)[1])
+
+def write_arrays(path:str, arrays:dict[str, np.ndarray]) -> None:
+    # Write next to the target and rename, so an interrupted save never leaves a torn file
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(temp_path, path)
+
+class Checkpointer:
+    '''
+    Saves a run every interval days, and saves the last completed day when the run raises
+    or is interrupted with Ctrl-C. An interval of 0 only saves on failures. Only the newest
+    keep periodic checkpoints are left in directory.
+    '''
+    def __init__(self, directory:str, interval:int = 0, keep:int = 2):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.topology = None
+        self.static_df = None
+        self.settings = None
+        self.sinks = []
+        self.tracked = None
+
+    def start(
+            self,
+            topology:Topology,
+            static_df:pd.DataFrame,
+            settings:Settings,
+            sinks:list,
+            resumed:bool = False
+        ) -> None:
+        self.topology = topology
+        self.static_df = static_df
+        self.settings = settings
+        self.sinks = sinks
+        self.tracked = None
+        os.makedirs(self.directory, exist_ok=True)
+        if not resumed:
+            # Checkpoints of an earlier run must not be mistaken for this one's
+            for filename in os.listdir(self.directory):
+                if CHECKPOINT_PATTERN.match(filename) or FAILURE_PATTERN.match(filename):
+                    os.remove(os.path.join(self.directory, filename))
+
+    def track(self, day:int, state:SimulationState, rng:np.random.Generator, stop_criteria:simulate.StopCriteria) -> None:
+        '''
+        Called once every day has been recorded by the sinks
+        '''
+        self.tracked = (day, state.copy(), copy.deepcopy(rng.bit_generator.state), stop_snapshot(stop_criteria))
+        if self.interval > 0 and day > 0 and day % self.interval == 0:
+            self.save()
+
+    def save(self) -> str|None:
+        '''
+        Writes the last tracked day and returns its path
+        '''
+        if self.tracked is None:
+            return None
+        day, state, rng_state, stop_state = self.tracked
+        path = os.path.join(self.directory, checkpoint_filename(day))
+        meta = {
+            "version":CHECKPOINT_FORMAT_VERSION,
+            "day":day,
+            "settings":vars(self.settings),
+            "rng_state":rng_state,
+            "quiet_days":stop_state["quiet_days"],
+            "elapsed":stop_state["elapsed"],
+            "sinks":[type(sink).__name__ for sink in self.sinks]
+        }
+        arrays = {"meta":np.array(json.dumps(meta))}
+        arrays["topology/ids"] = np.array(self.topology.ids, dtype=str)
+        for name in TOPOLOGY_ARRAYS:
+            arrays[f"topology/{name}"] = getattr(self.topology, name)
+        for column in self.static_df.columns.drop("neighbors", errors="ignore"):
+            values = self.static_df[column].to_numpy()
+            arrays[f"static/{column}"] = values.astype(str) if values.dtype == object else values
+        for column, values in state.as_dict().items():
+            arrays[f"state/{column}"] = values
+        if stop_state["previous"] is not None:
+            arrays["stop/previous"] = stop_state["previous"]
+        for i, sink in enumerate(self.sinks):
+            for key, values in sink.snapshot().items():
+                arrays[f"sink{i}/{key}"] = values
+        write_arrays(path, arrays)
+        self.prune()
+        return path
+
+    def save_failure(self, state:SimulationState) -> None:
+        '''
+        Saves the last completed day n as a regular checkpoint, plus the state the failed
+        step left behind for day n+1, which is only kept for inspection
+        '''
+        path = self.save()
+        if path is None:
+            return
+        day = self.tracked[0]
+        write_arrays(os.path.join(self.directory, failure_filename(day + 1)), state.as_dict())
+        print(f"Saved a checkpoint of day {day} to {path}")
+
+    def prune(self) -> None:
+        days = sorted(int(match.group(1)) for filename in os.listdir(self.directory) if (match := CHECKPOINT_PATTERN.match(filename)))
+        for day in days[:-self.keep]:
+            os.remove(os.path.join(self.directory, checkpoint_filename(day)))
+
+def stop_snapshot(stop_criteria:simulate.StopCriteria) -> dict:
+    previous = stop_criteria.previous
+    return {
+        "quiet_days":stop_criteria.quiet_days,
+        "elapsed":time.perf_counter() - stop_criteria.start_time,
+        "previous":None if previous is None else previous.copy()
+    }
+
+class Checkpoint:
+    '''
+    A checkpoint read back by load()
+    '''
+    def __init__(self, path:str):
+        with np.load(path) as archive:
+            arrays = {key:archive[key] for key in archive.files}
+        meta = json.loads(str(arrays["meta"]))
+        if meta["version"] != CHECKPOINT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {meta['version']}")
+        self.path = path
+        self.day = meta["day"]
+        self.settings = Settings()
+        vars(self.settings).update(meta["settings"])
+        ids = arrays["topology/ids"].tolist()
+        self.topology = Topology(ids, *[arrays[f"topology/{name}"] for name in TOPOLOGY_ARRAYS])
+        self.static_df = pd.DataFrame(
+            {key.split("/", 1)[1]:values for key, values in arrays.items() if key.startswith("static/")},
+            index=pd.Index(ids)
+        )
+        self.static_df.attrs["topology"] = self.topology
+        self.state = SimulationState({column:arrays[f"state/{column}"] for column in DYNAMIC_COLUMNS})
+        self.rng_state = meta["rng_state"]
+        self.quiet_days = meta["quiet_days"]
+        self.elapsed = meta["elapsed"]
+        self.previous = arrays.get("stop/previous")
+        self.sink_types = meta["sinks"]
+        self.snapshots = [
+            {key.split("/", 1)[1]:values for key, values in arrays.items() if key.startswith(f"sink{i}/")}
+            for i in range(len(self.sink_types))
+        ]
+
+    def make_rng(self) -> np.random.Generator:
+        bit_generator = getattr(np.random, self.rng_state["bit_generator"])()
+        bit_generator.state = self.rng_state
+        return np.random.Generator(bit_generator)
+
+    def make_stop_criteria(self) -> simulate.StopCriteria:
+        stop_criteria = simulate.StopCriteria(self.settings)
+        stop_criteria.start_time -= self.elapsed
+        stop_criteria.quiet_days = self.quiet_days
+        stop_criteria.previous = self.previous
+        return stop_criteria
+
+    def restore_sinks(self, sinks:list) -> None:
+        if [type(sink).__name__ for sink in sinks] != self.sink_types:
+            raise ValueError(f"The checkpointed run used the sinks {self.sink_types}")
+        for sink, snapshot in zip(sinks, self.snapshots):
+            sink.restore(self.static_df, self.settings.simulation_length + 1, snapshot, self.day)
+
+    def resume(self, sinks:list|None = None, checkpointer:Checkpointer|None = None, verbose:bool = True, domain=None) -> Trajectory|None:
+        '''
+        Continues the run. sinks must be fresh instances of the sinks the run was started
+        with, in the same order; they are filled back up to the checkpointed day first.
+        Without sinks, a run that kept a Trajectory returns it, like simulate.run. A bounded
+        run keeps growing with a domain rebuilt from the checkpointed regions
+        (setup.get_domain(settings, filepaths, checkpoint.topology.ids)).
+        '''
+        data = None
+        if sinks is None:
+            if "Trajectory" not in self.sink_types:
+                raise ValueError(f"The checkpointed run used the sinks {self.sink_types}")
+            data = Trajectory()
+            data.restore(self.static_df, self.settings.simulation_length + 1, self.snapshots[self.sink_types.index("Trajectory")], self.day)
+            sinks = [data]
+        else:
+            self.restore_sinks(sinks)
+        simulate.continue_run(
+            self.topology,
+            self.state,
+            self.static_df,
+            self.settings,
+            sinks,
+            self.make_rng(),
+            self.make_stop_criteria(),
+            start_day=self.day,
+            resumed=True,
+            verbose=verbose,
+            checkpointer=checkpointer,
+            domain=domain
+        )
+        return data
+
+def load(path:str) -> Checkpoint:
+    return Checkpoint(path)
+
+def resume(path:str, sinks:list|None = None, checkpointer:Checkpointer|None = None, verbose:bool = True, domain=None) -> Trajectory|None:
+    '''
+    Continues a run from the checkpoint at path (see Checkpoint.resume)
+    '''
+    return load(path).resume(sinks, checkpointer, verbose, domain)
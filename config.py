@@ -2,10 +2,28 @@ import os
 
 class Settings:
     def __init__(self):
+        self.migration_rounding = "truncate" #Must be "truncate", "largest_remainder" or "stochastic"
+        self.random_seed = None #Seed for the "stochastic" migration rounding. None draws a fresh seed every run
+        self.active_frontier = True #Only step regions with zeds and their neighbors. Results are identical either way
+        self.stop_when_no_zeds = True
+        self.stop_when_no_humans = False
+        self.steady_state_tolerance = 0 #Stop when no population changes by more than this fraction for steady_state_days. 0 disables
+        self.steady_state_days = 7
+        self.wall_clock_budget = None #seconds
+        self.pad_stopped_runs = True #Repeat the final day of a stopped run up to simulation_length
+        self.time_stepping = "fixed" #Must be "fixed" or "adaptive"
+        self.step_tolerance = 0.001 #Relative population error allowed per adaptive step
+        self.max_time_step = 7 #days
+        self.conservation_check_interval = 1 #days between population conservation checks. 0 disables them
+        self.profile = False #Run main's simulation and visualization under cProfile
+        self.checkpoint_interval = 30 #days. 0 only saves a checkpoint when a run fails or is interrupted
+        self.schema_validation = "auto" #Must be "auto", "full", "structural" or "trusted". "auto" fully checks source files, structurally checks frames built from them and trusts validated caches
+        self.setup_cache = True #Save the cleaned setup frames and reuse them until the shapefile or population file changes
+        self.domain_hops = None #Only load and simulate the regions within this many borders of the zeds, growing as they spread. None simulates every region
         self.set_test_scenario()
 
     def set_test_scenario(self):
-        self.simulation_resolution = "state"
+        self.simulation_resolution = "state" #Must be "state", "county", "tract" or "mixed" (states split into counties as zeds reach them)
         self.outbreak_region = ["US"]
         self.outbreak_size = 1000 #Number of zeds to start with. Enter a number bewteen 0-1 to make the start a fraction of the existing population
         self.initial_escape_chance_h = 0.25
@@ -135,7 +153,14 @@ class Filepaths:
         self.population_directory = os.path.join(self.data_directory,"populations")  
         self.county_shapefile_filename = "counties_shapefile.shp"
         self.state_shapefile_filename = "states_shapefile.shp"
+        self.tract_shapefile_filename = "tracts_shapefile.shp"
         self.county_neighbors_filename = "counties_neighbors.json"
         self.state_neighbors_filename = "states_neighbors.json"
+        self.tract_neighbors_filename = "tracts_neighbors.json"
         self.county_populations_filename = os.path.join(self.population_directory,"county_populations.csv")
-        self.last_simulation_filename = os.path.join(self.data_directory,"last_simulation.sim")
+        self.tract_populations_filename = os.path.join(self.population_directory,"tract_populations.csv")
+        self.last_simulation_directory = os.path.join(self.data_directory,"last_simulation")
+        self.checkpoint_directory = os.path.join(self.data_directory,"checkpoints")
+        self.report_directory = os.path.join(self.data_directory,"reports")
+        self.setup_cache_directory = os.path.join(self.data_directory,"setup_cache")
+        self.benchmark_results_filename = os.path.join(self.data_directory,"benchmarks","results.jsonl")
@@ -1,6 +1,54 @@
+'''
+Table schemas and their validation (see clean_df).
+
+pandera takes about as long to import as pandas, and only "full" validation needs it, so
+the schemas are kept as plain column specs here and turned into pandera schemas on first
+use.
+'''
 import ast
+import functools
+import instrument
 import pandas as pd
-from pandera import Check, Column, DataFrameSchema, Index
+
+VALIDATION_LEVELS = ["full", "structural", "trusted"]
+VALIDATION_ERROR_MESSAGE = "schema validation must be 'auto', 'full', 'structural' or 'trusted'"
+
+class Column:
+    '''
+    The arguments of a pandera Column
+    '''
+    def __init__(self, dtype, coerce:bool = False, nullable:bool = False, required:bool = True, description:str|None = None):
+        self.dtype = dtype
+        self.coerce = coerce
+        self.nullable = nullable
+        self.required = required
+        self.description = description
+
+class DataFrameSchema:
+    '''
+    Columns by name. Calling the schema validates a frame with the equivalent pandera
+    DataFrameSchema, in which the record columns check their records.
+    '''
+    def __init__(self, columns:dict[str, Column]):
+        self.columns = columns
+
+    @functools.cached_property
+    def pandera(self):
+        import pandera
+        columns = {}
+        for key, column in self.columns.items():
+            checks = None
+            if key in RECORD_SCHEMAS:
+                checks = [pandera.Check(lambda x, key=key: validate_records(x, RECORD_SCHEMAS[key], nullable=True))]
+            columns[key] = pandera.Column(column.dtype, coerce=column.coerce, nullable=column.nullable,
+                                          required=column.required, checks=checks, description=column.description)
+        return pandera.DataFrameSchema(columns)
+
+    def __call__(self, df:pd.DataFrame, lazy:bool = False) -> pd.DataFrame:
+        return self.pandera(df, lazy=lazy)
+
+    def validate(self, df:pd.DataFrame) -> pd.DataFrame:
+        return self.pandera.validate(df)
 
 SimulationSchema = DataFrameSchema({
     "name": Column(str, coerce=True, nullable=False, required=False,
@@ -31,8 +79,7 @@ SimulationSchema = DataFrameSchema({
                     description="Land area of region (km^2)"),
     "border_area_z": Column(float, coerce=True, nullable=False, required=True,
                             description="Area close enough to border for zed migration (km^2)"),
-    "neighbors": Column(object, coerce=True, nullable=True, required=True,
-                        checks=[Check(lambda x: validate_record(x, NeighborSchema, nullable=True,), element_wise=True)],
+    "neighbors": Column(object, coerce=True, nullable=True, required=False,
                         description="List of neighboring regions")
 })
 
@@ -45,6 +92,9 @@ ShapeSchema = DataFrameSchema({
     "geometry": Column("geometry", coerce=True, nullable=False, required=True)    
 })
 
+#The shapefile attribute table, read without the polygons
+ShapeAttributeSchema = DataFrameSchema({key:column for key, column in ShapeSchema.columns.items() if key != "geometry"})
+
 NeighborSchema = DataFrameSchema({        
     "neighbor_id": Column(str, coerce=True, nullable=False, required=True),
     "neighbor_state_fp": Column(str, coerce=True, nullable=False, required=True),
@@ -58,8 +108,7 @@ GraphSchema = DataFrameSchema({
     "county_fp": Column(str, coerce=True, nullable=False, required=False),
     "name": Column(str, coerce=True, nullable=False, required=True),
     "border_length": Column(float, coerce=True, nullable=False, required=True),
-    "neighbors": Column(object, coerce=True, nullable=True, required=True,
-                        checks=[Check(lambda x: validate_record(x, NeighborSchema, nullable=True,), element_wise=True)])
+    "neighbors": Column(object, coerce=True, nullable=True, required=True)
 })
 
 PopulationSchema = DataFrameSchema( {
@@ -69,7 +118,20 @@ PopulationSchema = DataFrameSchema( {
     "county": Column(str, coerce=True, nullable=False, required=True)
 })
 
+#The state totals setup.consolidate_populations sums up from the county populations
+StatePopulationSchema = DataFrameSchema({
+    "NAME": Column(str, coerce=True, nullable=False, required=True),
+    "POP": Column(int, coerce=True, nullable=False, required=True),
+    "state": Column(str, coerce=True, nullable=False, required=True)
+})
+
+#Columns holding lists of records, and the schema of their records
+RECORD_SCHEMAS = {
+    "neighbors": NeighborSchema
+}
+
 def validate_record(record_list:list, record_schema:DataFrameSchema, nullable:bool = False) -> bool:
+    from pandera.errors import SchemaError
     records = pd.Series(record_list)
     try:
         if len(records) == 0 or all(pd.isnull(records)):
@@ -79,25 +141,132 @@ def validate_record(record_list:list, record_schema:DataFrameSchema, nullable:bo
         df = pd.DataFrame.from_records(records)
         record_schema.validate(df)
         return True
-    except:
+    except (SchemaError, AttributeError, KeyError, TypeError, ValueError):
         return False
 
+def validate_records(column:pd.Series, record_schema:DataFrameSchema, nullable:bool = False) -> pd.Series:
+    '''
+    validate_record for every row of column, but the records of all rows are validated
+    together in a single pass. Only if that fails is each row checked on its own, so
+    the result is the same as the element-wise check.
+    '''
+    from pandera.errors import SchemaError
+    ret = pd.Series(True, index=column.index)
+    batch = []
+    for i, record_list in enumerate(column):
+        if isinstance(record_list, list) and record_list and all(isinstance(record, dict) for record in record_list):
+            batch.extend(record_list)
+        else:
+            ret.iloc[i] = validate_record(record_list, record_schema, nullable)
+    if not batch:
+        return ret
+    try:
+        record_schema.validate(pd.DataFrame.from_records(batch))
+    except (SchemaError, TypeError, ValueError):
+        return pd.Series([validate_record(record_list, record_schema, nullable) for record_list in column], index=column.index)
+    return ret
+
 def safe_literal_eval(text:str) -> any:
     try:
         return ast.literal_eval(text)
-    except:
+    except (MemoryError, RecursionError, SyntaxError, TypeError, ValueError):
         return text
-        
-def clean_df(df:pd.DataFrame, schema:DataFrameSchema) -> pd.DataFrame:
+
+def pick_level(setting:str, auto:str) -> str:
+    '''
+    The validation level for an input: setting itself, or auto if setting is "auto"
+    '''
+    if setting == "auto":
+        return auto
+    if setting not in VALIDATION_LEVELS:
+        raise ValueError(VALIDATION_ERROR_MESSAGE)
+    return setting
+
+def check_columns(df:pd.DataFrame, schema:DataFrameSchema) -> list[str]:
+    '''
+    Vectorized required, null and dtype checks of every schema column of df. Columns are
+    coerced in place; the failures are returned.
+    '''
+    failures = []
+    for key, column in schema.columns.items():
+        if key not in df.columns:
+            if column.required:
+                failures.append(f"column '{key}' is missing")
+            continue
+        if not column.nullable and df[key].isna().any():
+            failures.append(f"column '{key}' has null values")
+            continue
+        if key in RECORD_SCHEMAS or column.dtype == "geometry":
+            continue
+        try:
+            df[key] = df[key].astype(column.dtype)
+        except (TypeError, ValueError) as e:
+            failures.append(f"column '{key}' can not be coerced to {getattr(column.dtype, '__name__', column.dtype)}: {e}")
+    return failures
+
+def check_record_column(column:pd.Series, record_schema:DataFrameSchema) -> list[str]:
+    '''
+    The failures of a record list column, with the records of every row checked as one
+    flattened table. Rows may be empty or null, like the nullable element-wise check.
+    '''
+    batch = []
+    for record_list in column:
+        if isinstance(record_list, list):
+            batch.extend(record for record in record_list if record is not None)
+        elif not pd.isnull(record_list):
+            return [f"column '{column.name}' holds {type(record_list).__name__} values instead of record lists"]
+    if not batch:
+        return []
+    if not all(isinstance(record, dict) for record in batch):
+        return [f"column '{column.name}' holds records that are not dicts"]
+    records = pd.DataFrame.from_records(batch)
+    return [f"{column.name}: {failure}" for failure in check_columns(records, record_schema)]
+
+def clean_df(df:pd.DataFrame, schema:DataFrameSchema, level:str = "full") -> pd.DataFrame:
+    '''
+    Validates df against schema at one of the VALIDATION_LEVELS and lists the checks that
+    ran in df.attrs["validation"].
+
+    "full" evaluates every string cell as a Python literal and runs the pandera schema,
+    with its element-wise record checks. "structural" only evaluates the cells of record
+    columns, coerces and null-checks the columns in bulk and checks all records as one
+    table; it is meant for frames this code built itself. "trusted" checks nothing, for
+    inputs read back from a cache that was validated when it was written.
+    '''
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(VALIDATION_ERROR_MESSAGE)
+    instrument.count(f"schema.{level}")
+    if level == "trusted":
+        df.attrs["validation"] = {"level":level, "checks":[]}
+        return df
     #Remove empty colums and rows
     df = df.loc[:, ~df.columns.str.contains("^Unnamed")]
     df = df.dropna(axis="index", how="all")
-    #Convert strings to the lists and/or boolean they are supposed to represent
-    for key in schema.columns:
-        if key not in df.columns:
-            continue
-        df[key] = df[key].apply(safe_literal_eval)
-    #Wierd things happen when trying to set a type of an empty column, so we drop them
-    df = df.dropna(axis="columns", how="all")
-    df = schema(df, lazy=True)    
-    return df
\ No newline at end of file
+    if level == "full":
+        checks = ["literal_eval", "pandera"]
+        #Convert strings to the lists and/or boolean they are supposed to represent
+        for key in schema.columns:
+            if key not in df.columns:
+                continue
+            df[key] = df[key].apply(safe_literal_eval)
+        #Wierd things happen when trying to set a type of an empty column, so we drop them
+        df = df.dropna(axis="columns", how="all")
+        df = schema(df, lazy=True)
+    else:
+        checks = ["columns", "nulls", "dtypes"]
+        record_keys = [key for key in RECORD_SCHEMAS if key in schema.columns and key in df.columns]
+        for key in record_keys:
+            if df[key].map(lambda value: isinstance(value, str)).any():
+                df[key] = df[key].map(lambda value: safe_literal_eval(value) if isinstance(value, str) else value)
+        df = df.dropna(axis="columns", how="all")
+        df = df.copy()
+        failures = check_columns(df, schema)
+        for key in record_keys:
+            if key in df.columns:
+                checks.append(f"{key}_records")
+                failures += check_record_column(df[key], RECORD_SCHEMAS[key])
+        if failures:
+            from pandera.errors import SchemaError
+            raise SchemaError(schema.pandera, df, "; ".join(failures))
+    df.attrs["validation"] = {"level":level, "checks":checks}
+    return df
@@ -0,0 +1,126 @@
+'''
+Bounded simulation domains for localized outbreaks (settings.domain_hops).
+
+A bounded run only loads and simulates the outbreak regions and every region within
+domain_hops borders of them. When zeds come within one border of the domain's edge, the
+regions within domain_hops of the zeds are loaded and attached, and the run carries on.
+Regions are attached before any zeds can reach them, so they still hold their day-0
+values and every day matches a run over the whole map, restricted to the domain.
+'''
+from config import Settings
+import copy
+import instrument
+import numpy as np
+import pandas as pd
+import simulate
+from state import DYNAMIC_COLUMNS, SimulationState, static_frame
+from topology import Topology
+
+class Domain:
+    '''
+    graph lists the neighbors of every region on the map. load(ids) returns the
+    (attribute_df, neighbors_df, population_df) rows of the given regions, indexed by id,
+    with their neighbor lists still reaching outside the domain.
+    '''
+    def __init__(self, graph:dict[str, list[str]], load, settings:Settings, region_ids:list[str]|None = None):
+        if settings.domain_hops < 2:
+            raise ValueError("domain_hops must be at least 2")
+        self.graph = graph
+        self.load = load
+        self.settings = settings
+        self.ids = []
+        self.members = set()
+        self.attribute_df = None
+        self.neighbors_df = None
+        self.population_df = None
+        if region_ids is None:
+            region_ids = self.halo(self.outbreak_regions())
+        with instrument.timer("setup.domain"):
+            self.attach(region_ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def outbreak_regions(self) -> list[str]:
+        regions = self.settings.outbreak_region
+        if any(region.lower() == "us" for region in regions):
+            return list(self.graph)
+        # Unknown regions are reported by simulate.outbreak
+        return [region for region in regions if region in self.graph]
+
+    def halo(self, regions:list[str]) -> list[str]:
+        '''
+        Every region within domain_hops borders of regions, in neighbor file order
+        '''
+        reached = set(regions)
+        ring = list(reached)
+        for _ in range(self.settings.domain_hops):
+            ring = [neighbor for region in ring for neighbor in self.graph[region] if neighbor not in reached]
+            reached.update(ring)
+        return [region for region in self.graph if region in reached]
+
+    def attach(self, region_ids:list[str]) -> None:
+        region_ids = [region_id for region_id in region_ids if region_id not in self.members]
+        attribute_df, neighbors_df, population_df = self.load(region_ids)
+        attribute_df = attribute_df.loc[region_ids]
+        neighbors_df = neighbors_df.loc[region_ids]
+        if self.attribute_df is None:
+            self.attribute_df, self.neighbors_df, self.population_df = attribute_df, neighbors_df, population_df
+        else:
+            self.attribute_df = pd.concat([self.attribute_df, attribute_df])
+            self.neighbors_df = pd.concat([self.neighbors_df, neighbors_df])
+            self.population_df = pd.concat([self.population_df, population_df])
+        self.ids += region_ids
+        self.members.update(region_ids)
+        # Regions with a neighbor outside the domain are missing borders
+        self.boundary = np.array([any(neighbor not in self.members for neighbor in self.graph[region_id]) for region_id in self.ids])
+        instrument.count("setup.domain_regions", len(region_ids))
+
+    def data(self) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        '''
+        The (attribute_df, neighbors_df, population_df) of the domain for simulate.initialize,
+        with the neighbor lists cut down to the domain
+        '''
+        neighbors_df = self.neighbors_df.copy()
+        neighbors_df["neighbors"] = [
+            [neighbor for neighbor in neighbors if neighbor["neighbor_id"] in self.members]
+            for neighbors in neighbors_df["neighbors"]
+        ]
+        return (self.attribute_df, neighbors_df, self.population_df)
+
+    def needs_growth(self, topology:Topology, state:SimulationState) -> bool:
+        '''
+        True once zeds are on or next to a region whose borders run out of the domain
+        '''
+        return bool((topology.active_regions(state.population_z > 0) & self.boundary).any())
+
+    def grow(self, topology:Topology, state:SimulationState, static_df:pd.DataFrame) -> tuple[Topology, SimulationState, pd.DataFrame]:
+        '''
+        Attaches every region within domain_hops of the zeds and returns the topology,
+        state and static frame of the grown domain. The regions already simulated keep
+        their positions and values; the new ones are appended with their day-0 values.
+        '''
+        with instrument.timer("simulate.grow_domain"):
+            zeds = [topology.ids[i] for i in np.flatnonzero(state.population_z > 0)]
+            count = len(self.ids)
+            self.attach(self.halo(zeds))
+            attribute_df, neighbors_df, population_df = self.data()
+            # Only the new regions are initialized; none of them can hold part of the outbreak
+            new_ids = self.ids[count:]
+            new_members = set(new_ids)
+            new_neighbors_df = neighbors_df.loc[new_ids].copy()
+            new_neighbors_df["neighbors"] = [
+                [neighbor for neighbor in neighbors if neighbor["neighbor_id"] in new_members]
+                for neighbors in new_neighbors_df["neighbors"]
+            ]
+            quiet_settings = copy.copy(self.settings)
+            quiet_settings.outbreak_region = []
+            new_df = simulate.initialize(attribute_df.loc[new_ids], new_neighbors_df, population_df.loc[new_ids], quiet_settings)
+            grown_df = pd.concat([static_df, static_frame(new_df)])
+            grown_df["neighbors"] = neighbors_df["neighbors"]
+            grown_df.attrs = {"topology":Topology.from_frame(grown_df)}
+            grown = SimulationState({
+                column:np.concatenate((getattr(state, column), new_df[column].to_numpy()))
+                for column in DYNAMIC_COLUMNS
+            })
+        return (grown_df.attrs["topology"], grown, grown_df)
@@ -0,0 +1,130 @@
+'''
+Runs many parameter variations of one region set in a single vectorized simulation.
+
+Every state array carries a leading scenario axis ([scenarios x regions]) while the
+topology is shared, so one call of the time-step kernel advances all scenarios together.
+'''
+from config import Settings
+import copy
+import instrument
+import numpy as np
+import pandas as pd
+import simulate
+from sinks import summary_frame
+from state import DYNAMIC_COLUMNS, POPULATION_COLUMNS, SimulationState
+from topology import Topology
+
+def sweep(settings:Settings, attribute:str, values:list) -> list[Settings]:
+    '''
+    Copies of settings that only differ in one attribute
+    '''
+    settings_list = []
+    for value in values:
+        variation = copy.deepcopy(settings)
+        setattr(variation, attribute, value)
+        settings_list.append(variation)
+    return settings_list
+
+def check_compatible(settings_list:list[Settings]) -> None:
+    if not settings_list:
+        raise ValueError("An ensemble needs at least one scenario")
+    if len({settings.simulation_length for settings in settings_list}) > 1:
+        raise ValueError("All scenarios must use the same simulation_length")
+    if any(settings.time_stepping != "fixed" for settings in settings_list):
+        raise ValueError("The batched ensemble only steps whole days; use parallel.run_jobs for adaptive runs")
+    if any(settings.simulation_resolution.lower() == "mixed" for settings in settings_list):
+        raise ValueError("The batched ensemble steps a fixed region graph; use parallel.run_jobs for mixed resolution runs")
+
+def get_kernel_parameters(topology:Topology, settings_list:list[Settings]) -> simulate.KernelParameters:
+    params = simulate.KernelParameters.stack(settings_list)
+    params.border_area_z = np.stack([
+        np.minimum(topology.border_length * simulate.get_zed_travel_distance(settings), topology.area)
+        for settings in settings_list
+    ])
+    return params
+
+def initial_state(initial_df:pd.DataFrame, settings_list:list[Settings]) -> SimulationState:
+    '''
+    Stacks the day-0 populations of every scenario. Only the outbreak differs between them.
+    '''
+    states = [simulate.initial_state(initial_df["population_h"], settings) for settings in settings_list]
+    return SimulationState({column:np.stack([getattr(state, column) for state in states]) for column in DYNAMIC_COLUMNS})
+
+def population_totals(state:SimulationState) -> np.ndarray:
+    return sum(getattr(state, column).sum(axis=-1) for column in POPULATION_COLUMNS)
+
+def scenario_state(state:SimulationState, scenario:int) -> SimulationState:
+    return SimulationState({column:getattr(state, column)[scenario] for column in DYNAMIC_COLUMNS})
+
+def check_conservation(
+        state:SimulationState,
+        intial_population:np.ndarray,
+        day:int,
+        settings_list:list[Settings],
+        running:np.ndarray
+    ) -> None:
+    '''
+    Raises if the total population of a running scenario has drifted, on the days its
+    conservation_check_interval asks for (see simulate.check_conservation)
+    '''
+    intervals = np.array([settings.conservation_check_interval for settings in settings_list])
+    due = running & (intervals > 0) & (day % np.maximum(intervals, 1) == 0)
+    if not due.any():
+        return
+    with instrument.timer("simulate.conservation_check"):
+        totals = population_totals(state)
+    changed = np.flatnonzero(due & (totals != intial_population))
+    if len(changed):
+        raise RuntimeError(f"Population of scenario {changed[0]} has changed by {totals[changed[0]] - intial_population[changed[0]]}")
+
+def run(initial_df:pd.DataFrame, settings_list:list[Settings]) -> list[pd.DataFrame]:
+    '''
+    Simulates every scenario and returns one simulate.summarize-style frame per scenario,
+    with its simulate.STOP_* reason in attrs["stop_reason"]. initial_df comes from
+    simulate.initialize with any of the scenarios' settings.
+
+    Like simulate.run, every scenario stops on its own StopCriteria, is padded up to
+    simulation_length if its pad_stopped_runs says so, and has its population checked every
+    conservation_check_interval days. The batch is stepped until the last scenario stops.
+    '''
+    check_compatible(settings_list)
+    simulation_length = settings_list[0].simulation_length
+    topology = simulate.get_topology(initial_df)
+    params = get_kernel_parameters(topology, settings_list)
+    rng = simulate.make_rng(settings_list[0])
+    state = initial_state(initial_df, settings_list)
+    simulate.derive_initial_state(state, topology, params, rng)
+    intial_population = population_totals(state)
+    stop_criteria = [simulate.StopCriteria(settings) for settings in settings_list]
+    stop_reasons = [simulate.STOP_COMPLETED] * len(settings_list)
+    last_days = [simulation_length] * len(settings_list)
+    running = np.ones(len(settings_list), dtype=bool)
+    totals_h = []
+    totals_z = []
+    for day in range(simulation_length + 1):
+        if day > 0:
+            if (day - 1) % 5 == 0:
+                print(f"Day {day - 1} of ensemble simulation.")
+            simulate.advance_state(state, topology, params, rng)
+            check_conservation(state, intial_population, day, settings_list, running)
+        totals_h.append(state.population_h.sum(axis=-1))
+        totals_z.append(state.population_z.sum(axis=-1))
+        for i in np.flatnonzero(running):
+            reason = stop_criteria[i].check(day, scenario_state(state, i))
+            if reason is not None and day < simulation_length:
+                running[i] = False
+                stop_reasons[i] = reason
+                last_days[i] = day
+        if not running.any():
+            break
+    totals_h = np.array(totals_h)
+    totals_z = np.array(totals_z)
+    summaries = []
+    for i, settings in enumerate(settings_list):
+        # Repeat the final day so every scenario still has simulation_length days
+        days = np.arange(simulation_length + 1 if settings.pad_stopped_runs else last_days[i] + 1)
+        rows = np.minimum(days, last_days[i])
+        summary = summary_frame(totals_h[rows, i], totals_z[rows, i])
+        summary.attrs["stop_reason"] = stop_reasons[i]
+        summaries.append(summary)
+    return summaries
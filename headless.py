@@ -0,0 +1,95 @@
+'''
+Headless runs: simulation and reporting without plots.
+
+Nothing here imports matplotlib, and the setup inputs are read as attribute tables
+from the setup caches (see setup_cache.read_attribute_inputs) when they are current, so a
+warm start does not import geopandas, fiona, pygris, requests or pandera either. setup is
+only imported when a cache is missing or stale, or for bounded runs, and then fills the
+caches for the next start.
+
+    python headless.py --scenario 2
+    python headless.py --resume
+'''
+import argparse
+import checkpoint
+from config import Filepaths, Settings
+import instrument
+from pandas import DataFrame
+import setup_cache
+import simulate
+from sinks import get_sinks
+
+SCENARIOS = {
+    "0":Settings.set_test_scenario,
+    "1":Settings.set_scenario1,
+    "2":Settings.set_scenario2,
+    "3":Settings.set_scenario3
+}
+
+def load_inputs(settings:Settings, filepaths:Filepaths) -> tuple[DataFrame, DataFrame, DataFrame]:
+    inputs = setup_cache.read_attribute_inputs(settings, filepaths)
+    if inputs is None:
+        import setup
+        inputs = setup.get_inputs(settings, filepaths)
+    return inputs
+
+def report(settings:Settings, sinks:list) -> DataFrame:
+    summary_sink, keyframe_sink, _ = sinks
+    simulation_summary = simulate.summarize(summary_sink)
+    print(f"Simulation result: {summary_sink.stop_reason}")
+    simulate.print_report(settings, keyframe_sink, simulation_summary)
+    return simulation_summary
+
+def run_simulation(settings:Settings, filepaths:Filepaths) -> DataFrame:
+    '''
+    Simulates settings and returns the summary. The days are written to the last
+    simulation directory, like the interactive runs.
+    '''
+    domain = None
+    with instrument.timer("setup.main"):
+        if settings.domain_hops is None:
+            attribute_df, border_df, population_df = load_inputs(settings, filepaths)
+        else:
+            import setup
+            domain = setup.get_domain(settings, filepaths)
+            attribute_df, border_df, population_df = domain.data()
+    initial_df = simulate.initialize(attribute_df, border_df, population_df, settings)
+    sinks = get_sinks(settings, filepaths)
+    checkpointer = checkpoint.Checkpointer(filepaths.checkpoint_directory, settings.checkpoint_interval)
+    with instrument.timer("simulate.run"):
+        simulate.run(initial_df, settings, sinks, checkpointer, domain)
+    return report(settings, sinks)
+
+def resume_simulation(filepaths:Filepaths) -> DataFrame:
+    path = checkpoint.latest(filepaths.checkpoint_directory)
+    if path is None:
+        raise FileNotFoundError("There is no checkpoint to resume from.")
+    saved = checkpoint.load(path)
+    settings = saved.settings
+    print(f"Resuming from day {saved.day} of {settings.simulation_length}")
+    domain = None
+    if settings.domain_hops is not None:
+        import setup
+        with instrument.timer("setup.main"):
+            domain = setup.get_domain(settings, filepaths, saved.topology.ids)
+    sinks = get_sinks(settings, filepaths)
+    checkpointer = checkpoint.Checkpointer(filepaths.checkpoint_directory, settings.checkpoint_interval)
+    with instrument.timer("simulate.run"):
+        saved.resume(sinks, checkpointer, domain=domain)
+    return report(settings, sinks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a scenario without visualizing it")
+    parser.add_argument("--scenario", default="0", choices=list(SCENARIOS))
+    parser.add_argument("--resume", action="store_true", help="continue the latest checkpoint instead")
+    parser.add_argument("--timings", action="store_true", help="print the timing report")
+    args = parser.parse_args()
+    with instrument.recording() as recorder:
+        if args.resume:
+            resume_simulation(Filepaths())
+        else:
+            my_settings = Settings()
+            SCENARIOS[args.scenario](my_settings)
+            run_simulation(my_settings, Filepaths())
+    if args.timings:
+        recorder.print_report()
@@ -0,0 +1,119 @@
+'''
+Mixed state/county region graphs for simulation_resolution == "mixed".
+
+Counties are grouped by their state (the first two digits of a county id). A state is
+simulated as a single node until zeds arrive in it or border it, and is then split into
+its counties. Nodes are laid out as the remaining state nodes followed by the counties of
+the refined states, in county order, and the borders between them are the county borders
+summed per pair of nodes.
+
+A state node never has zeds on it or next to it, so nothing happens there: bites, kills
+and migration all need zeds. Its counties therefore still hold their last values when the
+state is refined, which is exactly their share of the state's populations.
+'''
+import numpy as np
+from state import DYNAMIC_COLUMNS, POPULATION_COLUMNS, SimulationState
+from topology import Topology
+
+EXTENSIVE_COLUMNS = POPULATION_COLUMNS + ["encounters", "bit_h", "killed_z", "migration_z"]
+
+def get_state_fp(region_id:str) -> str:
+    return region_id[:2]
+
+class Hierarchy:
+    '''
+    The current mixed-level graph over a county Topology, in self.topology
+    '''
+    def __init__(self, counties:Topology, distance_z:float):
+        self.counties = counties
+        self.state_ids, self.county_state = np.unique([get_state_fp(region_id) for region_id in counties.ids], return_inverse=True)
+        self.county_state = self.county_state.astype(np.int64)
+        state_count = len(self.state_ids)
+        self.refined = np.zeros(state_count, dtype=bool)
+        # Summing the county perimeters counts every border inside a state once from each side
+        internal = self.county_state[counties.src] == self.county_state[counties.dst]
+        internal_length = np.bincount(self.county_state[counties.src[internal]], weights=counties.shared_border_length[internal], minlength=state_count)
+        self.state_area = np.bincount(self.county_state, weights=counties.area, minlength=state_count)
+        self.state_border_length = np.bincount(self.county_state, weights=counties.border_length, minlength=state_count) - internal_length
+        self.state_border_area_z = np.minimum(self.state_border_length * distance_z, self.state_area)
+        self.build()
+
+    def __len__(self) -> int:
+        return len(self.topology)
+
+    def build(self) -> None:
+        counties = self.counties
+        self.coarse_states = np.flatnonzero(~self.refined)
+        self.county_positions = np.flatnonzero(self.refined[self.county_state])
+        coarse_count = len(self.coarse_states)
+        n = coarse_count + len(self.county_positions)
+        state_node = np.full(len(self.state_ids), -1, dtype=np.int64)
+        state_node[self.coarse_states] = np.arange(coarse_count)
+        self.node = state_node[self.county_state]
+        self.node[self.county_positions] = coarse_count + np.arange(len(self.county_positions))
+        # Borders inside a state node disappear and parallel borders between two nodes merge.
+        # Within each node the surviving borders keep the county order.
+        src = self.node[counties.src]
+        dst = self.node[counties.dst]
+        crossing = src != dst
+        keys, first, inverse = np.unique(src[crossing] * n + dst[crossing], return_index=True, return_inverse=True)
+        shared_border_length = np.bincount(inverse, weights=counties.shared_border_length[crossing], minlength=len(keys))
+        order = np.lexsort((first, keys // n))
+        keys = keys[order]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(keys // n, minlength=n), dtype=np.int64)))
+        self.topology = Topology(
+            [self.state_ids[state] for state in self.coarse_states] + [counties.ids[county] for county in self.county_positions],
+            np.concatenate((self.state_area[self.coarse_states], counties.area[self.county_positions])),
+            np.concatenate((self.state_border_length[self.coarse_states], counties.border_length[self.county_positions])),
+            np.concatenate((self.state_border_area_z[self.coarse_states], counties.border_area_z[self.county_positions])),
+            indptr,
+            keys % n,
+            shared_border_length[order]
+        )
+
+    def states_to_refine(self, has_zeds:np.ndarray) -> np.ndarray:
+        '''
+        State nodes with zeds on them or on a neighboring node
+        '''
+        active = self.topology.active_regions(has_zeds)
+        return self.coarse_states[active[:len(self.coarse_states)]]
+
+    def refine(self, states:np.ndarray) -> None:
+        self.refined[states] = True
+        self.build()
+
+    def refine_around(self, county_state:SimulationState) -> None:
+        '''
+        Refines every state with zeds in or next to one of its counties
+        '''
+        active = self.counties.active_regions(county_state.population_z > 0)
+        self.refine(np.unique(self.county_state[active]))
+
+    def gather(self, county_state:SimulationState) -> SimulationState:
+        '''
+        The node values of a county-level state. State nodes hold the sums of their
+        counties, and human-weighted means of the per-person columns.
+        '''
+        coarse_count = len(self.coarse_states)
+        n = len(self)
+        arrays = {}
+        weights = county_state.population_h.astype(float)
+        totals = np.bincount(self.node, weights=weights, minlength=n)[:coarse_count]
+        for column in DYNAMIC_COLUMNS:
+            values = getattr(county_state, column)
+            if column in EXTENSIVE_COLUMNS:
+                coarse = np.bincount(self.node, weights=values, minlength=n)[:coarse_count]
+            else:
+                coarse = np.bincount(self.node, weights=values * weights, minlength=n)[:coarse_count]
+                coarse = np.divide(coarse, totals, out=np.zeros(coarse_count), where=totals > 0)
+            arrays[column] = np.concatenate((coarse, values[self.county_positions]))
+        return SimulationState(arrays)
+
+    def scatter(self, node_state:SimulationState, county_state:SimulationState) -> None:
+        '''
+        Writes the county nodes back into the county-level state. The counties of state
+        nodes keep their values.
+        '''
+        coarse_count = len(self.coarse_states)
+        for column in DYNAMIC_COLUMNS:
+            getattr(county_state, column)[self.county_positions] = getattr(node_state, column)[coarse_count:]
@@ -0,0 +1,142 @@
+'''
+Phase timers and counters for setup, simulate and visualize.
+
+Code marks its phases with `with instrument.timer("simulate.migration"):` and bumps
+counters with instrument.count(). Nothing is kept unless a Recorder is active (see
+recording()), so the marks cost a function call when instrumentation is off.
+'''
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import pstats
+import time
+
+class Timing:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.shortest = float("inf")
+        self.longest = 0.0
+
+    def add(self, seconds:float) -> None:
+        self.calls += 1
+        self.total += seconds
+        self.shortest = min(self.shortest, seconds)
+        self.longest = max(self.longest, seconds)
+
+class Recorder:
+    '''
+    Accumulates the time spent in each named phase and the value of each counter
+    '''
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+        self.metadata = {}
+
+    @contextlib.contextmanager
+    def timer(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.setdefault(name, Timing()).add(time.perf_counter() - start)
+
+    def count(self, name:str, n:int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def rows(self) -> list[dict]:
+        return [
+            {
+                "phase":name,
+                "calls":timing.calls,
+                "total_s":timing.total,
+                "mean_s":timing.total / timing.calls,
+                "min_s":timing.shortest,
+                "max_s":timing.longest
+            }
+            for name, timing in self.timings.items()
+        ]
+
+    def report(self) -> dict:
+        return {"metadata":self.metadata, "timings":self.rows(), "counts":dict(self.counts)}
+
+    def write_report(self, filename:str) -> None:
+        '''
+        Writes the report as JSON, or as one CSV row per phase and counter if filename
+        ends in .csv
+        '''
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if filename.lower().endswith(".csv"):
+            with open(filename, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=["phase", "calls", "total_s", "mean_s", "min_s", "max_s"])
+                writer.writeheader()
+                writer.writerows(self.rows())
+                for name, value in self.counts.items():
+                    writer.writerow({"phase":name, "calls":value})
+        else:
+            with open(filename, "w") as f:
+                json.dump(self.report(), f, indent=4)
+
+    def print_report(self) -> None:
+        for row in sorted(self.rows(), key=lambda row: -row["total_s"]):
+            print(f"{row['phase']:<32}{row['calls']:>8} calls{row['total_s']:>10.3f} s")
+        for name, value in self.counts.items():
+            print(f"{name:<32}{value:>8}")
+
+class NullRecorder:
+    '''
+    Stands in while nothing is being recorded
+    '''
+    def timer(self, name:str) -> contextlib.nullcontext:
+        return NULL_CONTEXT
+
+    def count(self, name:str, n:int = 1) -> None:
+        pass
+
+NULL_CONTEXT = contextlib.nullcontext()
+ACTIVE = NullRecorder()
+
+def timer(name:str):
+    return ACTIVE.timer(name)
+
+def count(name:str, n:int = 1) -> None:
+    ACTIVE.count(name, n)
+
+@contextlib.contextmanager
+def recording(recorder:Recorder|None = None):
+    '''
+    Makes recorder (a new one by default) the target of every timer and counter inside the
+    block, and yields it
+    '''
+    global ACTIVE
+    recorder = recorder if recorder is not None else Recorder()
+    previous = ACTIVE
+    ACTIVE = recorder
+    try:
+        yield recorder
+    finally:
+        ACTIVE = previous
+
+@contextlib.contextmanager
+def profiling(filename:str|None = None, top:int = 25):
+    '''
+    Runs the block under cProfile. The stats are dumped to filename (open them with
+    pstats or snakeviz) or, without one, the top entries by cumulative time are printed.
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if filename is None:
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+        else:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(filename)
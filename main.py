@@ -1,13 +1,19 @@
+import checkpoint
 from config import Filepaths, Settings
+import contextlib
+from datetime import datetime
 from geopandas import GeoDataFrame
+import instrument
+import os
 from pandas import DataFrame
-import pickle
 import setup
 import simulate
+from sinks import KeyframeSink, get_sinks
+from typing import Callable
 import visualize as viz
 
-NO_SIM_MESSAGE_REPORT = "Error: Unable to report without simulating first."
 NO_SIM_MESSAGE_VIZ = "Error: Unable to visualize without simulating first. Please run 'sim' or 'load' before calling 'viz'"
+NO_CHECKPOINT_MESSAGE = "Error: There is no checkpoint to resume from."
 
 def display_menu():
   print("Available Options:")
@@ -15,46 +21,101 @@ def display_menu():
   print("1. Night of the Living Dead (1968)")
   print("2. Dawn of the Dead (2004)")
   print("3. The Walking Dead (2010)")
+  print("R. Resume the last run")
+  print("C. Reload the data files")
   print("Q. Quit")
 
-def run_simulation(settings:Settings, filepaths:Filepaths) -> tuple[GeoDataFrame, list[DataFrame], DataFrame]:
-    shape_gdf, border_df, population_df = setup.main(settings, filepaths)
-    initial_df = simulate.initialize(shape_gdf, border_df, population_df, settings)    
-    simulation_data = simulate.run(initial_df, settings)
-    simulation_summary = simulate.summarize(simulation_data)
-    pickle.dump(simulation_data, open(filepaths.last_simulation_filename, 'wb'))
-    print_report(settings, simulation_data, simulation_summary)
-    return shape_gdf, simulation_data, simulation_summary
+def get_setup(settings:Settings, filepaths:Filepaths, session:setup.SessionCache|None = None) -> tuple[DataFrame, DataFrame, DataFrame]:
+    if session is None:
+        return setup.get_inputs(settings, filepaths)
+    return session.inputs(settings, filepaths)
+
+def get_shapes_loader(settings:Settings, filepaths:Filepaths, session:setup.SessionCache|None = None, domain=None) -> Callable[[], GeoDataFrame]:
+    '''
+    A function returning the polygons of the run, so they are only read if it is plotted
+    '''
+    if domain is not None:
+        return lambda: setup.get_shapes(settings, filepaths, domain.ids)
+    if session is None:
+        return lambda: setup.get_shapes(settings, filepaths)
+    return lambda: session.shapes(settings, filepaths)
+
+def run_simulation(settings:Settings, filepaths:Filepaths, session:setup.SessionCache|None = None) -> tuple[Callable[[], GeoDataFrame], KeyframeSink, DataFrame]:
+    domain = None
+    with instrument.timer("setup.main"):
+        if settings.domain_hops is None:
+            attribute_df, border_df, population_df = get_setup(settings, filepaths, session)
+        else:
+            domain = setup.get_domain(settings, filepaths)
+            attribute_df, border_df, population_df = domain.data()
+    initial_df = simulate.initialize(attribute_df, border_df, population_df, settings)    
+    summary_sink, keyframe_sink, columnar_sink = get_sinks(settings, filepaths)
+    checkpointer = checkpoint.Checkpointer(filepaths.checkpoint_directory, settings.checkpoint_interval)
+    with instrument.timer("simulate.run"):
+        simulate.run(initial_df, settings, [summary_sink, keyframe_sink, columnar_sink], checkpointer, domain)
+    simulation_summary = simulate.summarize(summary_sink)
+    print(f"Simulation result: {summary_sink.stop_reason}")
+    simulate.print_report(settings, keyframe_sink, simulation_summary)
+    return get_shapes_loader(settings, filepaths, session, domain), keyframe_sink, simulation_summary
+
+def resume_simulation(filepaths:Filepaths, session:setup.SessionCache|None = None) -> tuple[Settings, Callable[[], GeoDataFrame], KeyframeSink, DataFrame]:
+    path = checkpoint.latest(filepaths.checkpoint_directory)
+    if path is None:
+        raise FileNotFoundError(NO_CHECKPOINT_MESSAGE)
+    saved = checkpoint.load(path)
+    settings = saved.settings
+    print(f"Resuming from day {saved.day} of {settings.simulation_length}")
+    domain = None
+    if settings.domain_hops is not None:
+        with instrument.timer("setup.main"):
+            domain = setup.get_domain(settings, filepaths, saved.topology.ids)
+    summary_sink, keyframe_sink, columnar_sink = get_sinks(settings, filepaths)
+    checkpointer = checkpoint.Checkpointer(filepaths.checkpoint_directory, settings.checkpoint_interval)
+    with instrument.timer("simulate.run"):
+        saved.resume([summary_sink, keyframe_sink, columnar_sink], checkpointer, domain=domain)
+    simulation_summary = simulate.summarize(summary_sink)
+    print(f"Simulation result: {summary_sink.stop_reason}")
+    simulate.print_report(settings, keyframe_sink, simulation_summary)
+    return settings, get_shapes_loader(settings, filepaths, session, domain), keyframe_sink, simulation_summary
 
 def run_visualization(
         settings:Settings,
         filepaths:Filepaths,
-        shape_gdf:GeoDataFrame,
-        simulation_data:list[DataFrame],
-        simulation_summary:DataFrame) -> None:
+        shapes:GeoDataFrame|Callable[[], GeoDataFrame],
+        simulation_data:KeyframeSink,
+        simulation_summary:DataFrame,
+        session:setup.SessionCache|None = None) -> None:
     if not simulation_data:
         print(NO_SIM_MESSAGE_VIZ)
         return
-    plot_data = viz.generate_geo_plot_data(simulation_data, shape_gdf, settings)
-    state_borders = setup.get_states_shapefile(filepaths)
+    plot_data = viz.generate_geo_plot_data(simulation_data, shapes, settings)
+    state_borders = setup.get_states_shapefile(filepaths) if session is None else session.state_borders(filepaths)
     if settings.show_image:
         viz.show_frame(plot_data, state_borders, simulation_summary, settings)
     if settings.make_animation:
         mov = viz.make_animation(plot_data, state_borders, simulation_summary, settings)
         viz.save_animation(mov, settings)
 
-def print_report(settings, simulation_data, simulation_summary) -> None:
-    if not simulation_data or type(simulation_summary) is not DataFrame:
-        print(NO_SIM_MESSAGE_REPORT)
-        return
-    print(f"Initial population: {round(pow(10,simulation_summary.at[0,'population_h_log10'])):,d}")
-    print(f"Final population: {round(pow(10,simulation_summary.at[settings.simulation_length,'population_h_log10'])):,d}")
-    print(f"Maximum zed population: {round(max([sum(df['population_z']) for df in simulation_data])):,d}")
+def write_run_report(recorder:instrument.Recorder, settings:Settings, filepaths:Filepaths, run_name:str) -> None:
+    recorder.metadata = {
+        "run":run_name,
+        "scenario":settings.plot_title,
+        "resolution":settings.simulation_resolution,
+        "simulation_length":settings.simulation_length,
+        "time_stepping":settings.time_stepping
+    }
+    filename = os.path.join(filepaths.report_directory, f"run_{run_name}")
+    recorder.write_report(filename + ".json")
+    recorder.write_report(filename + ".csv")
+    print(f"Wrote timing report to {filename}.json")
 
 def main(settings:Settings, filepaths:Filepaths):
+    # Setup outputs are kept between runs until the data files are reloaded
+    session = setup.SessionCache()
     while True:
         display_menu()
         choice = input("Choose scenario: ")
+        resume = False
         if choice == '0':
             settings.set_test_scenario()
         elif choice == '1':
@@ -63,14 +124,27 @@ def main(settings:Settings, filepaths:Filepaths):
             settings.set_scenario2()
         elif choice == '3':
             settings.set_scenario3()
+        elif choice.lower() == 'r':
+            resume = True
+        elif choice.lower() == 'c':
+            session.clear()
+            print("The data files will be read again on the next run.")
+            continue
         elif choice.lower() == 'q':
             break
         else:
             print("Invalid choice. Please try again.")
         try:
-            shape_gdf, simulation_data, simulation_summary = run_simulation(settings, filepaths)
-            run_visualization(settings, filepaths, shape_gdf, simulation_data, simulation_summary)
-            print_report(settings, simulation_data, simulation_summary)
+            run_name = datetime.now().strftime("%Y%m%d-%H%M%S")
+            profiler = instrument.profiling(os.path.join(filepaths.report_directory, f"run_{run_name}.prof")) if settings.profile else contextlib.nullcontext()
+            with instrument.recording() as recorder, profiler:
+                if resume:
+                    settings, shapes, simulation_data, simulation_summary = resume_simulation(filepaths, session)
+                else:
+                    shapes, simulation_data, simulation_summary = run_simulation(settings, filepaths, session)
+                run_visualization(settings, filepaths, shapes, simulation_data, simulation_summary, session)
+            simulate.print_report(settings, simulation_data, simulation_summary)
+            write_run_report(recorder, settings, filepaths, run_name)
         except Exception as ex:
             print(ex)
 
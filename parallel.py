@@ -0,0 +1,130 @@
+'''
+Spreads independent simulation jobs over a process pool.
+
+The region set is loaded once in the parent. Its static arrays (region ids, areas, border
+lengths, the CSR neighbor graph and the census populations) are published through
+multiprocessing.shared_memory, so workers neither re-read shapefiles nor unpickle
+GeoDataFrames. Each job only ships its Settings and returns a compact summary.
+'''
+from config import Filepaths, Settings
+from multiprocessing import Pool, shared_memory
+import numpy as np
+import pandas as pd
+import setup
+import simulate
+from sinks import SummarySink
+from state import Trajectory
+from topology import Topology
+
+WORKER_ARRAYS = {}
+WORKER_BLOCKS = []
+
+class SharedArrays:
+    '''
+    Copies arrays into named shared-memory blocks. Use as a context manager so the blocks
+    are unlinked once the pool is done.
+    '''
+    def __init__(self, arrays:dict[str, np.ndarray]):
+        self.blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+class JobResult:
+    def __init__(self, settings:Settings, summary:pd.DataFrame, trajectory:Trajectory|None = None):
+        self.settings = settings
+        self.summary = summary
+        self.trajectory = trajectory
+
+def attach(specs:dict[str, tuple]) -> None:
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        WORKER_BLOCKS.append(block)
+        WORKER_ARRAYS[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def publish(initial_df:pd.DataFrame) -> SharedArrays:
+    topology = simulate.get_topology(initial_df)
+    return SharedArrays({
+        "ids": np.array(topology.ids),
+        "area": topology.area,
+        "border_length": topology.border_length,
+        "indptr": topology.indptr,
+        "dst": topology.dst,
+        "shared_border_length": topology.shared_border_length,
+        "population_h": initial_df["population_h"].to_numpy()
+    })
+
+def run_job(settings:Settings, keep_trajectory:bool = False) -> JobResult:
+    '''
+    Runs one job inside a worker from the shared arrays only
+    '''
+    arrays = WORKER_ARRAYS
+    ids = arrays["ids"].tolist()
+    border_area_z = np.minimum(arrays["border_length"] * simulate.get_zed_travel_distance(settings), arrays["area"])
+    topology = Topology(
+        ids,
+        arrays["area"],
+        arrays["border_length"],
+        border_area_z,
+        arrays["indptr"],
+        arrays["dst"],
+        arrays["shared_border_length"]
+    )
+    static_df = pd.DataFrame({
+        "border_length": topology.border_length,
+        "area": topology.area,
+        "border_area_z": topology.border_area_z
+    }, index=pd.Index(ids))
+    state = simulate.initial_state(pd.Series(arrays["population_h"], index=static_df.index), settings)
+    simulate.derive_initial_state(state, topology, simulate.KernelParameters(settings), simulate.make_rng(settings))
+    sinks = [SummarySink()]
+    if keep_trajectory:
+        sinks.append(Trajectory())
+    simulate.run_state(topology, state, static_df, settings, sinks, verbose=False)
+    return JobResult(settings, sinks[0].summary(), sinks[1] if keep_trajectory else None)
+
+def run_jobs(
+        initial_df:pd.DataFrame,
+        settings_list:list[Settings],
+        processes:int|None = None,
+        keep_trajectories:bool = False
+    ) -> list[JobResult]:
+    '''
+    Runs every Settings on the region set of initial_df (from simulate.initialize), in order
+    '''
+    with publish(initial_df) as shared:
+        with Pool(processes, initializer=attach, initargs=(shared.specs,)) as pool:
+            results = pool.starmap(run_job, [(settings, keep_trajectories) for settings in settings_list])
+    return results
+
+def run_scenarios(
+        settings_list:list[Settings],
+        filepaths:Filepaths,
+        processes:int|None = None,
+        keep_trajectories:bool = False
+    ) -> list[JobResult]:
+    '''
+    Loads the setup data once and runs every scenario on the process pool. All scenarios
+    must share a simulation_resolution.
+    '''
+    if len({settings.simulation_resolution.lower() for settings in settings_list}) > 1:
+        raise ValueError("All scenarios must use the same simulation_resolution")
+    attribute_df, neighbors_df, population_df = setup.get_inputs(settings_list[0], filepaths)
+    initial_df = simulate.initialize(attribute_df, neighbors_df, population_df, settings_list[0])
+    return run_jobs(initial_df, settings_list, processes, keep_trajectories)
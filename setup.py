@@ -1,25 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
 from config import Filepaths, Settings
 from data.list_of_contiguous_states import CONTIGUOUS_STATES
 import data.schema as sch
+import domain
+import fiona
+import functools
 import geopandas as gpd
+import instrument
+import numpy as np
 import os
 import pandas as pd
-import pygris
-import requests
+import setup_cache
+import shapely
+from state import region_attributes
+import topology
 import utils
 
 def download_states_shapefile(filename:str) -> gpd.GeoDataFrame:
+    # The download clients are slow to import and only needed when data is missing
+    import pygris
     #Remove below for national-counties
     gdf = pygris.states(cb=True, resolution="500k")
     gdf.to_file(filename, )
     return gdf
 
 def download_counties_shapefile(filename:str) -> gpd.GeoDataFrame:
+    import pygris
     gdf = pygris.counties(cb=True, resolution="500k")
     gdf.to_file(filename, driver='ESRI Shapefile')
     return gdf
 
-def generate_neighborfile(gdf_src:gpd.GeoDataFrame) -> list[dict]:
+def get_shared_border_lengths(geometries:np.ndarray, left:np.ndarray, right:np.ndarray, chunks:list[np.ndarray], workers:int = 1) -> np.ndarray:
+    '''
+    Length of the intersection of geometries[left] and geometries[right], pair by pair.
+    The pairs are split into chunks, which are worked on by a pool of threads when workers > 1:
+    shapely releases the GIL inside its array functions.
+    '''
+    def measure(chunk:np.ndarray) -> np.ndarray:
+        return shapely.length(shapely.intersection(geometries[left[chunk]], geometries[right[chunk]]))
+
+    ret = np.zeros(len(left))
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            for chunk, lengths in zip(chunks, executor.map(measure, chunks)):
+                ret[chunk] = lengths
+    else:
+        for chunk in chunks:
+            ret[chunk] = measure(chunk)
+    return ret
+
+def generate_neighborfile(gdf_src:gpd.GeoDataFrame, workers:int = 1) -> list[dict]:
+    '''
+    One record per region with its border length and the regions it shares a border with.
+    Candidate pairs come from a spatial self-join, and their shared borders are measured
+    in one vectorized pass, split by state across workers threads.
+    '''
     gdf = gdf_src.copy()
     gdf.set_index("id", inplace=True)
     buffer_gdf = gdf.to_crs(epsg=32618) #32618 is the UTM code for North America
@@ -31,33 +66,51 @@ def generate_neighborfile(gdf_src:gpd.GeoDataFrame) -> list[dict]:
     # Filter out self-adjacencies
     neighbor_gdf = joined_gdf[joined_gdf.index != joined_gdf["index_right"]]
 
+    # Candidate pairs as positions in gdf, kept in join order
+    left = gdf.index.get_indexer(neighbor_gdf.index)
+    right = gdf.index.get_indexer(neighbor_gdf["index_right"])
+    geometries = np.asarray(gdf.geometry.values)
+    state_fp = gdf["STATEFP"].to_numpy()
+    chunks = list(pd.Series(np.arange(len(left))).groupby(state_fp[left], sort=False).indices.values())
+    # Shapefile polygons are 1:100 km
+    shared_border_length = 100 * get_shared_border_lengths(geometries, left, right, chunks, workers)
+    border_length = 100 * shapely.length(geometries)
+
+    # Regions in order of their first candidate, each with its candidates in join order
+    region_positions = pd.unique(left)
+    rank = np.empty(len(gdf), dtype=np.int64)
+    rank[region_positions] = np.arange(len(region_positions))
+    order = np.argsort(rank[left], kind="stable")
+    splits = np.cumsum(np.bincount(rank[left], minlength=len(region_positions)))[:-1]
+    ids = gdf.index.tolist()
+    state_fp = state_fp.tolist()
+    names = gdf["NAME"].tolist()
+    county_fp = gdf["COUNTYFP"].tolist() if "COUNTYFP" in gdf.columns else None
+    right = right.tolist()
+    shared_border_length = shared_border_length.tolist()
+
     data = []
-    region_ids = neighbor_gdf.index.unique()
-    for id1 in region_ids:
+    for i, pairs in zip(region_positions.tolist(), np.split(order, splits)):
         neighbors = []
         my_dict = {
-            "id":id1, 
-            "state_fp":gdf.at[id1, "STATEFP"],
-            "name":gdf.at[id1, "NAME"],
+            "id":ids[i], 
+            "state_fp":state_fp[i],
+            "name":names[i],
         }
-        if "COUNTYFP" in gdf.columns:
-            my_dict["county_fp"] = gdf.at[id1, "COUNTYFP"]
-        # Shapefile polygons are 1:100 km
-        my_border_length = 100 * utils.get_border_length(gdf.geometry[id1])
-        my_dict["border_length"] = my_border_length
-        neighbor_ids = neighbor_gdf[neighbor_gdf.index==id1]["index_right"]
-        for id2 in neighbor_ids:
-            # Shapefile polygons are 1:100 km
-            shared_border_length = 100 * utils.get_shared_border_length(gdf.geometry[id1], gdf.geometry[id2])
-            if shared_border_length > 0:
+        if county_fp is not None:
+            my_dict["county_fp"] = county_fp[i]
+        my_dict["border_length"] = float(border_length[i])
+        for pair in pairs.tolist():
+            if shared_border_length[pair] > 0:
+                j = right[pair]
                 neighbor_dict = {
-                    "neighbor_id":id2, 
-                    "neighbor_state_fp":gdf.at[id2, "STATEFP"],
-                    "neighbor_name":gdf.at[id2, "NAME"],
-                    "shared_border_length":shared_border_length,
+                    "neighbor_id":ids[j], 
+                    "neighbor_state_fp":state_fp[j],
+                    "neighbor_name":names[j],
+                    "shared_border_length":shared_border_length[pair],
                 }
-                if "COUNTYFP" in gdf.columns:
-                    neighbor_dict["neighbor_county_fp"] = gdf.at[id2, "COUNTYFP"]
+                if county_fp is not None:
+                    neighbor_dict["neighbor_county_fp"] = county_fp[j]
                 neighbors.append(neighbor_dict)
         my_dict["neighbors"] = neighbors
         data.append(my_dict) 
@@ -70,6 +123,7 @@ def add_leading_zeros(value:any, desired_length=3) -> str:
     return text
 
 def generate_populationfile(filename) -> pd.DataFrame:
+    import requests
     print(f"Can not find {filename}. Downloading now...")
     url = "https://api.census.gov/data/2019/pep/charagegroups?get=NAME,POP&HISP=0&for=county:*"
     session = requests.Session()
@@ -101,92 +155,354 @@ def consolidate_populations(county_pop_df:pd.DataFrame) -> pd.DataFrame:
     state_df = pd.DataFrame.from_records(state_data)
     return state_df
 
-def get_states_shapefile(filepaths:Filepaths) -> gpd.GeoDataFrame:
+def get_state_ids(df:pd.DataFrame) -> pd.Series:
+    return df["STATEFP"].astype(str).str.zfill(2)
+
+def get_county_ids(df:pd.DataFrame) -> pd.Series:
+    return df["STATEFP"].astype(str).str.zfill(2) + df["COUNTYFP"]
+
+def get_tract_ids(df:pd.DataFrame) -> pd.Series:
+    return df["STATEFP"].astype(str).str.zfill(2) + df["COUNTYFP"].astype(str).str.zfill(3) + df["TRACTCE"].astype(str).str.zfill(6)
+
+@functools.lru_cache(maxsize=4)
+def read_shapefile_attributes(filepath:str, modified:float) -> pd.DataFrame:
+    return gpd.read_file(filepath, ignore_geometry=True)
+
+def read_shapefile(filepath:str, get_ids=None, ids:list[str]|None = None, geometry:bool = True) -> gpd.GeoDataFrame:
+    '''
+    Reads the whole shapefile, or only the rows whose get_ids(row) is in ids. The attribute
+    table is read on its own first, so the geometry of the skipped rows is never parsed.
+    Without geometry no polygon is parsed and a plain DataFrame is returned.
+    '''
+    print(f"Reading {filepath}")
+    with instrument.timer("setup.read_shapefile"):
+        if ids is None and geometry:
+            return gpd.read_file(filepath)
+        attributes = read_shapefile_attributes(filepath, os.path.getmtime(filepath))
+        if not geometry:
+            # A copy, so the cached table is not changed by the callers
+            return keep_ids(attributes, get_ids, ids).copy()
+        rows = np.flatnonzero(get_ids(attributes).isin(ids))
+        with fiona.open(filepath) as collection:
+            features = [collection[int(row)] for row in rows]
+            crs = collection.crs
+        if not features:
+            return gpd.GeoDataFrame(columns=list(attributes.columns) + ["geometry"], geometry="geometry", crs=crs)
+        gdf = gpd.GeoDataFrame.from_features(features, crs=crs)
+    return gdf[list(attributes.columns) + ["geometry"]]
+
+def keep_ids(df:pd.DataFrame, get_ids, ids:list[str]|None) -> pd.DataFrame:
+    return df if ids is None else df[get_ids(df).isin(ids)]
+
+def drop_geometry(gdf:gpd.GeoDataFrame) -> pd.DataFrame:
+    return pd.DataFrame(gdf.drop(columns="geometry"))
+
+def get_shape_schema(geometry:bool) -> sch.DataFrameSchema:
+    return sch.ShapeSchema if geometry else sch.ShapeAttributeSchema
+
+def get_states_shapefile(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full", geometry:bool = True) -> gpd.GeoDataFrame:
     state_shape_filepath = os.path.join(filepaths.shape_directory,filepaths.state_shapefile_filename)
     if os.path.exists(state_shape_filepath):
-        print(f"Reading {state_shape_filepath}")
-        state_shape_gdf = gpd.read_file(state_shape_filepath)
+        state_shape_gdf = read_shapefile(state_shape_filepath, get_state_ids, ids, geometry)
     else:
         print(f"Can not find {state_shape_filepath}. Generating now...")
-        state_shape_gdf = download_states_shapefile(state_shape_filepath)   
+        with instrument.timer("setup.download_shapefile"):
+            state_shape_gdf = download_states_shapefile(state_shape_filepath)   
+        state_shape_gdf = keep_ids(state_shape_gdf, get_state_ids, ids)
+        if not geometry:
+            state_shape_gdf = drop_geometry(state_shape_gdf)
     state_shape_gdf["id"] = state_shape_gdf["STATEFP"]
-    state_shape_gdf = sch.clean_df(state_shape_gdf, sch.ShapeSchema)
+    with instrument.timer("setup.clean_schema"):
+        state_shape_gdf = sch.clean_df(state_shape_gdf, get_shape_schema(geometry), validation)
     state_shape_gdf = filter_for_contiguous(state_shape_gdf)
     return state_shape_gdf
 
-def get_county_shapefile(filepaths:Filepaths) -> gpd.GeoDataFrame:
+def get_county_shapefile(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full", geometry:bool = True) -> gpd.GeoDataFrame:
     counties_shape_filepath = os.path.join(filepaths.shape_directory,filepaths.county_shapefile_filename)
     if os.path.exists(counties_shape_filepath):
-            print(f"Reading {counties_shape_filepath}")
-            counties_shape_gdf = gpd.read_file(counties_shape_filepath)
+        counties_shape_gdf = read_shapefile(counties_shape_filepath, get_county_ids, ids, geometry)
     else:
         print(f"Can not find {counties_shape_filepath}. Generating now...")
-        counties_shape_gdf = download_counties_shapefile(counties_shape_filepath)  
-    counties_shape_gdf["STATEFP"] = counties_shape_gdf["STATEFP"].apply(add_leading_zeros, args=(2,))
-    counties_shape_gdf["id"] = counties_shape_gdf["STATEFP"] + counties_shape_gdf["COUNTYFP"]
-    counties_shape_gdf = sch.clean_df(counties_shape_gdf, sch.ShapeSchema)
+        with instrument.timer("setup.download_shapefile"):
+            counties_shape_gdf = download_counties_shapefile(counties_shape_filepath)  
+        counties_shape_gdf = keep_ids(counties_shape_gdf, get_county_ids, ids)
+        if not geometry:
+            counties_shape_gdf = drop_geometry(counties_shape_gdf)
+    counties_shape_gdf["STATEFP"] = counties_shape_gdf["STATEFP"].astype(str).str.zfill(2)
+    counties_shape_gdf["id"] = get_county_ids(counties_shape_gdf)
+    with instrument.timer("setup.clean_schema"):
+        counties_shape_gdf = sch.clean_df(counties_shape_gdf, get_shape_schema(geometry), validation)
     counties_shape_gdf = filter_for_contiguous(counties_shape_gdf)    
     return counties_shape_gdf
 
-def main(settings:Settings, filepaths:Filepaths) -> tuple[gpd.GeoDataFrame, pd.DataFrame, pd.DataFrame]:  
-    state_neighbors_filepath = os.path.join(filepaths.neighbor_directory,filepaths.state_neighbors_filename)
-    
-    county_neighbors_filepath = os.path.join(filepaths.neighbor_directory,filepaths.county_neighbors_filename)
-    population_filepath = filepaths.county_populations_filename
-    
-    if settings.simulation_resolution.lower() == "state": 
-        state_shape_gdf = get_states_shapefile(filepaths)
-        if os.path.exists(state_neighbors_filepath):  
-            print(f"Reading {state_neighbors_filepath}")      
-            state_neighbors_df = utils.df_from_json(state_neighbors_filepath)
-        else:
-            print(f"Can not find {state_neighbors_filepath}. Generating now...")
-            state_neighbors_data = generate_neighborfile(state_shape_gdf)
-            utils.write_json_file(state_neighbors_data, state_neighbors_filepath)  
-            state_neighbors_df = pd.DataFrame.from_records(state_neighbors_data)
-        state_neighbors_df = sch.clean_df(state_neighbors_df, sch.GraphSchema)    
-
-    if settings.simulation_resolution.lower() == "county":        
-        counties_shape_gdf = get_county_shapefile(filepaths)    
-        if os.path.exists(county_neighbors_filepath):
-            print(f"Reading {county_neighbors_filepath}")  
-            county_neighbors_df = utils.df_from_json(county_neighbors_filepath)
-        else:
-            print(f"Can not find {county_neighbors_filepath}. Generating now...")
-            county_neighbors_data = generate_neighborfile(counties_shape_gdf) 
-            utils.write_json_file(county_neighbors_data, county_neighbors_filepath)
-            county_neighbors_df = pd.DataFrame.from_records(county_neighbors_data)     
-        county_neighbors_df = sch.clean_df(county_neighbors_df, sch.GraphSchema)
+def get_tract_shapefile(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full", geometry:bool = True) -> gpd.GeoDataFrame:
+    '''
+    Tract shapefiles are large and split by state, so they are not downloaded. Place a
+    national tract shapefile (e.g. the Census cartographic boundary cb_*_us_tract_500k)
+    at filepaths.tract_shapefile_filename in the shape directory.
+    '''
+    tracts_shape_filepath = os.path.join(filepaths.shape_directory,filepaths.tract_shapefile_filename)
+    if not os.path.exists(tracts_shape_filepath):
+        raise FileNotFoundError(f"Can not find {tracts_shape_filepath}. Tract shapefiles have to be placed there manually.")
+    tracts_shape_gdf = read_shapefile(tracts_shape_filepath, get_tract_ids, ids, geometry)
+    tracts_shape_gdf["STATEFP"] = tracts_shape_gdf["STATEFP"].astype(str).str.zfill(2)
+    tracts_shape_gdf["COUNTYFP"] = tracts_shape_gdf["COUNTYFP"].astype(str).str.zfill(3)
+    tracts_shape_gdf["TRACTCE"] = tracts_shape_gdf["TRACTCE"].astype(str).str.zfill(6)
+    tracts_shape_gdf["id"] = get_tract_ids(tracts_shape_gdf)
+    with instrument.timer("setup.clean_schema"):
+        tracts_shape_gdf = sch.clean_df(tracts_shape_gdf, get_shape_schema(geometry), validation)
+    tracts_shape_gdf = filter_for_contiguous(tracts_shape_gdf)
+    return tracts_shape_gdf
 
+def get_county_populations(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full") -> pd.DataFrame:
+    population_filepath = filepaths.county_populations_filename
     if os.path.exists(population_filepath):
         print(f"Reading {population_filepath}")
-        county_population_df = pd.read_csv(population_filepath)
+        with instrument.timer("setup.read_populations"):
+            county_population_df = pd.read_csv(population_filepath)
     else:
         print(f"Can not find {population_filepath}. Generating now...")
         county_population_df = generate_populationfile(population_filepath)        
         county_population_df.to_csv(population_filepath)
-    county_population_df["state"] = county_population_df["state"].apply(add_leading_zeros, args=(2,))
-    county_population_df["county"] = county_population_df["county"].apply(add_leading_zeros, args=(3,))
+    county_population_df["state"] = county_population_df["state"].astype(str).str.zfill(2)
+    county_population_df["county"] = county_population_df["county"].astype(str).str.zfill(3)
     county_population_df["id"] = county_population_df["state"] + county_population_df["county"]
-    county_population_df = sch.clean_df(county_population_df, sch.PopulationSchema)
+    if ids is not None:
+        county_population_df = county_population_df[county_population_df["id"].isin(ids)]
+    with instrument.timer("setup.clean_schema"):
+        county_population_df = sch.clean_df(county_population_df, sch.PopulationSchema, validation)
+    return county_population_df
+
+def get_state_populations(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full") -> pd.DataFrame:
+    state_population_df = consolidate_populations(get_county_populations(filepaths, validation=validation))
+    with instrument.timer("setup.clean_schema"):
+        state_population_df = sch.clean_df(state_population_df, sch.StatePopulationSchema, validation)
+    if ids is not None:
+        state_population_df = state_population_df[state_population_df["id"].isin(ids)]
+    return state_population_df
+
+def get_tract_populations(filepaths:Filepaths, ids:list[str]|None = None, validation:str = "full") -> pd.DataFrame:
+    '''
+    Reads tract populations laid out like the county file (POP, state, county) plus a
+    tract column, e.g. a saved Census API response. HISP defaults to 0 if it is missing.
+    '''
+    population_filepath = filepaths.tract_populations_filename
+    if not os.path.exists(population_filepath):
+        raise FileNotFoundError(f"Can not find {population_filepath}. Tract populations have to be placed there manually.")
+    print(f"Reading {population_filepath}")
+    with instrument.timer("setup.read_populations"):
+        tract_population_df = pd.read_csv(population_filepath, dtype={"state":str, "county":str, "tract":str})
+    if "HISP" not in tract_population_df.columns:
+        tract_population_df["HISP"] = 0
+    tract_population_df["state"] = tract_population_df["state"].str.zfill(2)
+    tract_population_df["county"] = tract_population_df["county"].str.zfill(3)
+    tract_population_df["tract"] = tract_population_df["tract"].str.zfill(6)
+    tract_population_df["id"] = tract_population_df["state"] + tract_population_df["county"] + tract_population_df["tract"]
+    if ids is not None:
+        tract_population_df = tract_population_df[tract_population_df["id"].isin(ids)]
+    with instrument.timer("setup.clean_schema"):
+        tract_population_df = sch.clean_df(tract_population_df, sch.PopulationSchema, validation)
+    return tract_population_df
+
+def read_neighbor_records(neighbors_filepath:str, get_shape_gdf) -> list[dict]:
+    '''
+    The raw records of the neighbor file, generated from get_shape_gdf() if there is none
+    '''
+    if os.path.exists(neighbors_filepath):
+        print(f"Reading {neighbors_filepath}")
+        with instrument.timer("setup.read_neighbors"):
+            return utils.read_json_file(neighbors_filepath)
+    print(f"Can not find {neighbors_filepath}. Generating now...")
+    shape_gdf = get_shape_gdf()
+    with instrument.timer("setup.generate_neighbors"):
+        neighbors_data = generate_neighborfile(shape_gdf, workers=os.cpu_count() or 1)
+    utils.write_json_file(neighbors_data, neighbors_filepath)
+    return neighbors_data
 
-    match settings.simulation_resolution.lower():    
+def clean_neighbors(neighbors_data:list[dict], validation:str = "full") -> pd.DataFrame:
+    neighbors_df = pd.DataFrame.from_records(neighbors_data)
+    with instrument.timer("setup.clean_schema"):
+        neighbors_df = sch.clean_df(neighbors_df, sch.GraphSchema, validation)
+    return neighbors_df
+
+def load_graph(neighbors_filepath:str, get_shape_gdf, validation:str = "auto") -> dict[str, np.ndarray]:
+    '''
+    The CSR arrays of the neighbor file, memory-mapped from its binary copy next to it.
+    The copy is written, from the schema-checked JSON, whenever it is missing or older
+    than the JSON, so the JSON stays the file to edit or share. A JSON file that was just
+    generated only gets the structural checks (see schema.clean_df).
+    '''
+    graph_filepath = setup_cache.get_graph_filepath(neighbors_filepath)
+    if setup_cache.graph_is_current(neighbors_filepath):
+        try:
+            with instrument.timer("setup.read_graph"):
+                return topology.read_graph(graph_filepath)
+        except (OSError, ValueError) as e:
+            print(f"Can not read {graph_filepath} ({e}). Rebuilding it from {neighbors_filepath}")
+    level = sch.pick_level(validation, "full" if os.path.exists(neighbors_filepath) else "structural")
+    neighbors_df = clean_neighbors(read_neighbor_records(neighbors_filepath, get_shape_gdf), level)
+    with instrument.timer("setup.write_graph"):
+        arrays = topology.graph_arrays(neighbors_df)
+        utils.write_npz(graph_filepath, arrays)
+    return arrays
+
+def export_neighborfile(neighbors_filepath:str, graph_filepath:str|None = None) -> None:
+    '''
+    Writes the JSON neighbor file of a binary graph file, e.g. one shared without its JSON
+    '''
+    graph_filepath = setup_cache.get_graph_filepath(neighbors_filepath) if graph_filepath is None else graph_filepath
+    utils.write_json_file(topology.graph_records(topology.read_graph(graph_filepath)), neighbors_filepath)
+
+def get_neighbors(get_shape_gdf, neighbors_filepath:str, validation:str = "auto") -> pd.DataFrame:
+    '''
+    get_shape_gdf returns the shapes to generate a missing neighbor file from
+    '''
+    arrays = load_graph(neighbors_filepath, get_shape_gdf, validation)
+    # The graph file was validated when it was written, so the neighbor lists are only
+    # built when they are checked again
+    level = sch.pick_level(validation, "trusted")
+    with instrument.timer("setup.graph_frame"):
+        neighbors_df = topology.graph_frame(arrays, neighbors=level != "trusted")
+    return sch.clean_df(neighbors_df, sch.GraphSchema, level)
+
+def get_sources(settings:Settings, filepaths:Filepaths) -> tuple:
+    '''
+    The shapefile reader, neighbor file and population reader of the simulation
+    resolution. Both readers take filepaths and, optionally, the ids of the regions to keep.
+    '''
+    match settings.simulation_resolution.lower():
         case "state":
-            simulation_gdf = state_shape_gdf
-            neighbor_df = state_neighbors_df
-            population_df = consolidate_populations(county_population_df)
-        case "county":
-            simulation_gdf = counties_shape_gdf
-            neighbor_df = county_neighbors_df
-            population_df = county_population_df
+            return (get_states_shapefile, os.path.join(filepaths.neighbor_directory,filepaths.state_neighbors_filename), get_state_populations)
+        # Mixed resolution runs on the county data and merges quiet states on the fly
+        case "county" | "mixed":
+            return (get_county_shapefile, os.path.join(filepaths.neighbor_directory,filepaths.county_neighbors_filename), get_county_populations)
+        case "tract":
+            return (get_tract_shapefile, os.path.join(filepaths.neighbor_directory,filepaths.tract_neighbors_filename), get_tract_populations)
         case _:
-            raise ValueError("simulation_resolution must be 'state' or 'county'")
+            raise ValueError("simulation_resolution must be 'state', 'county', 'tract' or 'mixed'")
+
+def get_domain(settings:Settings, filepaths:Filepaths, region_ids:list[str]|None = None) -> domain.Domain:
+    '''
+    The bounded domain of a run with settings.domain_hops: only its regions are read from
+    the shapefile, and more are loaded as it grows. region_ids restores an earlier domain,
+    e.g. that of a checkpoint, instead of starting from the outbreak.
+    '''
+    get_shapes, neighbors_filepath, get_populations = get_sources(settings, filepaths)
+    validation = sch.pick_level(settings.schema_validation, "full")
+    arrays = load_graph(neighbors_filepath, lambda: get_shapes(filepaths, validation=validation), settings.schema_validation)
+    ids = arrays["ids"].tolist()
+    positions = {region_id:i for i, region_id in enumerate(ids)}
+
+    def load(region_ids:list[str]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        attribute_df = region_attributes(get_shapes(filepaths, region_ids, validation, geometry=False).set_index("id"))
+        neighbor_df = topology.graph_frame(arrays, [positions[region_id] for region_id in region_ids])
+        neighbor_df = sch.clean_df(neighbor_df, sch.GraphSchema, sch.pick_level(settings.schema_validation, "trusted")).set_index("id")
+        population_df = get_populations(filepaths, region_ids, validation).set_index("id")
+        return (attribute_df, neighbor_df, population_df)
+
+    indptr = arrays["indptr"]
+    indices = arrays["indices"].tolist()
+    graph = {region_id:[ids[j] for j in indices[indptr[i]:indptr[i+1]]] for i, region_id in enumerate(ids)}
+    return domain.Domain(graph, load, settings, region_ids)
+
+def main(settings:Settings, filepaths:Filepaths, geometry:bool = True) -> tuple[gpd.GeoDataFrame, pd.DataFrame, pd.DataFrame]:
+    '''
+    The shape, neighbor and population frames of the simulation resolution, indexed by id.
+    With settings.setup_cache the cleaned shape and population frames are saved in the
+    setup cache directory and reused until their source files change. Without geometry the
+    shape frame is a DataFrame of the shapefile attributes and no polygon is parsed, unless
+    the setup cache has to be filled.
+    '''
+    get_shapes, neighbors_filepath, get_populations = get_sources(settings, filepaths)
+    validation = sch.pick_level(settings.schema_validation, "full")
+    cached = None
+    if settings.setup_cache:
+        name, key = setup_cache.get_setup_cache_key(settings, filepaths)
+        cached = None if key is None else setup_cache.read_setup_cache(filepaths, name, key, settings.schema_validation, geometry,
+                                                                         setup_cache.get_population_schema(settings))
+    if cached is None:
+        # The setup cache keeps the polygons, so later runs can read it either way
+        simulation_gdf = get_shapes(filepaths, validation=validation, geometry=geometry or settings.setup_cache)
+        population_df = get_populations(filepaths, validation=validation)
+        if settings.setup_cache:
+            # Missing sources have just been downloaded
+            name, key = setup_cache.get_setup_cache_key(settings, filepaths)
+            if key is not None:
+                setup_cache.write_setup_cache(filepaths, name, key, simulation_gdf, population_df, validation)
+        if not geometry and "geometry" in simulation_gdf.columns:
+            simulation_gdf = drop_geometry(simulation_gdf)
+    else:
+        simulation_gdf, population_df = cached
+    if geometry:
+        get_shape_gdf = lambda: simulation_gdf
+    else:
+        get_shape_gdf = lambda: get_shapes(filepaths, validation=validation)
+    neighbor_df = get_neighbors(get_shape_gdf, neighbors_filepath, settings.schema_validation)
 
     simulation_gdf.set_index("id", inplace=True)
     neighbor_df.set_index("id", inplace=True)
     population_df.set_index("id", inplace=True)
     return (simulation_gdf, neighbor_df, population_df)
+
+def get_inputs(settings:Settings, filepaths:Filepaths) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    '''
+    The attribute, neighbor and population frames simulate.initialize needs, indexed by id.
+    The attribute table (see state.region_attributes) holds the name, land area and state of
+    every region but no polygons; get_shapes reads those when a run is plotted.
+    '''
+    shape_df, neighbor_df, population_df = main(settings, filepaths, geometry=False)
+    return (region_attributes(shape_df), neighbor_df, population_df)
+
+def get_shapes(settings:Settings, filepaths:Filepaths, ids:list[str]|None = None) -> gpd.GeoDataFrame:
+    '''
+    The polygons of the simulation resolution, indexed by id: those of every region, read
+    from the setup cache when it is current, or only those of ids
+    '''
+    get_shape_gdf = get_sources(settings, filepaths)[0]
+    if ids is None and settings.setup_cache:
+        name, key = setup_cache.get_setup_cache_key(settings, filepaths)
+        cached = None if key is None else setup_cache.read_setup_cache(filepaths, name, key, settings.schema_validation,
+                                                                         population_schema=setup_cache.get_population_schema(settings))
+        if cached is not None:
+            return cached[0].set_index("id")
+    return get_shape_gdf(filepaths, ids, sch.pick_level(settings.schema_validation, "full")).set_index("id")
         
+class SessionCache:
+    '''
+    Setup outputs kept in memory for an interactive session, keyed by the data they were
+    read from, so back-to-back runs only pay for simulating. Every call returns copies.
+    Call clear() after changing the data files while the session is running.
+    '''
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key:tuple, load):
+        if key in self.entries:
+            instrument.count("setup.session_hits")
+        else:
+            self.entries[key] = load()
+        value = self.entries[key]
+        if isinstance(value, tuple):
+            return tuple(frame.copy() for frame in value)
+        return value.copy()
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def inputs(self, settings:Settings, filepaths:Filepaths) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        name, paths, neighbors_filepath = setup_cache.get_source_files(settings, filepaths)
+        key = ("inputs", name, tuple(paths), neighbors_filepath, settings.schema_validation)
+        return self.get(key, lambda: get_inputs(settings, filepaths))
+
+    def shapes(self, settings:Settings, filepaths:Filepaths) -> gpd.GeoDataFrame:
+        name, paths, _ = setup_cache.get_source_files(settings, filepaths)
+        key = ("shapes", name, tuple(paths), settings.schema_validation)
+        return self.get(key, lambda: get_shapes(settings, filepaths))
+
+    def state_borders(self, filepaths:Filepaths) -> gpd.GeoDataFrame:
+        key = ("state_borders", os.path.join(filepaths.shape_directory,filepaths.state_shapefile_filename))
+        return self.get(key, lambda: get_states_shapefile(filepaths))
+
 if __name__ == "__main__":
     my_filepaths = Filepaths()
     my_settings = Settings()
@@ -0,0 +1,186 @@
+'''
+On-disk caches of the setup outputs.
+
+The cleaned shape and population frames of a resolution are saved as GeoParquet and
+Feather files in the setup cache directory, keyed by the fingerprints of the files they
+were read from, and each neighbor file gets a binary graph copy next to it (see
+topology.write_graph). This module only needs pandas, so a headless run can read the
+caches without importing the geometry and download stacks setup depends on.
+'''
+from config import Filepaths, Settings
+import data.schema as sch
+import hashlib
+import instrument
+import os
+import pandas as pd
+from state import region_attributes
+import topology
+import utils
+
+SETUP_CACHE_VERSION = 1
+SHAPEFILE_EXTENSIONS = ["shp", "shx", "dbf", "prj", "cpg"]
+
+def get_graph_filepath(neighbors_filepath:str) -> str:
+    return os.path.splitext(neighbors_filepath)[0] + ".npz"
+
+def graph_is_current(neighbors_filepath:str) -> bool:
+    '''
+    True if the neighbor file has a graph copy at least as new as itself
+    '''
+    graph_filepath = get_graph_filepath(neighbors_filepath)
+    return os.path.exists(graph_filepath) and (not os.path.exists(neighbors_filepath)
+            or os.path.getmtime(graph_filepath) >= os.path.getmtime(neighbors_filepath))
+
+def get_source_files(settings:Settings, filepaths:Filepaths) -> tuple[str, list[str], str]:
+    '''
+    The name of the setup cache of the simulation resolution, the files its shape and
+    population frames are read from, and its neighbor file
+    '''
+    match settings.simulation_resolution.lower():
+        case "state":
+            shapefile, populations, neighbors = filepaths.state_shapefile_filename, filepaths.county_populations_filename, filepaths.state_neighbors_filename
+        case "county" | "mixed":
+            shapefile, populations, neighbors = filepaths.county_shapefile_filename, filepaths.county_populations_filename, filepaths.county_neighbors_filename
+        case "tract":
+            shapefile, populations, neighbors = filepaths.tract_shapefile_filename, filepaths.tract_populations_filename, filepaths.tract_neighbors_filename
+        case _:
+            raise ValueError("simulation_resolution must be 'state', 'county', 'tract' or 'mixed'")
+    shape_stem = os.path.join(filepaths.shape_directory, os.path.splitext(shapefile)[0])
+    shape_files = [f"{shape_stem}.{extension}" for extension in SHAPEFILE_EXTENSIONS if os.path.exists(f"{shape_stem}.{extension}")]
+    return (os.path.basename(shape_stem), shape_files + [populations], os.path.join(filepaths.neighbor_directory, neighbors))
+
+def get_population_schema(settings:Settings) -> sch.DataFrameSchema:
+    '''
+    The schema of the population frame of the simulation resolution: states hold the sums
+    of their counties, without the county columns
+    '''
+    return sch.StatePopulationSchema if settings.simulation_resolution.lower() == "state" else sch.PopulationSchema
+
+def fingerprint_files(paths:list[str]) -> list[dict]|None:
+    '''
+    The content hash, size and modification time of every file, or None if one is missing
+    '''
+    fingerprints = []
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        fingerprints.append({"path":os.path.abspath(path), "sha256":digest, "size":os.path.getsize(path), "mtime":os.path.getmtime(path)})
+    return fingerprints
+
+def get_setup_cache_key(settings:Settings, filepaths:Filepaths) -> tuple[str, dict|None]:
+    name, paths, _ = get_source_files(settings, filepaths)
+    with instrument.timer("setup.fingerprint"):
+        fingerprints = fingerprint_files(paths)
+    if fingerprints is None:
+        return (name, None)
+    return (name, {"version":SETUP_CACHE_VERSION, "sources":fingerprints})
+
+def read_cache_key(filepaths:Filepaths, name:str, key:dict) -> dict|None:
+    '''
+    The saved key of the setup cache if it was saved for key: key plus the validation level
+    of the frames it holds. None otherwise.
+    '''
+    key_filepath = os.path.join(filepaths.setup_cache_directory, f"{name}.json")
+    if not os.path.exists(key_filepath):
+        return None
+    saved = utils.read_json_file(key_filepath)
+    if {field:value for field, value in saved.items() if field != "validation"} != key:
+        return None
+    return saved
+
+def read_setup_cache(
+        filepaths:Filepaths,
+        name:str,
+        key:dict,
+        validation:str = "auto",
+        geometry:bool = True,
+        population_schema:sch.DataFrameSchema = sch.PopulationSchema
+    ) -> tuple[pd.DataFrame, pd.DataFrame]|None:
+    '''
+    The cleaned shape and population frames saved for key, or None if they were saved for
+    other source files. population_schema is that of the resolution (see
+    get_population_schema). Only frames that were fully validated before they were saved
+    are trusted; others get the full checks, after which the cache is marked as fully
+    validated if the polygons were checked too. Without geometry the shape frame is a plain
+    DataFrame of the attribute columns, and geopandas is not needed.
+    '''
+    cache_stem = os.path.join(filepaths.setup_cache_directory, name)
+    saved = read_cache_key(filepaths, name, key)
+    if saved is None:
+        return None
+    print(f"Reading cached setup {cache_stem}")
+    try:
+        with instrument.timer("setup.read_cache"):
+            if geometry:
+                import geopandas as gpd
+                shape_df = gpd.read_parquet(f"{cache_stem}_shapes.parquet")
+            else:
+                import pyarrow.parquet as pq
+                columns = [column for column in pq.read_schema(f"{cache_stem}_shapes.parquet").names if column != "geometry" and not column.startswith("__")]
+                shape_df = pd.read_parquet(f"{cache_stem}_shapes.parquet", columns=columns)
+            population_df = pd.read_feather(f"{cache_stem}_populations.feather")
+    except (OSError, ValueError) as e:
+        print(f"Can not read the cached setup ({e}). Rebuilding it")
+        return None
+    validated = saved.get("validation") == "full"
+    level = sch.pick_level(validation, "trusted" if validated else "full")
+    shape_schema = sch.ShapeSchema if geometry else sch.ShapeAttributeSchema
+    with instrument.timer("setup.clean_schema"):
+        cached = (sch.clean_df(shape_df, shape_schema, level), sch.clean_df(population_df, population_schema, level))
+    if level == "full" and geometry and not validated:
+        utils.write_json_file(saved | {"validation":"full"}, f"{cache_stem}.json")
+    return cached
+
+def write_setup_cache(
+        filepaths:Filepaths,
+        name:str,
+        key:dict,
+        shape_gdf:pd.DataFrame,
+        population_df:pd.DataFrame,
+        validation:str
+    ) -> None:
+    '''
+    Saves the frames for key. validation is the level they were cleaned at, and only frames
+    cleaned at "full" are trusted when they are read back.
+    '''
+    cache_stem = os.path.join(filepaths.setup_cache_directory, name)
+    os.makedirs(filepaths.setup_cache_directory, exist_ok=True)
+    try:
+        with instrument.timer("setup.write_cache"):
+            # The key goes last, so frames half written by an interrupted run are never read
+            if os.path.exists(f"{cache_stem}.json"):
+                os.remove(f"{cache_stem}.json")
+            shape_gdf.to_parquet(f"{cache_stem}_shapes.parquet")
+            population_df.reset_index(drop=True).to_feather(f"{cache_stem}_populations.feather")
+            utils.write_json_file(key | {"validation":validation}, f"{cache_stem}.json")
+    except (ImportError, OSError, ValueError) as e:
+        print(f"Can not cache the setup ({e})")
+
+def read_attribute_inputs(settings:Settings, filepaths:Filepaths) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]|None:
+    '''
+    setup.get_inputs' (attribute, neighbor, population) frames, read from the caches. None
+    unless every cache is current and trusted.
+    '''
+    if not settings.setup_cache or sch.pick_level(settings.schema_validation, "trusted") != "trusted":
+        return None
+    name, key = get_setup_cache_key(settings, filepaths)
+    neighbors_filepath = get_source_files(settings, filepaths)[2]
+    if key is None or not graph_is_current(neighbors_filepath):
+        return None
+    saved = read_cache_key(filepaths, name, key)
+    if saved is None or saved.get("validation") != "full":
+        return None
+    cached = read_setup_cache(filepaths, name, key, settings.schema_validation, geometry=False, population_schema=get_population_schema(settings))
+    if cached is None:
+        return None
+    shape_df, population_df = cached
+    try:
+        with instrument.timer("setup.read_graph"):
+            arrays = topology.read_graph(get_graph_filepath(neighbors_filepath))
+    except (OSError, ValueError):
+        return None
+    with instrument.timer("setup.graph_frame"):
+        neighbors_df = sch.clean_df(topology.graph_frame(arrays, neighbors=False), sch.GraphSchema, "trusted")
+    return (region_attributes(shape_df.set_index("id")), neighbors_df.set_index("id"), population_df.set_index("id"))
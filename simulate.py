@@ -1,16 +1,33 @@
 from config import Settings
+import copy
 import data.schema as sch
-import geopandas as gpd
+import functools
+import hierarchy
+import instrument
 import math
 import numpy as np
 import pandas as pd
-import random 
+from sinks import SummarySink, summary_frame
+from state import DYNAMIC_COLUMNS, POPULATION_COLUMNS, SimulationState, Trajectory, build_frame, region_attributes, static_frame
+import time
+from topology import Topology
+from typing import Iterator
 import utils
 
+STOP_COMPLETED = "completed"
+STOP_NO_ZEDS = "no_zeds"
+STOP_NO_HUMANS = "no_humans"
+STOP_STEADY_STATE = "steady_state"
+STOP_TIME_BUDGET = "time_budget"
+TIME_STEPPING_ERROR_MESSAGE = "time_stepping must be 'fixed' or 'adaptive'"
+MIXED_TIME_STEPPING_ERROR_MESSAGE = "Mixed resolution runs only support fixed time_stepping"
+ADAPTIVE_ABSOLUTE_TOLERANCE = 1.0 #people
+NO_SIM_MESSAGE_REPORT = "Error: Unable to report without simulating first."
+
 def outbreak(src_df:pd.DataFrame, ground_zero_list:list[str], zero_patients:float) -> pd.DataFrame:
     ret_df = src_df.copy()
     for ground_zero in ground_zero_list:
-        if ground_zero not in list(ret_df.index):
+        if ground_zero not in ret_df.index:
             if ground_zero.lower() == 'us':
                 if zero_patients < 1:
                     ret_df["population_z"] = zero_patients*ret_df["population_h"]
@@ -34,75 +51,51 @@ def set_features(index:list) -> pd.DataFrame:
 
 def set_initial_conditions(src_df:pd.DataFrame, p_df:pd.DataFrame, settings:Settings) -> pd.DataFrame:
     ret_df = src_df.copy()
-    for index in ret_df.index:
-        ret_df.at[index,"population_h"] = p_df.at[index,"POP"]  
+    ret_df["population_h"] = p_df.loc[ret_df.index, "POP"].to_numpy()
     # Calling infer_objects prevents downcasting FutureWarning
     ret_df = ret_df.infer_objects(copy=False).fillna(0.0)
     ret_df = outbreak(ret_df, settings.outbreak_region, settings.outbreak_size)
     return ret_df
 
+def get_zed_travel_distance(settings:Settings) -> float:
+    return settings.zed_speed*1.609*24*1 #Convert from mph to km in 1 day
+
 def calculate_static_values(
         src_df:pd.DataFrame,
-        gdf:gpd.GeoDataFrame,
+        shape_df:pd.DataFrame,
         neigh_df:pd.DataFrame,
         distance_z:float
     ) -> pd.DataFrame:
     
+    attributes = region_attributes(shape_df)
     ret_df = src_df.copy()
-    ret_df["name"] = gdf["NAME"]
+    ret_df["name"] = attributes["name"]
     ret_df["border_length"] = neigh_df["border_length"]
-    ret_df["area"] = gdf["ALAND"] * 1e-6 #km^2
+    ret_df["area"] = attributes["area"] #km^2
     ret_df["border_area_z"] = (ret_df["border_length"]*distance_z).clip(upper= ret_df["area"])
-    ret_df["neighbors"] = neigh_df["neighbors"]
-    ret_df.dropna(axis='index', subset="neighbors", inplace=True)
+    if "neighbors" in neigh_df.columns:
+        ret_df["neighbors"] = neigh_df["neighbors"]
+        ret_df.dropna(axis='index', subset="neighbors", inplace=True)
+    elif "graph" in neigh_df.attrs:
+        # A graph frame without neighbor lists (see topology.graph_frame) lists every region of its graph
+        ret_df = ret_df[ret_df.index.isin(neigh_df.index)].drop(columns="neighbors")
+        ret_df.attrs["graph"] = neigh_df.attrs["graph"]
     return ret_df
 
-def fix_migration_roundoff(migrations:pd.Series, error:int) -> pd.Series:
-    ret = migrations.copy()
-    print(f"Adjusting for round-off error of {error}")
-    while error != 0:
-        if error > 0:
-            regions_eligible_for_adjustment = ret[ret > 0]
-            region_to_adjust = random.choice(regions_eligible_for_adjustment.index)
-            ret[region_to_adjust] = ret[region_to_adjust] - 1
-            error = error - 1
-        if error < 0:
-            regions_eligible_for_adjustment = ret[ret < 0]
-            region_to_adjust = random.choice(regions_eligible_for_adjustment.index)
-            ret[region_to_adjust] = ret[region_to_adjust] + 1
-            error = error + 1        
-    return ret
+def get_topology(src_df:pd.DataFrame) -> Topology:
+    topology = src_df.attrs.get("topology")
+    if topology is None or topology.ids != list(src_df.index):
+        topology = Topology.from_frame(src_df)
+    return topology
 
-def calculate_migration(src_df:pd.DataFrame) -> pd.Series:
-    ret = pd.Series(index=src_df.index)
-    for my_id in ret.index:
-        if my_id == "41033" or my_id == "41017":
-            junk = 1
-        total = 0        
-        my_conc = (src_df.at[my_id,"population_z"] - src_df.at[my_id,"killed_z"]) / src_df.at[my_id,"area"]        
-        for neighbor in src_df.at[my_id,"neighbors"]:
-            neighbor_id = neighbor["neighbor_id"]
-            neighbor_conc = (src_df.at[neighbor_id,"population_z"] - src_df.at[neighbor_id,"killed_z"]) / src_df.at[neighbor_id,"area"]
-            neighbor_border_zeds = my_conc * src_df.at[neighbor_id,"border_area_z"]            
-            shared_border_length = neighbor["shared_border_length"]
-            my_fraction = shared_border_length / src_df.at[my_id,"border_length"]
-            neighbor_fraction = shared_border_length / src_df.at[neighbor_id,"border_length"]
-            my_border_zeds = my_conc * my_fraction * src_df.at[my_id,"border_area_z"]
-            neighbor_border_zeds = neighbor_conc * neighbor_fraction * src_df.at[neighbor_id,"border_area_z"]
-            base_migration = (neighbor_border_zeds - my_border_zeds) / 2 
-            if base_migration != 0:
-                rate = abs(neighbor_conc - my_conc)/(neighbor_conc + my_conc)
-                total += int(rate*base_migration)
-        ret[my_id] = total 
-    migration_sum = sum(ret)
-    if(sum(ret) != 0):
-        total_migration = sum(ret.apply(abs)) / 2
-        if migration_sum / total_migration < 0.001:
-            ret = fix_migration_roundoff(ret, migration_sum)
-        else:
-            error_message = f"Round-off error. Migration sum is {migration_sum}. It should be 0."
-            raise RuntimeError(error_message)
-    return ret
+def calculate_migration(src_df:pd.DataFrame, rounding:str = "truncate", rng:np.random.Generator|None = None) -> pd.Series:
+    migration = get_topology(src_df).migration(
+        src_df["population_z"].to_numpy(dtype=float),
+        src_df["killed_z"].to_numpy(dtype=float),
+        rounding,
+        rng
+    )
+    return pd.Series(migration, index=src_df.index)
 
 def calculate_escape_chance(cumulative_encounters, initial, final, m, b):
     scale = final - initial
@@ -110,121 +103,607 @@ def calculate_escape_chance(cumulative_encounters, initial, final, m, b):
     ret = initial + scale*ret
     return ret
 
-def calculate_escape_chance2(x, initial, final, l, mu = 0.5):
+@functools.lru_cache(maxsize=None)
+def get_escape_chance_constants(initial:float, final:float, l:float, mu:float = 0.5) -> tuple[float, float, float]:
+    '''
+    Returns (a, c, m) of the escape chance curve a*sigmoid2(m*x) + c of x cumulative
+    encounters, which rises from initial at x = 0 towards final and is
+    initial + mu*(final - initial) at x = l
+    '''
     a = 2*(final - initial)
     c = final - a
-    k = a / (mu*(final - initial) + initial - c)    
+    k = a / (mu*(final - initial) + initial - c)
     m = math.log(k-1)/-l
-    sig = utils.sigmoid2(m*x)
+    return (a, c, m)
+
+def calculate_escape_chance_array(x:np.ndarray, constants:tuple[float, float, float]) -> np.ndarray:
+    a, c, m = constants
+    sig = 1 / (1 + np.exp(-m*x))
     return a*sig + c
 
-def calculate_decay_encounter(P0, rate):
-    n = math.ceil(math.log(0.5/(P0 + 1), rate))
-    sum = 0
-    for x in range(n):
-        sum += pow(rate,x)        
-    return P0*sum
-
-def calculate_encounters(df, area):
-    base_encounters = (df["population_density_h"] * area * df["population_z"]).apply(round)
-    #decay_encounters = calculate_final_encounter(df["population_z"], df["escape_chance_z"])
-    decay_encounters = df.apply(lambda x: calculate_decay_encounter(x["population_z"], x["escape_chance_z"]), axis=1)
+def calculate_decay_encounter_array(P0:np.ndarray, rate:np.ndarray) -> np.ndarray:
+    '''
+    Encounters P0 zeds can have before fewer than half a zed is left, with rate the share
+    surviving each one: P0 times the geometric series rate^0 + ... + rate^(n-1), which is
+    (1 - rate^n) / (1 - rate). Zeds that never die (rate >= 1) have no decay bound.
+    '''
+    P0 = np.asarray(P0, dtype=float)
+    rate = np.asarray(rate, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = np.maximum(np.ceil(np.log(0.5/(P0 + 1)) / np.log(rate)), 0)
+        series = (1 - np.power(rate, n)) / (1 - rate)
+    return np.where(rate < 1, P0*series, np.inf)
+
+def calculate_encounter_array(density_h:np.ndarray, population_z:np.ndarray, escape_chance_z:np.ndarray, area:float) -> np.ndarray:
+    base_encounters = np.round(density_h * area * population_z)
+    decay_encounters = calculate_decay_encounter_array(population_z, escape_chance_z)
     return np.minimum(base_encounters, decay_encounters)
-    
-def calculate_derived_values(src_df:pd.DataFrame, settings:Settings) -> pd.DataFrame:    
-    ret_df = src_df.copy()
-    ret_df["population_density_h"] = ret_df["population_h"] / ret_df["area"]
-    ret_df["population_density_z"] = ret_df["population_z"] / ret_df["area"]
-    speed_z = settings.zed_speed * 1.609 * 24 #Convert from mph to km/day
-    area_z = speed_z * 1 * settings.encounter_distance * 3.048e-4 #km^2
-    # ret_df["escape_chance_h"] = ret_df["cumulative_encounters_h"].apply(
-    #     calculate_escape_chance, args=(
-    #         settings.initial_escape_chance_h,
-    #         settings.final_escape_chance_h,
-    #         settings.escape_learning_rate_h,
-    #         settings.escape_learning_threshold_h
-    #     )
-    ret_df["escape_chance_h"] = ret_df["cumulative_encounters_h"].apply(
-        calculate_escape_chance2, args=(
+
+class KernelParameters:
+    '''
+    Constants of the derived-values kernel that only depend on Settings
+    '''
+    def __init__(self, settings:Settings):
+        speed_z = settings.zed_speed * 1.609 * 24 #Convert from mph to km/day
+        self.area_z = speed_z * 1 * settings.encounter_distance * 3.048e-4 #km^2
+        self.escape_h = get_escape_chance_constants(
             settings.initial_escape_chance_h,
             settings.final_escape_chance_h,
             settings.escape_learning_threshold_h
         )
-    )
-    ret_df["escape_chance_z"] = ret_df["cumulative_encounters_h"].apply(
-        # calculate_escape_chance, args=(
-        #     settings.initial_escape_chance_z,
-        #     settings.final_escape_chance_z,
-        #     settings.combat_learning_rate_h,
-        #     settings.combat_learning_threshold_h
-        # )
-        calculate_escape_chance2, args=(
+        self.escape_z = get_escape_chance_constants(
             settings.initial_escape_chance_z,
             settings.final_escape_chance_z,
             settings.combat_learning_threshold_h
         )
-    )    
-    ret_df["encounters"] = calculate_encounters(ret_df, area_z) 
-    ret_df["bit_h"] = (ret_df["encounters"] * (1 - ret_df["escape_chance_h"])).apply(np.round)   
-    ret_df["bit_h"] = ret_df["bit_h"].clip(lower=0, upper=ret_df["population_h"])    
-    ret_df["killed_z"] = ret_df["population_z"] * (1 - ret_df.apply(lambda x: pow(x["escape_chance_z"], x["encounters"]), axis=1))
-    ret_df["killed_z"] = ret_df["killed_z"].apply(np.round).clip(lower=0, upper=ret_df["population_z"])
-    ret_df["migration_z"] = calculate_migration(ret_df).apply(np.round)    
+        self.migration_rounding = settings.migration_rounding
+        self.active_frontier = settings.active_frontier
+        self.border_area_z = None #Per-region override of the topology's border areas
+
+    @classmethod
+    def stack(cls, settings_list:list[Settings]) -> "KernelParameters":
+        '''
+        One set of parameters whose constants are [scenarios x 1] columns, so the kernel
+        broadcasts them over [scenarios x regions] state arrays
+        '''
+        params_list = [cls(settings) for settings in settings_list]
+        roundings = {params.migration_rounding for params in params_list}
+        if len(roundings) > 1:
+            raise ValueError("All scenarios must use the same migration_rounding")
+        ret = params_list[0]
+        ret.area_z = np.array([params.area_z for params in params_list])[:, None]
+        ret.escape_h = tuple(np.array(values)[:, None] for values in zip(*[params.escape_h for params in params_list]))
+        ret.escape_z = tuple(np.array(values)[:, None] for values in zip(*[params.escape_z for params in params_list]))
+        return ret
+
+def make_rng(settings:Settings) -> np.random.Generator:
+    return np.random.default_rng(settings.random_seed)
+
+def get_rng(src_df:pd.DataFrame, settings:Settings) -> np.random.Generator:
+    '''
+    The random generator of the run src_df is a day of, kept in attrs next to the topology.
+    Frames are built after the day's draws, so each carries on where the last day stopped.
+    '''
+    rng = src_df.attrs.get("rng")
+    if rng is None:
+        rng = src_df.attrs["rng"] = make_rng(settings)
+    return rng
+
+def calculate_derived_arrays(
+        population_h:np.ndarray,
+        population_z:np.ndarray,
+        cumulative_encounters_h:np.ndarray,
+        area:np.ndarray,
+        params:KernelParameters
+    ) -> dict[str, np.ndarray]:
+    '''
+    The derived values of every region at once. The arrays may carry leading axes, e.g.
+    [scenarios x regions] with the stacked constants of KernelParameters.stack.
+    '''
+    population_h = np.asarray(population_h, dtype=float)
+    population_z = np.asarray(population_z, dtype=float)
+    ret = {}
+    ret["population_density_h"] = population_h / area
+    ret["population_density_z"] = population_z / area
+    ret["escape_chance_h"] = calculate_escape_chance_array(cumulative_encounters_h, params.escape_h)
+    ret["escape_chance_z"] = calculate_escape_chance_array(cumulative_encounters_h, params.escape_z)
+    encounters = calculate_encounter_array(ret["population_density_h"], population_z, ret["escape_chance_z"], params.area_z)
+    ret["encounters"] = encounters
+    ret["bit_h"] = np.clip(np.round(encounters * (1 - ret["escape_chance_h"])), 0, population_h)
+    killed_z = population_z * (1 - np.power(ret["escape_chance_z"], encounters))
+    ret["killed_z"] = np.clip(np.round(killed_z), 0, population_z)
+    return ret
+
+def calculate_derived_values(src_df:pd.DataFrame, settings:Settings, rng:np.random.Generator|None = None) -> pd.DataFrame:    
+    ret_df = src_df.copy()
+    if rng is None:
+        rng = get_rng(ret_df, settings)
+    derived = calculate_derived_arrays(
+        ret_df["population_h"].to_numpy(dtype=float),
+        ret_df["population_z"].to_numpy(dtype=float),
+        ret_df["cumulative_encounters_h"].to_numpy(dtype=float),
+        ret_df["area"].to_numpy(dtype=float),
+        KernelParameters(settings)
+    )
+    for key, values in derived.items():
+        ret_df[key] = values
+    ret_df["migration_z"] = calculate_migration(ret_df, settings.migration_rounding, rng)
     return ret_df
 
 def initialize(
-        shape_gdf:gpd.GeoDataFrame,
+        shape_df:pd.DataFrame,
         neighbors_df:pd.DataFrame,
         population_df:pd.DataFrame,
         settings:Settings
     ) -> pd.DataFrame:
-    ret_df = set_features(list(shape_gdf.index))
-    zed_travel_distance = settings.zed_speed*1.609*24*1 #Convert from mph to km in 1 day
-    ret_df = calculate_static_values(ret_df, shape_gdf, neighbors_df, zed_travel_distance)  
-    ret_df = set_initial_conditions(ret_df, population_df, settings)
-    ret_df = sch.clean_df(ret_df, sch.SimulationSchema)
-    ret_df = calculate_derived_values(ret_df, settings)
+    '''
+    shape_df is an attribute table (see setup.get_inputs) or a shape frame with NAME and ALAND
+    '''
+    with instrument.timer("simulate.initialize"):
+        ret_df = set_features(list(shape_df.index))
+        ret_df = calculate_static_values(ret_df, shape_df, neighbors_df, get_zed_travel_distance(settings))  
+        ret_df = set_initial_conditions(ret_df, population_df, settings)
+        # Built from validated setup frames, so the structural checks suffice
+        ret_df = sch.clean_df(ret_df, sch.SimulationSchema, sch.pick_level(settings.schema_validation, "structural"))
+        ret_df.attrs["topology"] = Topology.from_frame(ret_df)
+        ret_df = calculate_derived_values(ret_df, settings)
     return ret_df        
 
-def time_step(src_df:pd.DataFrame, settings:Settings) -> pd.DataFrame:
-    ret_df = src_df.copy()
-    ret_df["population_h"] = ret_df["population_h"] - ret_df["bit_h"]
-    ret_df["population_h"] = ret_df["population_h"].apply(max, args=(0,))
-    ret_df["population_z"] = ret_df["population_z"] + ret_df["bit_h"] - ret_df["killed_z"] + ret_df["migration_z"]
-    ret_df["population_z"] = ret_df["population_z"].apply(max, args=(0,)) 
-    ret_df["population_d"] = ret_df["population_d"] + ret_df["killed_z"]
-    populated_mask = ret_df[ret_df["population_h"] > 0]
-    ret_df.loc[populated_mask.index,"cumulative_encounters_h"] += \
-        ret_df.loc[populated_mask.index,"encounters"] / ret_df.loc[populated_mask.index,"population_h"]
-    ret_df = calculate_derived_values(ret_df, settings)
-    return ret_df
+def derive_state(state:SimulationState, topology:Topology, params:KernelParameters, rng:np.random.Generator) -> None:
+    '''
+    With params.active_frontier only the regions that can change are computed: those with
+    zeds, their neighbors, and those whose cumulative encounters just changed. Everywhere
+    else encounters, bites, kills and migration are zero and the escape chances still hold.
+    '''
+    regions = slice(None)
+    edges = None
+    if params.active_frontier:
+        has_zeds = state.population_z > 0
+        if has_zeds.ndim > 1:
+            has_zeds = has_zeds.any(axis=0)
+        active = topology.active_regions(has_zeds)
+        active |= (state.encounters > 0) if state.encounters.ndim == 1 else (state.encounters > 0).any(axis=0)
+        regions = np.flatnonzero(active)
+        edges = topology.active_edges(has_zeds)
+        for column in ["encounters", "bit_h", "killed_z"]:
+            getattr(state, column)[...] = 0
+    instrument.count("simulate.kernel_evaluations")
+    with instrument.timer("simulate.derived_values"):
+        derived = calculate_derived_arrays(
+            state.population_h[..., regions],
+            state.population_z[..., regions],
+            state.cumulative_encounters_h[..., regions],
+            topology.area[regions],
+            params
+        )
+        for column in ["escape_chance_h", "escape_chance_z", "encounters", "bit_h", "killed_z"]:
+            getattr(state, column)[..., regions] = derived[column]
+    with instrument.timer("simulate.migration"):
+        state.migration_z[:] = topology.migration(
+            state.population_z,
+            state.killed_z,
+            params.migration_rounding,
+            rng,
+            params.border_area_z,
+            edges
+        )
+
+def derive_initial_state(state:SimulationState, topology:Topology, params:KernelParameters, rng:np.random.Generator) -> None:
+    '''
+    derive_state over every region, for a day-0 state from initial_state. The active frontier
+    keeps the escape chances of the regions it skips, so they have to be computed once first.
+    '''
+    full_params = copy.copy(params)
+    full_params.active_frontier = False
+    derive_state(state, topology, full_params, rng)
 
-def run(initial_df:pd.DataFrame, settings:Settings) -> list[pd.DataFrame]:
-    intial_population = sum(initial_df["population_h"]) + sum(initial_df["population_z"]) + sum(initial_df["population_d"])
-    df_0 = initial_df.copy()
-    data = [df_0]
-    for i in range(settings.simulation_length): 
-        if i % 5 == 0:
+def update_populations(state:SimulationState) -> None:
+    '''
+    Applies the day's bites, kills and migration held in state
+    '''
+    with instrument.timer("simulate.population_update"):
+        np.maximum(state.population_h - state.bit_h, 0, out=state.population_h, casting="unsafe")
+        np.maximum(state.population_z + state.bit_h - state.killed_z + state.migration_z, 0, out=state.population_z, casting="unsafe")
+        np.add(state.population_d, state.killed_z, out=state.population_d, casting="unsafe")
+        populated = state.population_h > 0
+        state.cumulative_encounters_h[populated] += state.encounters[populated] / state.population_h[populated]
+
+def advance_state(state:SimulationState, topology:Topology, params:KernelParameters, rng:np.random.Generator) -> None:
+    '''
+    Moves state forward one day in place
+    '''
+    update_populations(state)
+    derive_state(state, topology, params, rng)
+
+def time_step(src_df:pd.DataFrame, settings:Settings, rng:np.random.Generator|None = None) -> pd.DataFrame:
+    if rng is None:
+        rng = get_rng(src_df, settings)
+    state = SimulationState.from_frame(src_df)
+    advance_state(state, get_topology(src_df), KernelParameters(settings), rng)
+    return build_frame(static_frame(src_df), state.as_dict())
+
+def initial_state(population_h:pd.Series, settings:Settings) -> SimulationState:
+    '''
+    Day-0 populations (census humans plus the settings' outbreak) with nothing derived yet
+    '''
+    df = pd.DataFrame({"population_h": population_h, "population_z": 0.0})
+    df = outbreak(df, settings.outbreak_region, settings.outbreak_size)
+    arrays = {column:np.zeros(len(df)) for column in DYNAMIC_COLUMNS}
+    arrays["population_h"] = df["population_h"].to_numpy()
+    # Truncates fractional outbreaks the same way the SimulationSchema coercion does
+    arrays["population_z"] = df["population_z"].to_numpy().astype(np.int64)
+    return SimulationState(arrays)
+
+def check_conservation(state:SimulationState, intial_population:int, day:int, settings:Settings) -> None:
+    '''
+    Raises if the total population has drifted. Runs every settings.conservation_check_interval
+    days, or never if that is 0.
+    '''
+    interval = settings.conservation_check_interval
+    if interval <= 0 or day % interval != 0:
+        return
+    with instrument.timer("simulate.conservation_check"):
+        total_population = state.total_population()
+    if total_population != intial_population:
+        raise RuntimeError(f"Population has changed by {total_population - intial_population}")
+
+def iterate_state(
+        topology:Topology,
+        state:SimulationState,
+        settings:Settings,
+        verbose:bool = True,
+        rng:np.random.Generator|None = None,
+        start_day:int = 0
+    ) -> Iterator[tuple[int, SimulationState]]:
+    '''
+    Yields (day, state) for start_day and every simulated day after it. The same state
+    object is advanced in place, so copy anything that has to outlive the next iteration.
+    '''
+    params = KernelParameters(settings)
+    rng = rng if rng is not None else make_rng(settings)
+    intial_population = state.total_population()
+    yield start_day, state
+    for i in range(start_day, settings.simulation_length): 
+        if verbose and i % 5 == 0:
             print(f"Day {i} of simulation.")       
-        df_1 = time_step(df_0, settings)
-        total_population = sum(df_1["population_h"]) + sum(df_1["population_z"]) + sum(df_1["population_d"])
-        if total_population != intial_population:
-            raise RuntimeError(f"Population has changed by {total_population - intial_population}")
-        df_0 = df_1.copy()
-        data.append(df_0)
+        advance_state(state, topology, params, rng)
+        check_conservation(state, intial_population, i + 1, settings)
+        yield i + 1, state
+
+def iterate_mixed(
+        topology:Topology,
+        state:SimulationState,
+        settings:Settings,
+        verbose:bool = True,
+        rng:np.random.Generator|None = None,
+        start_day:int = 0
+    ) -> Iterator[tuple[int, SimulationState]]:
+    '''
+    Same contract as iterate_state, with topology and state at county resolution, but the
+    kernels run on a hierarchy.Hierarchy where every state without zeds in or next to it
+    is a single node. States are split into their counties as the outbreak reaches them,
+    before the day's migration is worked out, so the results are the county results.
+    '''
+    params = KernelParameters(settings)
+    rng = rng if rng is not None else make_rng(settings)
+    intial_population = state.total_population()
+    mixed = hierarchy.Hierarchy(topology, get_zed_travel_distance(settings))
+    mixed.refine_around(state)
+    nodes = mixed.gather(state)
+    yield start_day, state
+    for i in range(start_day, settings.simulation_length):
+        if verbose and i % 5 == 0:
+            print(f"Day {i} of simulation.")
+        update_populations(nodes)
+        states = mixed.states_to_refine(nodes.population_z > 0)
+        if len(states) > 0:
+            with instrument.timer("simulate.refine"):
+                mixed.scatter(nodes, state)
+                mixed.refine(states)
+                nodes = mixed.gather(state)
+            instrument.count("simulate.refined_states", len(states))
+        derive_state(nodes, mixed.topology, params, rng)
+        mixed.scatter(nodes, state)
+        check_conservation(state, intial_population, i + 1, settings)
+        yield i + 1, state
+
+def population_rates(state:SimulationState) -> np.ndarray:
+    '''
+    Daily change of population_h, population_z and population_d implied by the derived
+    values of state, as a [3 x regions] array
+    '''
+    return np.stack([
+        -state.bit_h,
+        state.bit_h - state.killed_z + state.migration_z,
+        state.killed_z
+    ])
+
+def step_state(
+        state:SimulationState,
+        dt:int,
+        topology:Topology,
+        params:KernelParameters,
+        rng:np.random.Generator
+    ) -> SimulationState|None:
+    '''
+    Leaps dt whole days by repeating the daily changes held in state, returning a new
+    state with its own derived values. With dt == 1 this is exactly advance_state. A longer
+    leap that would take a population below zero returns None: clamping it would change
+    the total population.
+    '''
+    population_h = state.population_h - dt*state.bit_h
+    population_z = state.population_z + dt*(state.bit_h - state.killed_z + state.migration_z)
+    if dt > 1 and ((population_h < 0).any() or (population_z < 0).any()):
+        return None
+    arrays = state.as_dict()
+    arrays["population_h"] = np.maximum(population_h, 0)
+    arrays["population_z"] = np.maximum(population_z, 0)
+    arrays["population_d"] = state.population_d + dt*state.killed_z
+    ret = SimulationState(arrays)
+    populated = ret.population_h > 0
+    ret.cumulative_encounters_h[populated] += dt*state.encounters[populated] / ret.population_h[populated]
+    derive_state(ret, topology, params, rng)
+    return ret
+
+def step_error(state:SimulationState, candidate:SimulationState, dt:int, tolerance:float) -> float:
+    '''
+    Error of a leap relative to the tolerance, estimated against the trapezoid rule over
+    the daily changes at both ends. Leaps with an error above 1 are rejected.
+    '''
+    before = np.stack([state.population_h, state.population_z, state.population_d])
+    after = np.stack([candidate.population_h, candidate.population_z, candidate.population_d])
+    local_error = dt/2 * np.abs(population_rates(candidate) - population_rates(state))
+    scale = ADAPTIVE_ABSOLUTE_TOLERANCE + tolerance*np.maximum(before, after)
+    return float(np.max(local_error / scale))
+
+def sample_state(start:SimulationState, end:SimulationState, weight:float, total_population:int, out:SimulationState) -> None:
+    '''
+    Writes the day weight of the way through a leap into out, with populations rounded to
+    whole people that still add up to total_population
+    '''
+    for column in DYNAMIC_COLUMNS:
+        if column not in POPULATION_COLUMNS:
+            getattr(out, column)[...] = (1 - weight)*getattr(start, column) + weight*getattr(end, column)
+    populations = np.concatenate([(1 - weight)*getattr(start, column) + weight*getattr(end, column) for column in POPULATION_COLUMNS])
+    populations = utils.round_preserving_sum(populations, total_population)
+    for column, values in zip(POPULATION_COLUMNS, np.split(populations, len(POPULATION_COLUMNS))):
+        getattr(out, column)[...] = values
+    for column in ["bit_h", "killed_z"]:
+        np.round(getattr(out, column), out=getattr(out, column))
+    out.migration_z[...] = utils.round_preserving_sum(out.migration_z, 0)
+
+def iterate_adaptive(
+        topology:Topology,
+        state:SimulationState,
+        settings:Settings,
+        verbose:bool = True,
+        rng:np.random.Generator|None = None,
+        start_day:int = 0
+    ) -> Iterator[tuple[int, SimulationState]]:
+    '''
+    Same contract as iterate_state, but while the daily changes hold steady it leaps up to
+    settings.max_time_step days per kernel evaluation. A leap is accepted when its
+    estimated relative error is below settings.step_tolerance, otherwise it is shortened,
+    down to the exact single day. Leaps that would empty a region below zero fall straight
+    back to the single day. The days inside a leap are interpolated linearly.
+
+    The model is a daily map (a day's bites and kills are outcomes, not rates), so there
+    is no step shorter than a day: swings are stepped exactly, one day at a time.
+    '''
+    params = KernelParameters(settings)
+    rng = rng if rng is not None else make_rng(settings)
+    intial_population = state.total_population()
+    current = state.copy()
+    day = start_day
+    dt = 1
+    yield start_day, state
+    while day < settings.simulation_length:
+        dt = min(dt, settings.simulation_length - day)
+        candidate = step_state(current, dt, topology, params, rng)
+        if candidate is None:
+            # The leap overshoots a near-empty region, so the day is stepped exactly
+            dt = 1
+            continue
+        error = step_error(current, candidate, dt, settings.step_tolerance)
+        factor = min(2.0, 0.9 * error ** -0.5) if error > 0 else 2.0
+        if error > 1 and dt > 1:
+            dt = max(int(dt * factor), 1)
+            continue
+        start = day
+        for day in range(start + 1, start + dt + 1):
+            if verbose and (day - 1) % 5 == 0:
+                print(f"Day {day - 1} of simulation.")
+            if day == start + dt:
+                for column in DYNAMIC_COLUMNS:
+                    getattr(state, column)[...] = getattr(candidate, column)
+            else:
+                sample_state(current, candidate, (day - start) / dt, intial_population, state)
+            check_conservation(state, intial_population, day, settings)
+            yield day, state
+        current = candidate
+        dt = min(max(int(dt * factor), 1), settings.max_time_step)
+
+def get_iterator(settings:Settings):
+    mixed = settings.simulation_resolution.lower() == "mixed"
+    match settings.time_stepping:
+        case "fixed":
+            return iterate_mixed if mixed else iterate_state
+        case "adaptive":
+            if mixed:
+                raise ValueError(MIXED_TIME_STEPPING_ERROR_MESSAGE)
+            return iterate_adaptive
+        case _:
+            raise ValueError(TIME_STEPPING_ERROR_MESSAGE)
+
+class StopCriteria:
+    '''
+    Decides when a run can end before simulation_length. check() returns one of the
+    STOP_* reason codes, or None to keep going.
+    '''
+    def __init__(self, settings:Settings):
+        self.settings = settings
+        self.start_time = time.perf_counter()
+        self.previous = None
+        self.quiet_days = 0
+
+    def check(self, day:int, state:SimulationState) -> str|None:
+        settings = self.settings
+        if settings.stop_when_no_zeds and not state.population_z.any():
+            return STOP_NO_ZEDS
+        if settings.stop_when_no_humans and not state.population_h.any():
+            return STOP_NO_HUMANS
+        if settings.wall_clock_budget is not None and time.perf_counter() - self.start_time > settings.wall_clock_budget:
+            return STOP_TIME_BUDGET
+        if settings.steady_state_tolerance > 0:
+            current = np.concatenate([state.population_h, state.population_z, state.population_d]).astype(float)
+            if self.previous is not None:
+                change = np.max(np.abs(current - self.previous) / np.maximum(self.previous, 1))
+                self.quiet_days = self.quiet_days + 1 if change < settings.steady_state_tolerance else 0
+            self.previous = current
+            if self.quiet_days >= settings.steady_state_days:
+                return STOP_STEADY_STATE
+        return None
+
+    def extend(self, state:SimulationState) -> None:
+        '''
+        Takes in the regions attached to a bounded run (see domain.py) on the last checked day
+        '''
+        if self.previous is not None:
+            self.previous = np.concatenate([state.population_h, state.population_z, state.population_d]).astype(float)
+
+def run_state(
+        topology:Topology,
+        state:SimulationState,
+        static_df:pd.DataFrame,
+        settings:Settings,
+        sinks:list|None = None,
+        verbose:bool = True,
+        checkpointer=None,
+        domain=None
+    ) -> Trajectory|None:
+    data = None
+    if sinks is None:
+        data = Trajectory()
+        sinks = [data]
+    for sink in sinks:
+        sink.start(static_df, settings.simulation_length + 1)
+    continue_run(topology, state, static_df, settings, sinks, make_rng(settings), StopCriteria(settings), verbose=verbose, checkpointer=checkpointer, domain=domain)
     return data
 
-def summarize(simulation:list[pd.DataFrame]) -> pd.DataFrame:
-    summary = []
-    for day in range(len(simulation)):
-        total_h = sum(simulation[day]['population_h'])
-        total_z = sum(simulation[day]['population_z'])
-        summary.append({
-            "day": day,
-            "population_h_log10": utils.safe_log10(total_h),
-            "population_z_log10": utils.safe_log10(total_z)
-        })
-    return pd.DataFrame.from_records(summary, index="day")
+def continue_run(
+        topology:Topology,
+        state:SimulationState,
+        static_df:pd.DataFrame,
+        settings:Settings,
+        sinks:list,
+        rng:np.random.Generator,
+        stop_criteria:StopCriteria,
+        start_day:int = 0,
+        resumed:bool = False,
+        verbose:bool = True,
+        checkpointer=None,
+        domain=None
+    ) -> None:
+    '''
+    Steps state from start_day to the end of the run and closes the sinks. A resumed run
+    (see checkpoint.py) has already recorded and checked start_day. The checkpointer, if
+    any, sees every day and saves the last completed one if the run raises or is
+    interrupted. A domain.Domain grows the region set whenever the zeds near its edge;
+    the sinks are then extended and the run carries on from the same day.
+    '''
+    if checkpointer is not None:
+        checkpointer.start(topology, static_df, settings, sinks, resumed)
+    stop_reason = STOP_COMPLETED
+    try:
+        growing = True
+        while growing:
+            growing = False
+            for day, day_state in get_iterator(settings)(topology, state, settings, verbose, rng, start_day):
+                reason = None
+                if not resumed or day > start_day:
+                    instrument.count("simulate.days")
+                    with instrument.timer("simulate.sinks"):
+                        for sink in sinks:
+                            sink.record(day, day_state)
+                    reason = stop_criteria.check(day, day_state)
+                if reason is not None and day < settings.simulation_length:
+                    stop_reason = reason
+                    if verbose:
+                        print(f"Stopping on day {day}: {reason}")
+                    break
+                if checkpointer is not None:
+                    checkpointer.track(day, day_state, rng, stop_criteria)
+                if domain is not None and day < settings.simulation_length and domain.needs_growth(topology, day_state):
+                    growing = True
+                    break
+            if growing:
+                topology, state, static_df = domain.grow(topology, day_state, static_df)
+                day_state = state
+                if verbose:
+                    print(f"Domain grown to {len(domain)} regions on day {day}")
+                for sink in sinks:
+                    sink.extend(static_df, state)
+                stop_criteria.extend(state)
+                if checkpointer is not None:
+                    checkpointer.start(topology, static_df, settings, sinks, resumed=True)
+                start_day = day
+                resumed = True
+    except BaseException:
+        if checkpointer is not None:
+            checkpointer.save_failure(state)
+        raise
+    if settings.pad_stopped_runs:
+        # Repeat the final day so every consumer still sees simulation_length days
+        for padded_day in range(day + 1, settings.simulation_length + 1):
+            for sink in sinks:
+                sink.record(padded_day, day_state)
+    for sink in sinks:
+        sink.close(stop_reason)
+
+def run(
+        initial_df:pd.DataFrame,
+        settings:Settings,
+        sinks:list|None = None,
+        checkpointer=None,
+        domain=None
+    ) -> Trajectory|None:
+    '''
+    Streams every day to the sinks (see sinks.py). Without sinks the whole run is kept in
+    a Trajectory, which is returned. Pass a checkpoint.Checkpointer to save the run
+    periodically and on failure, so it can be picked up again with checkpoint.resume.
+    For a bounded run, initial_df is built from domain.data() (see setup.get_domain).
+    '''
+    return run_state(
+        get_topology(initial_df),
+        SimulationState.from_frame(initial_df),
+        static_frame(initial_df),
+        settings,
+        sinks,
+        checkpointer=checkpointer,
+        domain=domain
+    )
+
+def population_totals(simulation:Trajectory|SummarySink|list[pd.DataFrame], column:str) -> list:
+    if isinstance(simulation, SummarySink):
+        return simulation.totals[column]
+    if isinstance(simulation, Trajectory):
+        return list(simulation.column(column).sum(axis=1))
+    return [sum(df[column]) for df in simulation]
+
+def summarize(simulation:Trajectory|SummarySink|list[pd.DataFrame]) -> pd.DataFrame:
+    return summary_frame(population_totals(simulation, "population_h"), population_totals(simulation, "population_z"))
+
+def print_report(settings:Settings, simulation_data, simulation_summary) -> None:
+    '''
+    Prints the population totals of a run, from its summarize() frame. simulation_data is
+    whatever holds its days, e.g. a KeyframeSink, and is only checked for being non-empty.
+    '''
+    if not simulation_data or type(simulation_summary) is not pd.DataFrame:
+        print(NO_SIM_MESSAGE_REPORT)
+        return
+    print(f"Initial population: {round(pow(10,simulation_summary.at[0,'population_h_log10'])):,d}")
+    print(f"Final population: {round(pow(10,simulation_summary['population_h_log10'].iloc[-1])):,d}")
+    print(f"Maximum zed population: {round(pow(10,simulation_summary['population_z_log10'].max())):,d}")
 
 if __name__ == "__main__":
     import setup
@@ -233,6 +712,6 @@ if __name__ == "__main__":
     my_filepaths = Filepaths()
     my_settings.outbreak_region = ["53003"]
     my_settings.simulation_resolution = "county"
-    shape_gdf, nieghbors_df, population_df = setup.main(my_settings, my_filepaths)
-    initial_df = initialize(shape_gdf, nieghbors_df, population_df, my_settings)
+    attribute_df, nieghbors_df, population_df = setup.get_inputs(my_settings, my_filepaths)
+    initial_df = initialize(attribute_df, nieghbors_df, population_df, my_settings)
     print(initial_df.loc["53003"])
\ No newline at end of file
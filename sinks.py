@@ -0,0 +1,279 @@
+'''
+Consumers for the days streamed by simulate.run.
+
+A sink implements start(static_df, days) before the first day, record(day, state) for
+every simulated day and close(stop_reason) after the last one, with one of the
+simulate.STOP_* reason codes. The SimulationState passed to record
+is advanced in place by the simulation, so sinks copy whatever they keep.
+
+Sinks that can be checkpointed (see checkpoint.py) also implement snapshot(), returning
+their contents as a dict of arrays, and restore(static_df, days, snapshot, day), which
+starts the sink again holding every day up to and including day.
+
+Sinks used by bounded runs (see domain.py) implement extend(static_df, state) as well.
+static_df lists the regions recorded so far followed by the newly attached ones, whose
+values in state have held since day 0 and are filled in for every recorded day.
+'''
+from config import Filepaths, Settings
+import numpy as np
+import os
+import pandas as pd
+from state import DYNAMIC_COLUMNS, POPULATION_COLUMNS, SimulationState, Trajectory, column_dtype
+import utils
+
+TIME_PROGRESSION_ERROR_MESSAGE = "TIME_PROGRESSION must be 'lin' or 'log'"
+
+def summary_frame(totals_h:list, totals_z:list) -> pd.DataFrame:
+    summary = []
+    for day, (total_h, total_z) in enumerate(zip(totals_h, totals_z)):
+        summary.append({
+            "day": day,
+            "population_h_log10": utils.safe_log10(total_h),
+            "population_z_log10": utils.safe_log10(total_z)
+        })
+    return pd.DataFrame.from_records(summary, index="day")
+
+class SummarySink:
+    '''
+    Keeps only the daily population totals
+    '''
+    def __init__(self):
+        self.totals = {column:[] for column in POPULATION_COLUMNS}
+        self.regions = 0
+        self.stop_reason = None
+
+    def __len__(self) -> int:
+        return len(self.totals["population_h"])
+
+    def start(self, static_df:pd.DataFrame, days:int) -> None:
+        self.totals = {column:[] for column in POPULATION_COLUMNS}
+        self.regions = len(static_df)
+
+    def record(self, day:int, state:SimulationState) -> None:
+        for column in POPULATION_COLUMNS:
+            self.totals[column].append(int(getattr(state, column).sum()))
+
+    def close(self, stop_reason:str) -> None:
+        self.stop_reason = stop_reason
+
+    def extend(self, static_df:pd.DataFrame, state:SimulationState) -> None:
+        for column in POPULATION_COLUMNS:
+            added = int(getattr(state, column)[self.regions:].sum())
+            self.totals[column] = [total + added for total in self.totals[column]]
+        self.regions = len(static_df)
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        return {column:np.array(totals, dtype=np.int64) for column, totals in self.totals.items()}
+
+    def restore(self, static_df:pd.DataFrame, days:int, snapshot:dict[str, np.ndarray], day:int) -> None:
+        self.start(static_df, days)
+        self.totals = {column:snapshot[column][:day + 1].tolist() for column in POPULATION_COLUMNS}
+
+    def summary(self) -> pd.DataFrame:
+        return summary_frame(self.totals["population_h"], self.totals["population_z"])
+
+class KeyframeSink:
+    '''
+    Keeps the selected columns for a fixed set of days, e.g. the animation key frames
+    '''
+    def __init__(self, days:list[int], columns:tuple[str] = ("population_h", "population_z")):
+        self.requested_days = sorted(set(days))
+        self.columns = list(columns)
+        self.frames = {}
+        self.latest = None
+        self.index = None
+        self.stop_reason = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @property
+    def days(self) -> list[int]:
+        return sorted(self.frames)
+
+    def start(self, static_df:pd.DataFrame, days:int) -> None:
+        self.index = static_df.index
+        self.frames = {}
+        self.latest = None
+
+    def record(self, day:int, state:SimulationState) -> None:
+        self.latest = (day, {column:getattr(state, column).copy() for column in self.columns})
+        if day in self.requested_days:
+            self.frames[day] = self.latest[1]
+
+    def close(self, stop_reason:str) -> None:
+        # A run that stopped early still ends on its final day
+        if self.latest is not None:
+            self.frames.setdefault(*self.latest)
+        self.stop_reason = stop_reason
+
+    def extend(self, static_df:pd.DataFrame, state:SimulationState) -> None:
+        count = len(self.index)
+        self.index = static_df.index
+        frames = list(self.frames.values()) + ([self.latest[1]] if self.latest is not None else [])
+        # The latest day is usually also a key frame, held in the same dict
+        for frame in {id(frame):frame for frame in frames}.values():
+            for column in self.columns:
+                frame[column] = np.concatenate((frame[column], getattr(state, column)[count:]))
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        days = self.days
+        snapshot = {"days":np.array(days, dtype=np.int64)}
+        for column in self.columns:
+            snapshot[column] = np.array([self.frames[day][column] for day in days], dtype=column_dtype(column)).reshape(len(days), len(self.index))
+        if self.latest is not None:
+            snapshot["latest_day"] = np.array(self.latest[0])
+            for column in self.columns:
+                snapshot[f"latest_{column}"] = self.latest[1][column]
+        return snapshot
+
+    def restore(self, static_df:pd.DataFrame, days:int, snapshot:dict[str, np.ndarray], day:int) -> None:
+        self.start(static_df, days)
+        for i, frame_day in enumerate(snapshot["days"].tolist()):
+            if frame_day <= day:
+                self.frames[frame_day] = {column:snapshot[column][i].copy() for column in self.columns}
+        if "latest_day" in snapshot and int(snapshot["latest_day"]) <= day:
+            self.latest = (int(snapshot["latest_day"]), {column:snapshot[f"latest_{column}"].copy() for column in self.columns})
+
+    def frame(self, day:int) -> pd.DataFrame:
+        return pd.DataFrame(self.frames[day], index=self.index)
+
+    def matrix(self, column:str, days:list[int]|None = None) -> np.ndarray:
+        '''
+        column on the given days (default: every kept day) as one [days x regions] array
+        '''
+        days = self.days if days is None else days
+        return np.stack([self.frames[day][column] for day in days])
+
+class ColumnarSink:
+    '''
+    Writes every day to one memory-mapped .npy file per column, so a run of any length
+    only holds a single day in memory. Read it back with load_columnar.
+    '''
+    STATIC_FILENAME = "static.csv"
+    META_FILENAME = "meta.json"
+
+    def __init__(self, directory:str, columns:tuple[str] = tuple(DYNAMIC_COLUMNS), flush_interval:int = 30):
+        self.directory = directory
+        self.columns = list(columns)
+        self.flush_interval = flush_interval
+        self.arrays = {}
+        self.days = 0
+        self.stop_reason = None
+
+    def __len__(self) -> int:
+        return self.days
+
+    def write_static(self, static_df:pd.DataFrame) -> None:
+        static_df.drop(columns="neighbors", errors="ignore").reset_index(names="id").to_csv(
+            os.path.join(self.directory, self.STATIC_FILENAME), index=False)
+
+    def start(self, static_df:pd.DataFrame, days:int) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self.write_static(static_df)
+        self.arrays = {
+            column:np.lib.format.open_memmap(
+                os.path.join(self.directory, f"{column}.npy"),
+                mode="w+",
+                dtype=column_dtype(column),
+                shape=(days, len(static_df))
+            )
+            for column in self.columns
+        }
+        self.days = 0
+
+    def record(self, day:int, state:SimulationState) -> None:
+        for column in self.columns:
+            self.arrays[column][day] = getattr(state, column)
+        self.days = day + 1
+        if self.days % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self, stop_reason:str) -> None:
+        self.flush()
+        self.stop_reason = stop_reason
+        meta = {"days":self.days, "columns":self.columns, "stop_reason":stop_reason}
+        utils.write_json_file(meta, os.path.join(self.directory, self.META_FILENAME))
+        self.arrays = {}
+
+    def resize(self, static_df:pd.DataFrame, state:SimulationState|None = None) -> None:
+        '''
+        Rewrites the files with one column per region of static_df, keeping the columns
+        of the regions they share and filling any new ones from state
+        '''
+        self.write_static(static_df)
+        for column in self.columns:
+            values = self.arrays[column]
+            count = min(values.shape[1], len(static_df))
+            filename = os.path.join(self.directory, f"{column}.npy")
+            resized = np.lib.format.open_memmap(filename + ".tmp", mode="w+", dtype=values.dtype, shape=(len(values), len(static_df)))
+            resized[:, :count] = values[:, :count]
+            if state is not None:
+                resized[:, count:] = getattr(state, column)[count:]
+            resized.flush()
+            os.replace(filename + ".tmp", filename)
+            self.arrays[column] = resized
+
+    def extend(self, static_df:pd.DataFrame, state:SimulationState) -> None:
+        self.resize(static_df, state)
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        # The recorded days are already on disk
+        self.flush()
+        return {}
+
+    def restore(self, static_df:pd.DataFrame, days:int, snapshot:dict[str, np.ndarray], day:int) -> None:
+        self.arrays = {
+            column:np.load(os.path.join(self.directory, f"{column}.npy"), mmap_mode="r+")
+            for column in self.columns
+        }
+        # A bounded run may have grown past the checkpointed regions before it stopped
+        if len(next(iter(self.arrays.values()))[0]) != len(static_df):
+            self.resize(static_df)
+        self.days = day + 1
+
+def load_columnar(directory:str) -> Trajectory:
+    '''
+    Opens a ColumnarSink directory as a Trajectory backed by read-only memory maps
+    '''
+    meta = utils.read_json_file(os.path.join(directory, ColumnarSink.META_FILENAME))
+    static_df = pd.read_csv(os.path.join(directory, ColumnarSink.STATIC_FILENAME), dtype={"id":str}).set_index("id")
+    data = {
+        column:np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")[:meta["days"]]
+        for column in meta["columns"]
+    }
+    trajectory = Trajectory(static_df, data)
+    trajectory.stop_reason = meta.get("stop_reason")
+    return trajectory
+
+def get_key_frames(settings:Settings, data_length:int) -> list[int]:
+    total_frames = round(settings.fps * settings.animation_duration + 1)
+    match settings.time_progression:
+        case "lin":
+            return utils.calculate_key_frames_linear(data_length, total_frames)
+        case "log":
+            return utils.calculate_key_frames_logarithmic(data_length, total_frames)
+        case _:
+            raise ValueError(TIME_PROGRESSION_ERROR_MESSAGE)
+
+def get_recorded_days(settings:Settings) -> list[int]:
+    '''
+    Days that show_frame and make_animation will draw, i.e. what a KeyframeSink has to keep
+    '''
+    days = get_key_frames(settings, settings.simulation_length + 1)
+    return sorted(set(days + [min(settings.image_frame, settings.simulation_length)]))
+
+def get_sinks(settings:Settings, filepaths:Filepaths) -> list:
+    '''
+    The [SummarySink, KeyframeSink, ColumnarSink] of the interactive and headless runs.
+    Both entry points use the same sinks, so each can resume the checkpoints of the other.
+    '''
+    return [
+        SummarySink(),
+        KeyframeSink(get_recorded_days(settings)),
+        ColumnarSink(filepaths.last_simulation_directory)
+    ]
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+POPULATION_COLUMNS = ["population_h", "population_z", "population_d"]
+DYNAMIC_COLUMNS = POPULATION_COLUMNS + [
+    "encounters",
+    "escape_chance_h",
+    "escape_chance_z",
+    "cumulative_encounters_h",
+    "bit_h",
+    "killed_z",
+    "migration_z"
+]
+STATIC_COLUMNS = ["name", "border_length", "area", "border_area_z", "neighbors"]
+FRAME_COLUMNS = ["name"] + DYNAMIC_COLUMNS + STATIC_COLUMNS[1:]
+
+class SimulationState:
+    '''
+    Dynamic per-region values of one simulated day, one contiguous array per column.
+    Populations are integer counts, everything else is float.
+    '''
+    def __init__(self, arrays:dict[str, np.ndarray]):
+        for column in DYNAMIC_COLUMNS:
+            dtype = np.int64 if column in POPULATION_COLUMNS else float
+            setattr(self, column, np.array(arrays[column], dtype=dtype))
+
+    def __len__(self) -> int:
+        return len(self.population_h)
+
+    @classmethod
+    def from_frame(cls, df:pd.DataFrame) -> "SimulationState":
+        return cls({column:df[column].to_numpy() for column in DYNAMIC_COLUMNS})
+
+    def copy(self) -> "SimulationState":
+        return SimulationState(self.as_dict())
+
+    def as_dict(self) -> dict[str, np.ndarray]:
+        return {column:getattr(self, column) for column in DYNAMIC_COLUMNS}
+
+    def total_population(self) -> int:
+        return int(sum(getattr(self, column).sum() for column in POPULATION_COLUMNS))
+
+def region_attributes(shape_df:pd.DataFrame) -> pd.DataFrame:
+    '''
+    The attribute table the simulation reads from a shape frame: name, land area (km^2)
+    and state_fp of every region, on the same index. Attribute tables are returned as they are.
+    '''
+    if "area" in shape_df.columns:
+        return shape_df
+    return pd.DataFrame({
+        "name":shape_df["NAME"],
+        "area":shape_df["ALAND"] * 1e-6,
+        "state_fp":shape_df["STATEFP"]
+    }, index=shape_df.index)
+
+def static_frame(df:pd.DataFrame) -> pd.DataFrame:
+    return df[[column for column in STATIC_COLUMNS if column in df.columns]]
+
+def build_frame(static_df:pd.DataFrame, arrays:dict[str, np.ndarray]) -> pd.DataFrame:
+    '''
+    Reassembles the DataFrame layout the rest of the code expects (SimulationSchema
+    columns plus the population densities) from the static columns and one day of state
+    '''
+    data = {}
+    for column in FRAME_COLUMNS:
+        if column in arrays:
+            data[column] = arrays[column]
+        elif column in static_df.columns:
+            data[column] = static_df[column].to_numpy()
+    df = pd.DataFrame(data, index=static_df.index)
+    df.attrs = dict(static_df.attrs)
+    df["population_density_h"] = df["population_h"] / df["area"]
+    df["population_density_z"] = df["population_z"] / df["area"]
+    return df
+
+def column_dtype(column:str) -> type:
+    return np.int64 if column in POPULATION_COLUMNS else float
+
+class Trajectory:
+    '''
+    Every recorded day of a run in preallocated [days x regions] arrays.
+
+    Behaves like the list[DataFrame] that simulate.run used to return: len(), indexing and
+    iteration build a day's DataFrame on demand, while column() exposes the raw matrix.
+    It is also the default sink of simulate.run (see sinks.py for the sink interface).
+    '''
+    def __init__(self, static_df:pd.DataFrame|None = None, data:dict[str, np.ndarray]|None = None):
+        self.static_df = static_df
+        self.data = data or {}
+        self.days = len(next(iter(self.data.values()))) if self.data else 0
+        self.stop_reason = None
+
+    def __len__(self) -> int:
+        return self.days
+
+    def __getitem__(self, day:int) -> pd.DataFrame:
+        if day < 0:
+            day += self.days
+        if day < 0 or day >= self.days:
+            raise IndexError("Trajectory index out of range")
+        return build_frame(self.static_df, self.state(day).as_dict())
+
+    @property
+    def index(self) -> pd.Index:
+        return self.static_df.index
+
+    def start(self, static_df:pd.DataFrame, days:int) -> None:
+        self.static_df = static_df
+        self.days = 0
+        self.data = {column:np.zeros((days, len(static_df)), dtype=column_dtype(column)) for column in DYNAMIC_COLUMNS}
+
+    def record(self, day:int, state:SimulationState) -> None:
+        for column in DYNAMIC_COLUMNS:
+            self.data[column][day] = getattr(state, column)
+        self.days = day + 1
+
+    def close(self, stop_reason:str) -> None:
+        self.stop_reason = stop_reason
+
+    def extend(self, static_df:pd.DataFrame, state:SimulationState) -> None:
+        count = len(self.static_df)
+        self.static_df = static_df
+        for column in DYNAMIC_COLUMNS:
+            added = np.broadcast_to(getattr(state, column)[count:], (len(self.data[column]), len(static_df) - count))
+            self.data[column] = np.concatenate((self.data[column], added), axis=1)
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        return {column:values[:self.days] for column, values in self.data.items()}
+
+    def restore(self, static_df:pd.DataFrame, days:int, snapshot:dict[str, np.ndarray], day:int) -> None:
+        self.start(static_df, days)
+        for column in DYNAMIC_COLUMNS:
+            self.data[column][:day + 1] = snapshot[column][:day + 1]
+        self.days = day + 1
+
+    def state(self, day:int) -> SimulationState:
+        return SimulationState({column:values[day] for column, values in self.data.items()})
+
+    def column(self, column:str) -> np.ndarray:
+        return self.data[column][:self.days]
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import simulate
+
+@pytest.fixture(scope="session")
+def region_set():
+    '''
+    A small synthetic (shape_gdf, neighbors_df, population_df) triple (see benchmark.make_region_set)
+    '''
+    return benchmark.make_region_set(120, "grid")
+
+@pytest.fixture
+def settings(region_set):
+    settings = benchmark.get_settings(region_set[0])
+    settings.simulation_length = 15
+    return settings
+
+@pytest.fixture
+def initial_df(region_set, settings):
+    return simulate.initialize(*region_set, settings)
@@ -0,0 +1,34 @@
+import numpy as np
+
+import simulate
+from state import SimulationState
+
+def test_leap_past_an_empty_region_is_rejected(settings, initial_df):
+    topology = simulate.get_topology(initial_df)
+    params = simulate.KernelParameters(settings)
+    state = SimulationState.from_frame(initial_df)
+    # A near-empty region whose daily bites would take more people than it has within the leap
+    state.population_h[0] = 3
+    state.bit_h[0] = 1
+    state.population_z[1] = 1
+    state.killed_z[1] = 1
+    assert simulate.step_state(state, 7, topology, params, simulate.make_rng(settings)) is None
+    exact = state.copy()
+    simulate.advance_state(exact, topology, params, simulate.make_rng(settings))
+    stepped = simulate.step_state(state, 1, topology, params, simulate.make_rng(settings))
+    np.testing.assert_array_equal(stepped.population_h, exact.population_h)
+    np.testing.assert_array_equal(stepped.population_z, exact.population_z)
+
+def test_adaptive_run_over_near_empty_regions_conserves_population(region_set, settings):
+    shape_gdf, neighbors_df, population_df = region_set
+    population_df = population_df.copy()
+    population_df.loc[population_df.index[::2], "POP"] = 2
+    settings.time_stepping = "adaptive"
+    settings.max_time_step = 30
+    settings.step_tolerance = 0.5
+    settings.simulation_length = 60
+    initial_df = simulate.initialize(shape_gdf, neighbors_df, population_df, settings)
+    total = initial_df[["population_h", "population_z", "population_d"]].to_numpy().sum()
+    data = simulate.run(initial_df, settings)
+    for day in range(len(data)):
+        assert data[day][["population_h", "population_z", "population_d"]].to_numpy().sum() == total
@@ -0,0 +1,40 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+import ensemble
+import instrument
+import simulate
+from state import DYNAMIC_COLUMNS
+
+def test_day_zero_state_matches_initialize(region_set, settings, initial_df):
+    other = copy.copy(settings)
+    other.outbreak_region = settings.outbreak_region[:1]
+    other.outbreak_size = 500
+    settings_list = [settings, other]
+    topology = simulate.get_topology(initial_df)
+    state = ensemble.initial_state(initial_df, settings_list)
+    simulate.derive_initial_state(state, topology, ensemble.get_kernel_parameters(topology, settings_list), simulate.make_rng(settings))
+    for i, scenario in enumerate(settings_list):
+        expected = simulate.initialize(*region_set, scenario)
+        for column in DYNAMIC_COLUMNS:
+            np.testing.assert_allclose(getattr(state, column)[i], expected[column].to_numpy(), err_msg=column)
+
+def test_scenarios_stop_and_check_like_serial_runs(region_set, settings, initial_df):
+    settings.conservation_check_interval = 5
+    steady = copy.copy(settings)
+    steady.steady_state_tolerance = 1e9
+    steady.steady_state_days = 2
+    unpadded = copy.copy(steady)
+    unpadded.pad_stopped_runs = False
+    settings_list = [settings, steady, unpadded]
+    with instrument.recording() as recorder:
+        summaries = ensemble.run(initial_df, settings_list)
+    assert recorder.timings["simulate.conservation_check"].calls == settings.simulation_length // 5
+    for scenario, summary in zip(settings_list, summaries):
+        trajectory = simulate.run(simulate.initialize(*region_set, scenario), scenario)
+        assert summary.attrs["stop_reason"] == trajectory.stop_reason
+        pd.testing.assert_frame_equal(summary, simulate.summarize(trajectory))
+    assert summaries[1].attrs["stop_reason"] == simulate.STOP_STEADY_STATE
+    assert len(summaries[2]) < len(summaries[1])
@@ -0,0 +1,19 @@
+import os
+
+import benchmark
+import checkpoint
+import headless
+import main
+
+def test_headless_resumes_a_menu_checkpoint(region_set, settings, tmp_path):
+    filepaths, ids = benchmark.write_data_directory(str(tmp_path), region_set[0], region_set[2])
+    settings.outbreak_region = [ids[region] for region in settings.outbreak_region]
+    settings.checkpoint_interval = 10
+    _, _, expected = main.run_simulation(settings, filepaths)
+    for filename in os.listdir(filepaths.checkpoint_directory):
+        if not filename.endswith("10.npz"):
+            os.remove(os.path.join(filepaths.checkpoint_directory, filename))
+    assert checkpoint.load(checkpoint.latest(filepaths.checkpoint_directory)).day == 10
+
+    summary = headless.resume_simulation(filepaths)
+    assert summary.equals(expected)
@@ -0,0 +1,13 @@
+import numpy as np
+
+import parallel
+import simulate
+from state import DYNAMIC_COLUMNS
+
+def test_kept_trajectory_matches_serial_run(settings, initial_df):
+    serial = simulate.run(initial_df, settings)
+    job = parallel.run_jobs(initial_df, [settings], processes=1, keep_trajectories=True)[0]
+    assert len(job.trajectory) == len(serial)
+    for day in range(len(serial)):
+        for column in DYNAMIC_COLUMNS:
+            np.testing.assert_array_equal(job.trajectory[day][column].to_numpy(), serial[day][column].to_numpy(), err_msg=f"{column} on day {day}")
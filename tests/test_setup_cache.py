@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import benchmark
+from config import Settings
+import instrument
+import setup
+import setup_cache
+
+def write_state_shapefile(filepaths, shape_gdf) -> None:
+    '''
+    A state shapefile of the region set, with every state the union of its regions
+    '''
+    state_gdf = shape_gdf.dissolve("STATEFP", aggfunc={"ALAND":"sum", "AWATER":"sum"}).reset_index()
+    state_gdf["NAME"] = "State " + state_gdf["STATEFP"]
+    state_gdf.to_file(os.path.join(filepaths.shape_directory, filepaths.state_shapefile_filename))
+
+def test_only_fully_validated_caches_are_trusted(region_set, tmp_path):
+    filepaths, _ = benchmark.write_data_directory(str(tmp_path), region_set[0], region_set[2])
+    settings = Settings()
+    settings.simulation_resolution = "county"
+    settings.schema_validation = "structural"
+    setup.main(settings, filepaths)
+    name, key = setup_cache.get_setup_cache_key(settings, filepaths)
+    assert setup_cache.read_cache_key(filepaths, name, key)["validation"] == "structural"
+
+    settings.schema_validation = "auto"
+    assert setup_cache.read_attribute_inputs(settings, filepaths) is None
+    population_schema = setup_cache.get_population_schema(settings)
+    # Read without polygons, the shapes are not fully checked
+    shape_df, _ = setup_cache.read_setup_cache(filepaths, name, key, settings.schema_validation, False, population_schema)
+    assert shape_df.attrs["validation"]["level"] == "full"
+    assert setup_cache.read_cache_key(filepaths, name, key)["validation"] == "structural"
+    with instrument.recording() as recorder:
+        shape_df, _ = setup_cache.read_setup_cache(filepaths, name, key, settings.schema_validation, population_schema=population_schema)
+    assert shape_df.attrs["validation"]["level"] == "full"
+    assert recorder.counts["schema.full"] == 2
+    assert setup_cache.read_cache_key(filepaths, name, key)["validation"] == "full"
+
+    shape_df, _ = setup_cache.read_setup_cache(filepaths, name, key, settings.schema_validation, population_schema=population_schema)
+    assert shape_df.attrs["validation"]["level"] == "trusted"
+    assert setup_cache.read_attribute_inputs(settings, filepaths) is not None
+
+@pytest.mark.parametrize("written", ["full", "structural", "trusted", "auto"])
+@pytest.mark.parametrize("read", ["full", "structural", "trusted", "auto"])
+def test_warm_state_cache(region_set, tmp_path, written, read):
+    filepaths, _ = benchmark.write_data_directory(str(tmp_path), region_set[0], region_set[2])
+    write_state_shapefile(filepaths, region_set[0])
+    settings = Settings()
+    settings.simulation_resolution = "state"
+    settings.schema_validation = written
+    expected = setup.main(settings, filepaths, geometry=False)
+    settings.schema_validation = read
+    name, key = setup_cache.get_setup_cache_key(settings, filepaths)
+    assert setup_cache.read_cache_key(filepaths, name, key) is not None
+    shape_df, neighbor_df, population_df = setup.main(settings, filepaths, geometry=False)
+    assert shape_df.equals(expected[0])
+    assert population_df.equals(expected[2])
+    # Trusted graph files are read without the neighbor lists (see topology.graph_frame)
+    columns = neighbor_df.columns.intersection(expected[1].columns, sort=False)
+    assert neighbor_df[columns].equals(expected[1][columns])
@@ -0,0 +1,20 @@
+import numpy as np
+
+from state import DYNAMIC_COLUMNS, SimulationState
+import simulate
+
+def test_time_step_continues_one_random_stream(region_set, settings):
+    settings.migration_rounding = "stochastic"
+    settings.random_seed = 7
+    df = simulate.initialize(*region_set, settings)
+    topology = simulate.get_topology(df)
+    params = simulate.KernelParameters(settings)
+    # The array engine draws from one generator: day 0, then every day after it
+    rng = simulate.make_rng(settings)
+    simulate.calculate_derived_values(df, settings, rng)
+    state = SimulationState.from_frame(df)
+    for _ in range(settings.simulation_length):
+        simulate.advance_state(state, topology, params, rng)
+        df = simulate.time_step(df, settings)
+        for column in DYNAMIC_COLUMNS:
+            np.testing.assert_array_equal(df[column].to_numpy(), getattr(state, column))
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from state import DYNAMIC_COLUMNS
+import simulate
+import topology
+from topology import Topology
+
+TOPOLOGY_ARRAYS = ["area", "border_length", "border_area_z", "indptr", "dst", "shared_border_length"]
+
+def assert_same_topology(a:Topology, b:Topology) -> None:
+    assert a.ids == b.ids
+    for name in TOPOLOGY_ARRAYS:
+        np.testing.assert_array_equal(getattr(a, name), getattr(b, name))
+
+def test_from_arrays_matches_from_frame(region_set, initial_df):
+    arrays = topology.graph_arrays(region_set[1].reset_index())
+    area = initial_df["area"].to_numpy()
+    border_area_z = initial_df["border_area_z"].to_numpy()
+    assert_same_topology(Topology.from_arrays(arrays, area, border_area_z), Topology.from_frame(initial_df))
+
+    reordered_df = initial_df.iloc[::-1]
+    reordered = Topology.from_arrays(arrays, area[::-1], border_area_z[::-1], reordered_df.index)
+    assert_same_topology(reordered, Topology.from_frame(reordered_df))
+    with pytest.raises(ValueError):
+        Topology.from_arrays(arrays, area[:10], border_area_z[:10], initial_df.index[:10])
+
+def test_graph_frame_without_neighbor_lists(region_set, settings):
+    shape_gdf, neighbors_df, population_df = region_set
+    arrays = topology.graph_arrays(neighbors_df.reset_index())
+    graph_df = topology.graph_frame(arrays, neighbors=False).set_index("id")
+    assert "neighbors" not in graph_df.columns
+    pd.testing.assert_frame_equal(graph_df, topology.graph_frame(arrays).set_index("id").drop(columns="neighbors"))
+
+    expected_df = simulate.initialize(shape_gdf, neighbors_df, population_df, settings)
+    initial_df = simulate.initialize(shape_gdf, graph_df, population_df, settings)
+    assert "neighbors" not in initial_df.columns
+    assert_same_topology(initial_df.attrs["topology"], expected_df.attrs["topology"])
+    assert_same_topology(Topology.from_frame(initial_df), expected_df.attrs["topology"])
+    expected = simulate.run(expected_df, settings)
+    trajectory = simulate.run(initial_df, settings)
+    for column in DYNAMIC_COLUMNS:
+        np.testing.assert_array_equal(trajectory.column(column), expected.column(column))
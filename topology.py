@@ -0,0 +1,329 @@
+import numpy as np
+import pandas as pd
+import utils
+
+MIGRATION_ROUNDING_ERROR_MESSAGE = "migration_rounding must be 'truncate', 'largest_remainder' or 'stochastic'"
+GRAPH_FORMAT_VERSION = 1
+
+class Topology:
+    '''
+    Static view of the region graph used by the simulation kernels.
+
+    Regions are addressed by position and the neighbor lists are flattened into a directed
+    edge list (src -> dst) in CSR order, so each day's migration is a handful of gathers
+    and a scatter instead of a Python loop over every neighbor dict.
+    '''
+    def __init__(
+            self,
+            ids:list[str],
+            area:np.ndarray,
+            border_length:np.ndarray,
+            border_area_z:np.ndarray,
+            indptr:np.ndarray,
+            dst:np.ndarray,
+            shared_border_length:np.ndarray
+        ):
+        self.ids = list(ids)
+        self.area = np.asarray(area, dtype=float)
+        self.border_length = np.asarray(border_length, dtype=float)
+        self.border_area_z = np.asarray(border_area_z, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.dst = np.asarray(dst, dtype=np.int64)
+        self.src = np.repeat(np.arange(len(self.ids), dtype=np.int64), np.diff(self.indptr))
+        self.shared_border_length = np.asarray(shared_border_length, dtype=float)
+        # Each border is evaluated once, from the listing with src < dst (or the only listing
+        # there is), and applied with opposite signs to both ends so zeds are conserved.
+        n = len(self.ids)
+        keys = self.src * n + self.dst
+        reverse_listed = np.isin(self.dst * n + self.src, keys)
+        canonical = (self.src < self.dst) | ~reverse_listed
+        self.edge_src = self.src[canonical]
+        self.edge_dst = self.dst[canonical]
+        edge_shared_border_length = self.shared_border_length[canonical]
+        # Per-edge coefficients, kept in the same operand order as the scalar formula
+        self.src_fraction = edge_shared_border_length / self.border_length[self.edge_src]
+        self.dst_fraction = edge_shared_border_length / self.border_length[self.edge_dst]
+        self.src_border_area_z = self.border_area_z[self.edge_src]
+        self.dst_border_area_z = self.border_area_z[self.edge_dst]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __deepcopy__(self, memo):
+        # Topologies are never mutated, so DataFrame.attrs copies can share one instance
+        return self
+
+    def active_regions(self, has_zeds:np.ndarray) -> np.ndarray:
+        '''
+        Mask of the regions with zeds plus their one-hop neighbors
+        '''
+        active = has_zeds.copy()
+        active[self.dst[has_zeds[self.src]]] = True
+        return active
+
+    def active_edges(self, has_zeds:np.ndarray) -> np.ndarray:
+        '''
+        Borders with zeds on at least one side, the only ones that can carry migration
+        '''
+        return np.flatnonzero(has_zeds[self.edge_src] | has_zeds[self.edge_dst])
+
+    @classmethod
+    def from_frame(cls, df:pd.DataFrame) -> "Topology":
+        if "neighbors" not in df.columns and "graph" in df.attrs:
+            # Built from a graph frame without neighbor lists, see graph_frame
+            return cls.from_arrays(
+                df.attrs["graph"].arrays,
+                df["area"].to_numpy(dtype=float),
+                df["border_area_z"].to_numpy(dtype=float),
+                df.index
+            )
+        positions = {region_id:i for i, region_id in enumerate(df.index)}
+        counts = []
+        dst = []
+        shared_border_length = []
+        for neighbors in df["neighbors"]:
+            counts.append(len(neighbors))
+            for neighbor in neighbors:
+                dst.append(positions[neighbor["neighbor_id"]])
+                shared_border_length.append(neighbor["shared_border_length"])
+        indptr = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        return cls(
+            df.index,
+            df["area"].to_numpy(dtype=float),
+            df["border_length"].to_numpy(dtype=float),
+            df["border_area_z"].to_numpy(dtype=float),
+            indptr,
+            np.array(dst, dtype=np.int64),
+            np.array(shared_border_length, dtype=float)
+        )
+
+    @classmethod
+    def from_arrays(
+            cls,
+            arrays:dict[str, np.ndarray],
+            area:np.ndarray,
+            border_area_z:np.ndarray,
+            ids:list[str]|None = None
+        ) -> "Topology":
+        '''
+        The topology of the CSR arrays of a graph file (see graph_arrays), without building
+        any neighbor dict. ids picks and orders the regions (default: all of them, in file
+        order); the neighbors of every picked region have to be picked too.
+        '''
+        indptr = np.asarray(arrays["indptr"], dtype=np.int64)
+        indices = np.asarray(arrays["indices"], dtype=np.int64)
+        shared_border_length = arrays["shared_border_length"]
+        border_length = arrays["border_length"]
+        if ids is None or np.array_equal(np.asarray(ids, dtype=str), arrays["ids"]):
+            return cls(arrays["ids"].tolist(), area, border_length, border_area_z, indptr, indices, shared_border_length)
+        positions = pd.Index(arrays["ids"]).get_indexer(ids)
+        if (positions < 0).any():
+            raise ValueError(f"Region {list(ids)[np.flatnonzero(positions < 0)[0]]} is not a region of the graph")
+        counts = np.diff(indptr)[positions]
+        picked_indptr = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        edges = np.arange(picked_indptr[-1]) + np.repeat(indptr[positions] - picked_indptr[:-1], counts)
+        picked = np.full(len(indptr) - 1, -1, dtype=np.int64)
+        picked[positions] = np.arange(len(positions))
+        dst = picked[indices[edges]]
+        if (dst < 0).any():
+            raise ValueError(f"Neighbor {arrays['ids'][indices[edges][dst < 0][0]]} is not one of the picked regions")
+        return cls(ids, area, border_length[positions], border_area_z, picked_indptr, dst, shared_border_length[edges])
+
+    def scatter(self, flow:np.ndarray, edges:np.ndarray|None = None) -> np.ndarray:
+        '''
+        Sums per-edge flows into their regions. flow may carry leading axes (e.g. scenarios)
+        and may cover only the subset of edges given by edges.
+        '''
+        n = len(self.ids)
+        edge_src = self.edge_src if edges is None else self.edge_src[edges]
+        edge_dst = self.edge_dst if edges is None else self.edge_dst[edges]
+        if flow.ndim == 1:
+            return np.bincount(edge_src, weights=flow, minlength=n) - np.bincount(edge_dst, weights=flow, minlength=n)
+        rows = flow.reshape(-1, flow.shape[-1])
+        offsets = np.arange(len(rows))[:, None] * n
+        size = len(rows) * n
+        ret = np.bincount((edge_src + offsets).ravel(), weights=rows.ravel(), minlength=size) \
+            - np.bincount((edge_dst + offsets).ravel(), weights=rows.ravel(), minlength=size)
+        return ret.reshape(flow.shape[:-1] + (n,))
+
+    def edge_flows(
+            self,
+            population_z:np.ndarray,
+            killed_z:np.ndarray,
+            border_area_z:np.ndarray|None = None,
+            edges:np.ndarray|None = None
+        ) -> np.ndarray:
+        '''
+        Unrounded number of zeds crossing each border (or each border in edges), positive
+        towards edge_src. border_area_z overrides the static border areas, e.g. with one
+        row per scenario.
+        '''
+        edges = slice(None) if edges is None else edges
+        edge_src = self.edge_src[edges]
+        edge_dst = self.edge_dst[edges]
+        if border_area_z is None:
+            src_border_area_z = self.src_border_area_z[edges]
+            dst_border_area_z = self.dst_border_area_z[edges]
+        else:
+            src_border_area_z = border_area_z[..., edge_src]
+            dst_border_area_z = border_area_z[..., edge_dst]
+        conc = (np.asarray(population_z, dtype=float) - killed_z) / self.area
+        src_conc = conc[..., edge_src]
+        dst_conc = conc[..., edge_dst]
+        src_border_zeds = src_conc * self.src_fraction[edges] * src_border_area_z
+        dst_border_zeds = dst_conc * self.dst_fraction[edges] * dst_border_area_z
+        base_migration = (dst_border_zeds - src_border_zeds) / 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.abs(dst_conc - src_conc) / (dst_conc + src_conc)
+        return np.where(base_migration != 0, rate * base_migration, 0.0)
+
+    def migration(
+            self,
+            population_z:np.ndarray,
+            killed_z:np.ndarray,
+            rounding:str = "truncate",
+            rng:np.random.Generator|None = None,
+            border_area_z:np.ndarray|None = None,
+            edges:np.ndarray|None = None
+        ) -> np.ndarray:
+        '''
+        Net number of zeds moving into each region. The result always sums to zero.
+
+        "truncate" drops the fractional part of every border crossing, like the scalar
+        model. "largest_remainder" and "stochastic" round each region's net migration and
+        hand the leftover units to the largest remainders, or to regions drawn in
+        proportion to their remainders using rng. Borders left out of edges are taken to
+        carry no zeds.
+        '''
+        flow = self.edge_flows(population_z, killed_z, border_area_z, edges)
+        match rounding:
+            case "truncate":
+                return self.scatter(np.trunc(flow), edges)
+            case "largest_remainder":
+                rng = None
+            case "stochastic":
+                rng = rng if rng is not None else np.random.default_rng()
+            case _:
+                raise ValueError(MIGRATION_ROUNDING_ERROR_MESSAGE)
+        net = self.scatter(flow, edges)
+        if net.ndim == 1:
+            return utils.round_preserving_sum(net, 0, rng)
+        rows = [utils.round_preserving_sum(row, 0, rng) for row in net.reshape(-1, net.shape[-1])]
+        return np.reshape(rows, net.shape)
+
+class Graph:
+    '''
+    The arrays of a graph file, as kept in DataFrame.attrs by graph_frame. Like topologies,
+    attrs copies share one instance instead of copying (or comparing) the arrays.
+    '''
+    def __init__(self, arrays:dict[str, np.ndarray]):
+        self.arrays = arrays
+
+    def __deepcopy__(self, memo):
+        return self
+
+def graph_arrays(neighbors_df:pd.DataFrame) -> dict[str, np.ndarray]:
+    '''
+    The CSR arrays of a cleaned neighbor frame (one row per region, with an "id" column).
+    The attributes each neighbor dict repeats are stored once per region, so they must
+    agree with the neighbor's own row.
+    '''
+    ids = neighbors_df["id"].to_numpy(dtype=str)
+    positions = {region_id:i for i, region_id in enumerate(ids)}
+    if len(positions) != len(ids):
+        raise ValueError("Region ids in the neighbor file are not unique")
+    has_county_fp = "county_fp" in neighbors_df.columns
+    arrays = {
+        "version":np.array(GRAPH_FORMAT_VERSION),
+        "ids":ids,
+        "state_fp":neighbors_df["state_fp"].to_numpy(dtype=str),
+        "name":neighbors_df["name"].to_numpy(dtype=str),
+        "border_length":neighbors_df["border_length"].to_numpy(dtype=float)
+    }
+    if has_county_fp:
+        arrays["county_fp"] = neighbors_df["county_fp"].to_numpy(dtype=str)
+    counts = []
+    indices = []
+    shared_border_length = []
+    for neighbors in neighbors_df["neighbors"]:
+        neighbors = neighbors if isinstance(neighbors, list) else []
+        counts.append(len(neighbors))
+        for neighbor in neighbors:
+            j = positions.get(neighbor["neighbor_id"])
+            if j is None:
+                raise ValueError(f"Neighbor {neighbor['neighbor_id']} is not a region of the neighbor file")
+            if neighbor["neighbor_state_fp"] != arrays["state_fp"][j] or neighbor["neighbor_name"] != arrays["name"][j] \
+                    or (has_county_fp and neighbor.get("neighbor_county_fp") != arrays["county_fp"][j]):
+                raise ValueError(f"Neighbor {neighbor['neighbor_id']} does not match its own record")
+            indices.append(j)
+            shared_border_length.append(neighbor["shared_border_length"])
+    arrays["indptr"] = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    arrays["indices"] = np.array(indices, dtype=np.int64)
+    arrays["shared_border_length"] = np.array(shared_border_length, dtype=float)
+    return arrays
+
+def write_graph(filename:str, neighbors_df:pd.DataFrame) -> None:
+    utils.write_npz(filename, graph_arrays(neighbors_df))
+
+def read_graph(filename:str) -> dict[str, np.ndarray]:
+    '''
+    The memory-mapped arrays of a graph file written by write_graph
+    '''
+    arrays = utils.read_npz(filename)
+    if "version" not in arrays or int(arrays["version"]) != GRAPH_FORMAT_VERSION:
+        raise ValueError(f"{filename} is not a version {GRAPH_FORMAT_VERSION} graph file")
+    return arrays
+
+def graph_records(arrays:dict[str, np.ndarray], positions:np.ndarray|None = None) -> list[dict]:
+    '''
+    The neighbor file records of the regions at positions (default: all of them), in the
+    layout generate_neighborfile writes
+    '''
+    ids = arrays["ids"].tolist()
+    state_fp = arrays["state_fp"].tolist()
+    name = arrays["name"].tolist()
+    county_fp = arrays["county_fp"].tolist() if "county_fp" in arrays else None
+    border_length = arrays["border_length"].tolist()
+    indptr = arrays["indptr"].tolist()
+    indices = arrays["indices"].tolist()
+    shared_border_length = arrays["shared_border_length"].tolist()
+    positions = range(len(ids)) if positions is None else positions
+    records = []
+    for i in positions:
+        record = {"id":ids[i], "state_fp":state_fp[i], "name":name[i]}
+        if county_fp is not None:
+            record["county_fp"] = county_fp[i]
+        record["border_length"] = border_length[i]
+        neighbors = []
+        for k in range(indptr[i], indptr[i+1]):
+            j = indices[k]
+            neighbor = {
+                "neighbor_id":ids[j],
+                "neighbor_state_fp":state_fp[j],
+                "neighbor_name":name[j],
+                "shared_border_length":shared_border_length[k]
+            }
+            if county_fp is not None:
+                neighbor["neighbor_county_fp"] = county_fp[j]
+            neighbors.append(neighbor)
+        record["neighbors"] = neighbors
+        records.append(record)
+    return records
+
+def graph_frame(arrays:dict[str, np.ndarray], positions:np.ndarray|None = None, neighbors:bool = True) -> pd.DataFrame:
+    '''
+    The cleaned neighbor frame of the regions at positions (default: all of them).
+
+    The neighbor dicts are only built with neighbors, e.g. for schema checks. Otherwise the
+    frame has no "neighbors" column and keeps the arrays in attrs["graph"] instead, which
+    Topology.from_frame reads directly.
+    '''
+    if not neighbors:
+        positions = slice(None) if positions is None else np.asarray(positions, dtype=np.int64)
+        keys = ["state_fp", "name"] + (["county_fp"] if "county_fp" in arrays else []) + ["border_length"]
+        df = pd.DataFrame({"id":arrays["ids"][positions]} | {key:arrays[key][positions] for key in keys})
+        df.attrs["graph"] = Graph(arrays)
+        return df
+    records = graph_records(arrays, positions)
+    columns = ["id", "state_fp", "name"] + (["county_fp"] if "county_fp" in arrays else []) + ["border_length", "neighbors"]
+    return pd.DataFrame.from_records(records, columns=columns)
@@ -1,13 +1,17 @@
 import json
 import math
+import numpy as np
+import os
 from pandas import DataFrame
-import shapely.geometry as sg
+import struct
+import zipfile
 
 
-def get_border_length(polygon:sg.Polygon) -> float:
+# Shapely is left to the callers, which already have it loaded
+def get_border_length(polygon:"shapely.Polygon") -> float:
     return polygon.length
 
-def get_shared_border_length(polygon1:sg.Polygon, polygon2:sg.Polygon) -> float:
+def get_shared_border_length(polygon1:"shapely.Polygon", polygon2:"shapely.Polygon") -> float:
     border = polygon1.intersection(polygon2)
     return border.length
 
@@ -25,6 +29,43 @@ def df_from_json(filename:str, index=None) -> DataFrame:
     data = read_json_file(filename)
     return DataFrame.from_records(data, index=index)
 
+def write_npz(filename:str, arrays:dict[str, np.ndarray]) -> None:
+    '''
+    Writes arrays uncompressed, so read_npz can memory-map them. The file is written next
+    to filename and renamed, so readers never see half of it.
+    '''
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_filename, filename)
+
+def read_npz(filename:str, mmap_mode:str|None = "r") -> dict[str, np.ndarray]:
+    '''
+    Reads every array of an .npz file. Uncompressed members are memory-mapped in place
+    (np.load can only map .npy files); compressed ones, or any with mmap_mode None, are read.
+    '''
+    with zipfile.ZipFile(filename) as archive:
+        members = archive.infolist()
+    if mmap_mode is None or any(member.compress_type != zipfile.ZIP_STORED for member in members):
+        with np.load(filename) as archive:
+            return {key:archive[key] for key in archive.files}
+    arrays = {}
+    with open(filename, "rb") as f:
+        for member in members:
+            # The member's data follows its local header: 30 bytes, its name and an extra field
+            f.seek(member.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(member.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            key = member.filename.removesuffix(".npy")
+            if math.prod(shape) == 0:
+                arrays[key] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[key] = np.memmap(f, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape, order="F" if fortran_order else "C")
+    return arrays
+
 def sigmoid(x:float, m:float=1, b:float=0) -> float:
     return 1 / (1 + math.exp(-m*(x-b/m)))
 
@@ -57,6 +98,29 @@ def calculate_key_frames_logarithmic(data_length:int, number_of_frames:int) -> l
     key_frames.append(data_length-1)
     return key_frames
 
+def round_preserving_sum(values:np.ndarray, total:int|None = None, rng:np.random.Generator|None = None) -> np.ndarray:
+    '''
+    Rounds values to integers that add up to total (default: the rounded sum of values).
+    Every value is floored and the missing units go to the largest remainders in O(n),
+    or, when rng is given, to entries drawn with probability proportional to their remainders.
+    '''
+    values = np.asarray(values, dtype=float)
+    ret = np.floor(values)
+    remainders = values - ret
+    if total is None:
+        total = round(values.sum())
+    units = int(total - ret.sum())
+    if units <= 0:
+        return ret
+    candidates = np.flatnonzero(remainders > 0)
+    if rng is None:
+        chosen = candidates[np.argpartition(-remainders[candidates], units - 1)[:units]]
+    else:
+        weights = remainders[candidates]
+        chosen = rng.choice(candidates, size=units, replace=False, p=weights / weights.sum())
+    ret[chosen] += 1
+    return ret
+
 def interpolate_rgb(x, arr0, arr1):
     ret = []
     for i in range(len(arr0)):
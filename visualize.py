@@ -1,21 +1,93 @@
 from config import Settings
 from geopandas import GeoDataFrame
+import instrument
 import math
 import matplotlib.animation as animation
 from matplotlib.colors import ListedColormap
 import matplotlib.pyplot as plt
 import numpy as np
 from pandas import DataFrame
+from sinks import KeyframeSink, get_key_frames, get_recorded_days
+from typing import Callable
 import utils
 
-TIME_PROGRESSION_ERROR_MESSAGE = "TIME_PROGRESSION must be 'lin' or 'log'"
 BASE_COLORMAP = [
     [1.0, 0.0, 0.1, 1.0],
     [0.8, 0.8, 0.2, 1.0],
     [0.0, 1.0, 0.1, 1.0]
 ]
-FRAME = -1
-TOTAL_FRAMES = -1
+
+class FrameProgress:
+    '''
+    Counts the frames an animation has rendered so far
+    '''
+    def __init__(self, total_frames:int):
+        self.frame = 1
+        self.total_frames = total_frames
+
+    def advance(self) -> None:
+        print(f'Rendering frame {self.frame} / {self.total_frames}')
+        self.frame += 1
+
+class GeoPlotData:
+    '''
+    The map colours of the plotted days: colors[i, j] is the colormap entry of region j
+    (the j-th row of shapes) on days[i]
+    '''
+    def __init__(self, shapes:GeoDataFrame, days:list[int], colors:np.ndarray):
+        self.shapes = shapes
+        self.days = days
+        self.colors = colors
+        self.rows = {day:i for i, day in enumerate(days)}
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def frame(self, day:int) -> np.ndarray:
+        return self.colors[self.rows[day]]
+
+class GeoArtists:
+    '''
+    A geo plot drawn once. update() only recolours the regions and changes the day of the
+    annotation, instead of clearing the axes and replotting every polygon and border.
+    '''
+    def __init__(
+            self,
+            ax:any,
+            limits:tuple[tuple[float, float], tuple[float, float]],
+            data:GeoPlotData,
+            borders:GeoDataFrame,
+            colormap:ListedColormap
+        ):
+        #Configure axes
+        ax.clear()
+        ax.set_xlim(limits[0])
+        ax.set_ylim(limits[1])
+        ax.axis('off')
+        self.day = ax.annotate("", xy=(0.5, -0.05), xycoords='axes fraction', fontsize=12, ha='center')
+
+        # Plot boundaries
+        _ = borders.boundary.plot(ax=ax, edgecolor='black', linewidth=0.3)
+        _ = data.shapes.boundary.plot(ax=ax, antialiased=False, edgecolor='face', linewidth=0.4)
+
+        # The regions are plotted with their row numbers first: the collection then tells
+        # which row each of its patches, multipolygon parts included, has to be coloured by
+        data.shapes.plot(
+            ax=ax,
+            column=np.arange(len(data.shapes)),
+            legend=False,
+            cmap=colormap,
+            rasterized=True,
+            vmin=0,
+            vmax=len(colormap.colors)-1
+        )
+        self.regions = ax.collections[-1]
+        self.rows = np.asarray(self.regions.get_array(), dtype=np.intp)
+
+    def update(self, frame:int, data:GeoPlotData) -> list:
+        self.regions.set_array(data.frame(frame)[self.rows])
+        self.day.set_text(f"Day: {frame}")
+        return [self.regions, self.day]
 
 def generate_custom_colormap(color_slices = 5, alpha_slices = 4):    
     arr = np.array(BASE_COLORMAP)
@@ -35,25 +107,57 @@ def generate_custom_colormap(color_slices = 5, alpha_slices = 4):
         colors.append(np.concatenate((alpha*arr[-1][:3],[arr[-1][3]])))
     return ListedColormap(colors)
 
-def generate_geo_plot_data(src_data_list:list[DataFrame], gdf:GeoDataFrame, settings:Settings) -> GeoDataFrame:
-    data = []
-    population_top_percentile = src_data_list[0]["population_h"].quantile(0.99)
-    pop_scaling = utils.safe_log10(population_top_percentile)
-    for step in range(len(src_data_list)):
-        pop_h = src_data_list[step]["population_h"]
-        pop_z = src_data_list[step]["population_z"]
-        value = pop_h.apply(utils.safe_log10) / (pop_h + pop_z + 2).apply(utils.safe_log10) #Should be between [0, 1)
-        level = 1 - ((pop_h + pop_z + 2).apply(utils.safe_log10) / pop_scaling).apply(min, args=(1,)) #Should be between [0, 1)
-        datum = settings.color_slices*(settings.alpha_slices * level).apply(math.floor) + (settings.color_slices * value).apply(math.floor)
-        datum.name = step
-        data.append(datum)
-    data_df = DataFrame(data).T
-    ret_df = GeoDataFrame(        
-        data = data_df,
-        geometry = gdf.geometry,
-        crs = gdf.crs
-    )
-    return ret_df
+def get_animation_frames(pop_data:DataFrame, settings:Settings) -> list[int]:
+    '''
+    Key frames of the full-length run, trimmed to the days a stopped run actually has and
+    ending on its final day
+    '''
+    last_day = len(pop_data) - 1
+    key_frames = [day for day in get_key_frames(settings, settings.simulation_length + 1) if day <= last_day]
+    if last_day < settings.simulation_length and last_day not in key_frames:
+        key_frames.append(last_day)
+    return key_frames
+
+def get_color_indices(pop_h:np.ndarray, pop_z:np.ndarray, settings:Settings) -> np.ndarray:
+    '''
+    The colormap entry of every cell of the [days x regions] population matrices. The hue
+    shows the human share of the log population and the shade its size, relative to the top
+    percentile of the first day.
+    '''
+    # utils.safe_log10 on whole matrices: every total is at least 2, and populations are counts
+    log_h = np.log10(np.maximum(pop_h, 1))
+    log_total = np.log10(pop_h + pop_z + 2)
+    pop_scaling = utils.safe_log10(np.quantile(pop_h[0], 0.99))
+    value = log_h / log_total #Should be between [0, 1)
+    with np.errstate(divide="ignore"):
+        level = 1 - np.minimum(log_total / pop_scaling, 1) #Should be between [0, 1)
+    colors = settings.color_slices*np.floor(settings.alpha_slices * level) + np.floor(settings.color_slices * value)
+    return colors.astype(np.min_scalar_type(settings.color_slices * (settings.alpha_slices + 1)))
+
+def generate_geo_plot_data(src_data:list[DataFrame]|KeyframeSink, gdf:GeoDataFrame|Callable[[], GeoDataFrame], settings:Settings) -> GeoPlotData:
+    '''
+    gdf may also be a function returning the polygons, so runs that are never plotted never
+    read them. Only the days show_frame and make_animation draw are computed.
+    '''
+    if callable(gdf):
+        with instrument.timer("visualize.read_shapes"):
+            gdf = gdf()
+    with instrument.timer("visualize.plot_data"):
+        if isinstance(src_data, KeyframeSink):
+            days = src_data.days
+            index = src_data.index
+            pop_h = src_data.matrix("population_h", days)
+            pop_z = src_data.matrix("population_z", days)
+        else:
+            # A run that stopped early still ends on its final day, like in a KeyframeSink
+            last_day = len(src_data) - 1
+            days = sorted({day for day in get_recorded_days(settings) if day <= last_day} | {last_day})
+            index = src_data[days[0]].index
+            pop_h = np.stack([src_data[day]["population_h"].to_numpy() for day in days])
+            pop_z = np.stack([src_data[day]["population_z"].to_numpy() for day in days])
+        colors = get_color_indices(pop_h, pop_z, settings)
+        shapes = GeoDataFrame(geometry=gdf.geometry.reindex(index), crs=gdf.crs)
+    return GeoPlotData(shapes, days, colors)
 
 def get_geo_limits(data:GeoDataFrame) -> tuple[tuple[float], tuple[float]]:
     xlim = (data.total_bounds[0], data.total_bounds[2])
@@ -74,7 +178,7 @@ def setup_plots_and_limits(plot_types, geo_data, pop_data, settings):
     limits = []    
     for plot_type in plot_types:
         if plot_type == "geo":
-            limits.append(get_geo_limits(geo_data))
+            limits.append(get_geo_limits(geo_data.shapes))
         else:
             limits.append(get_data_limits(pop_data, "population_h_log10"))    
     colormap = generate_custom_colormap(settings.color_slices, settings.alpha_slices)
@@ -82,22 +186,34 @@ def setup_plots_and_limits(plot_types, geo_data, pop_data, settings):
 
 def generate_frame(
         frame:int,
-        geo_data:GeoDataFrame,
+        geo_data:GeoPlotData,
         plot_borders:GeoDataFrame,
         pop_data:DataFrame,  
         plot_types:list[str],
         plot_axes:any,
         limits:tuple[tuple[float], tuple[float]],
-        colormap:ListedColormap
-    ) -> None:
-    for [ax, bounds, plot_type] in zip(plot_axes.flat, limits, plot_types):
-        match plot_type:
-            case "geo":                
-                generate_geo_frame(frame, ax, bounds, geo_data, plot_borders, colormap)
-            case "bar":
-                generate_bar_frame(frame, ax, bounds, pop_data)
-            case "line":
-                generate_line_frame(frame, ax, bounds, pop_data)
+        colormap:ListedColormap,
+        progress:FrameProgress|None = None,
+        geo_artists:dict|None = None
+    ) -> list:
+    '''
+    Draws frame on every plot and returns the geo artists it changed. geo_artists keeps the
+    geo plots between the frames of an animation (see generate_geo_frame).
+    '''
+    changed = []
+    with instrument.timer("visualize.frame"):
+        for [ax, bounds, plot_type] in zip(plot_axes.flat, limits, plot_types):
+            match plot_type:
+                case "geo":                
+                    changed += generate_geo_frame(frame, ax, bounds, geo_data, plot_borders, colormap, geo_artists)
+                case "bar":
+                    generate_bar_frame(frame, ax, bounds, pop_data)
+                case "line":
+                    generate_line_frame(frame, ax, bounds, pop_data)
+    instrument.count("visualize.frames")
+    if progress is not None:
+        progress.advance()
+    return changed
 
 def generate_bar_frame(
         frame:int, 
@@ -126,36 +242,20 @@ def generate_geo_frame(
         frame:int, 
         ax:any, 
         limits:tuple[tuple[float, float], tuple[float, float]],
-        data:list[GeoDataFrame],
+        data:GeoPlotData,
         borders:GeoDataFrame,
-        colormap:ListedColormap
-        ) -> None:
-    
-    progress =  f"Day: {frame}"
-    #Configure axes
-    ax.clear()
-    ax.set_xlim(limits[0])
-    ax.set_ylim(limits[1])
-    ax.axis('off')        
-    ax.annotate(progress, xy=(0.5, -0.05), xycoords='axes fraction', fontsize=12, ha='center')        
-
-    # Plot boundaries
-    _ = borders.boundary.plot(ax=ax, edgecolor='black', linewidth=0.3) 
-    _ = data.boundary.plot(ax=ax, antialiased=False, edgecolor='face', linewidth=0.4)
-
-    # Plot the data for the current year
-    data.plot(
-        ax=ax,
-        column=frame,
-        legend=False,
-        cmap=colormap,
-        rasterized=True,
-        vmin=0,
-        vmax=len(colormap.colors)-1
-    )
-    global FRAME
-    print(f'Rendering frame {FRAME} / {TOTAL_FRAMES}')
-    FRAME += 1
+        colormap:ListedColormap,
+        artists:dict|None = None
+        ) -> list:
+    '''
+    Draws the geo plot of frame on ax, or only recolours it if artists already holds the
+    GeoArtists of ax. Returns the artists that changed.
+    '''
+    if artists is None:
+        artists = {}
+    if ax not in artists:
+        artists[ax] = GeoArtists(ax, limits, data, borders, colormap)
+    return artists[ax].update(frame, data)
 
 def generate_line_frame(
         frame:int, 
@@ -179,35 +279,32 @@ def generate_line_frame(
     ax.plot(pop_h, c = "green")
     ax.plot(pop_z, c = "red")
 
-def show_frame(geo_data:GeoDataFrame, plot_borders:GeoDataFrame, pop_data:DataFrame, settings:Settings) -> None:
+def show_frame(geo_data:GeoPlotData, plot_borders:GeoDataFrame, pop_data:DataFrame, settings:Settings) -> None:
     plot_types = settings.get_plot_types()
     (_, axs, limits, colormap) = setup_plots_and_limits(plot_types, geo_data, pop_data, settings)
-    generate_frame(settings.image_frame, geo_data, plot_borders, pop_data, plot_types, axs, limits, colormap)
+    frame = min(settings.image_frame, len(pop_data) - 1)
+    generate_frame(frame, geo_data, plot_borders, pop_data, plot_types, axs, limits, colormap)
     plt.show()
 
-def make_animation(geo_data:GeoDataFrame, plot_borders:GeoDataFrame, pop_data:DataFrame, settings:Settings) -> animation.FuncAnimation:
+def make_animation(geo_data:GeoPlotData, plot_borders:GeoDataFrame, pop_data:DataFrame, settings:Settings) -> animation.FuncAnimation:
     plot_types = settings.get_plot_types()
     (fig, axs, limits, colormap) = setup_plots_and_limits(plot_types, geo_data, pop_data, settings) 
-    total_frames = round(settings.fps * settings.animation_duration + 1)
-    match settings.time_progression:
-        case "lin":
-            key_frames = utils.calculate_key_frames_linear(len(geo_data.keys())-1, total_frames)
-        case "log":
-            key_frames = utils.calculate_key_frames_logarithmic(len(geo_data.keys())-1, total_frames)
-        case _:
-            raise ValueError(TIME_PROGRESSION_ERROR_MESSAGE)
-
-    # Create the animation
-    global FRAME, TOTAL_FRAMES
-    FRAME = 1
-    TOTAL_FRAMES = len(key_frames) + 1
+    key_frames = get_animation_frames(pop_data, settings)
+
+    # Create the animation. FuncAnimation draws the first frame with init_func to initialize,
+    # which happens more than once when blitting, so those draws are not counted.
+    progress = FrameProgress(len(key_frames))
+    geo_artists = {}
+    # Blitting only redraws the geo artists, so the bar and line plots, which rescale, rule it out
     mov = animation.FuncAnimation(
         fig=fig,
         func=generate_frame,        
-        fargs=(geo_data, plot_borders, pop_data, plot_types, axs, limits, colormap),
+        fargs=(geo_data, plot_borders, pop_data, plot_types, axs, limits, colormap, progress, geo_artists),
+        init_func=lambda: generate_frame(key_frames[0], geo_data, plot_borders, pop_data, plot_types, axs, limits, colormap, None, geo_artists),
         frames=key_frames,
         repeat=False,
-        interval=1000
+        interval=1000,
+        blit=plot_types == ["geo"]
     )
     return mov
 
@@ -216,4 +313,5 @@ def show_animation() -> None:
 
 def save_animation(video:animation.FuncAnimation, settings:Settings) -> None:
     writer = animation.PillowWriter(fps=settings.fps)
-    video.save(settings.video_filename, writer=writer)
\ No newline at end of file
+    with instrument.timer("visualize.save_animation"):
+        video.save(settings.video_filename, writer=writer)
\ No newline at end of file